@@ -4,6 +4,8 @@ RESTful API.
 
 """
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from itertools import chain
 
 # noinspection PyPackageRequirements
@@ -43,6 +45,7 @@ class KiveAPI(Session):
             'api_find_datasets': '/api/datasets/?{filters}',
             'api_dataset_add': '/api/datasets/',
             'api_dataset_dl': '/api/datasets/{dataset-id}/download/',
+            'api_dataset_uploads': '/api/datasets/uploads/',
 
             'api_pipeline_families': '/api/pipelinefamilies/',
             'api_pipeline_family': '/api/pipelinefamilies/{family-id}/',
@@ -240,6 +243,28 @@ class KiveAPI(Session):
         url += '&'.join(filters)
         return self.get(url, **kwargs)
 
+    def iterate(self, url, *args, **kwargs):
+        """ Yield all the records from a list that supports cursor pages.
+
+        Only one page is loaded at a time, so this can walk through very
+        long lists, like datasets or container runs.
+        :param url: the list's URL, like '/api/datasets/'
+        :param args: name/value pairs to filter on, like filter()
+        :param int page_size: number of records to request at a time
+        :param kwargs: passed on to get()
+        """
+        page_size = kwargs.pop('page_size', 1000)
+        url += '&' if '?' in url else '?'
+        url += 'cursor=&page_size={}'.format(page_size)
+        page = self.filter(url, *args, **kwargs).json()
+        while True:
+            for record in page['results']:
+                yield record
+            next_url = page['next']
+            if next_url is None:
+                break
+            page = self.get(next_url, **kwargs).json()
+
     def post(self, *args, **kwargs):
         nargs = list(args)
         url = self._prep_url(nargs[0])
@@ -264,6 +289,14 @@ class KiveAPI(Session):
         self._prep_headers(kwargs, nargs[0])
         return self._validate_response(super(KiveAPI, self).patch(*nargs, **kwargs))
 
+    def put(self, *args, **kwargs):
+        nargs = list(args)
+        nargs[0] = self._prep_url(nargs[0])
+        is_json = kwargs.pop('is_json', True)
+        self._prep_headers(kwargs, nargs[0])
+        return self._validate_response(super(KiveAPI, self).put(*nargs, **kwargs),
+                                       is_json=is_json)
+
     def delete(self, *args, **kwargs):
         nargs = list(args)
         nargs[0] = self._prep_url(nargs[0])
@@ -312,6 +345,39 @@ class KiveAPI(Session):
         datasets = self.filter('/api/datasets/', *filter_args).json()
         return [Dataset(d, self) for d in datasets]
 
+    def iterate_datasets(self, page_size=1000, **kwargs):
+        """ Yield all datasets that match search criteria, newest first.
+
+        Like find_datasets(), but loads them a page at a time.
+        :param int page_size: number of datasets to request at a time
+        :param kwargs: search parameters, with the same names as the keys
+            used by the API
+        :return: a generator of Dataset objects
+        """
+        filter_args = chain.from_iterable(kwargs.items())
+        for dataset in self.iterate('/api/datasets/',
+                                    *filter_args,
+                                    page_size=page_size):
+            yield Dataset(dataset, self)
+
+    def lookup_datasets(self, md5_checksums, batch_size=10000):
+        """ Find the ids of datasets that match a list of MD5 checksums.
+
+        Useful to skip uploading files that are already stored.
+        :param md5_checksums: a list of MD5 checksums in hex
+        :param int batch_size: number of checksums to send in each request
+        :return: {md5_checksum: [dataset_id]} with the newest datasets first,
+            and an empty list for checksums without any datasets
+        """
+        md5_checksums = list(md5_checksums)
+        matches = {}
+        for start in range(0, len(md5_checksums), batch_size):
+            batch = md5_checksums[start:start + batch_size]
+            response = self.post('/api/datasets/lookup/',
+                                 json=dict(md5_checksums=batch))
+            matches.update(response.json()['md5_checksums'])
+        return matches
+
     def add_dataset(self,
                     name,
                     description,
@@ -320,7 +386,10 @@ class KiveAPI(Session):
                     users=None,
                     groups=None,
                     externalfiledirectory=None,
-                    external_path=None):
+                    external_path=None,
+                    chunk_size=None,
+                    thread_count=1,
+                    max_retries=3):
         """ Adds a dataset to kive.
 
         :param str name: a name for the dataset
@@ -334,6 +403,11 @@ class KiveAPI(Session):
             or None for internal datasets
         :param str external_path: path relative to external file directory,
             or None for internal datasets
+        :param int chunk_size: if set, upload the contents in chunks of this
+            many bytes, so a failed chunk can be retried without starting
+            again. The handle must be opened in binary mode, and seekable.
+        :param int thread_count: number of chunks to send at once
+        :param int max_retries: number of times to retry each chunk
         :return: Dataset object
         """
         users_allowed = users or []
@@ -347,6 +421,18 @@ class KiveAPI(Session):
             'compounddatatype': cdt and cdt.cdt_id
         }
 
+        if not external_path and chunk_size is not None:
+            handle.seek(0, os.SEEK_END)
+            size = handle.tell()
+            file_name = os.path.basename(getattr(handle, 'name', '') or name)
+            upload = self.post('@api_dataset_uploads',
+                               json=dict(file_name=file_name, size=size)).json()
+            return self.resume_dataset_upload(upload['url'],
+                                              handle,
+                                              metadata_dict,
+                                              chunk_size,
+                                              thread_count,
+                                              max_retries)
         if not external_path:
             dataset = self.post(
                 '@api_dataset_add',
@@ -366,3 +452,68 @@ class KiveAPI(Session):
             ).json()
 
         return Dataset(dataset, self)
+
+    def resume_dataset_upload(self,
+                              upload_url,
+                              handle,
+                              metadata,
+                              chunk_size,
+                              thread_count=1,
+                              max_retries=3):
+        """ Send any chunks that the server hasn't received, then finish.
+
+        Use this to continue an upload that add_dataset() started, if it
+        failed. The upload's URL is logged when a chunk fails.
+        :param str upload_url: the upload's URL on the server
+        :param handle: an open, seekable, binary file object with the contents
+        :param dict metadata: the dataset's name, description, users_allowed,
+            and groups_allowed
+        :param int chunk_size: the number of bytes to send in each request
+        :param int thread_count: number of chunks to send at once
+        :param int max_retries: number of times to retry each chunk
+        :return: Dataset object
+        """
+        upload = self.get(upload_url).json()
+        size = upload['size']
+        received_ranges = upload['received_ranges']
+
+        def send_chunk(start, data):
+            end = start + len(data)
+            headers = {'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, size),
+                       'Content-Type': 'application/octet-stream'}
+            for attempt in range(max_retries + 1):
+                try:
+                    return self.put(upload_url, data=data, headers=headers)
+                except (KiveServerException,
+                        requests.ConnectionError,
+                        requests.Timeout):
+                    if attempt == max_retries:
+                        logger.error('Failed to send bytes %d-%d to %s.',
+                                     start,
+                                     end,
+                                     upload_url)
+                        raise
+                    logger.warning('Retrying bytes %d-%d to %s.',
+                                   start,
+                                   end,
+                                   upload_url,
+                                   exc_info=True)
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            pending = set()
+            for start in range(0, size, chunk_size):
+                end = min(start + chunk_size, size)
+                if any(old_start <= start and end <= old_end
+                       for old_start, old_end in received_ranges):
+                    continue
+                if len(pending) >= thread_count * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                handle.seek(start)
+                pending.add(executor.submit(send_chunk, start, handle.read(end - start)))
+            for future in pending:
+                future.result()
+
+        dataset = self.post(upload['finalize_url'], json=metadata).json()
+        return Dataset(dataset, self)
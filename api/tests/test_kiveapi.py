@@ -1,9 +1,9 @@
-from io import StringIO
+from io import StringIO, BytesIO
 
 import pytest
 from kiveapi import KiveAPI, KiveAuthException, KiveServerException, KiveMalformedDataException, KiveClientException
 # noinspection PyPackageRequirements
-from mock import patch, DEFAULT
+from mock import patch, DEFAULT, Mock
 # noinspection PyPackageRequirements
 from requests import Session
 
@@ -18,6 +18,7 @@ def mocked_api():
                         send=DEFAULT,
                         post=DEFAULT,
                         patch=DEFAULT,
+                        put=DEFAULT,
                         delete=DEFAULT,
                         head=DEFAULT):
         Session.head.return_value.status_code = 200
@@ -25,6 +26,7 @@ def mocked_api():
         Session.post.return_value.status_code = 200
         Session.delete.return_value.status_code = 200
         Session.patch.return_value.status_code = 200
+        Session.put.return_value.status_code = 200
         yield KiveAPI('http://localhost')
 
 
@@ -221,6 +223,106 @@ def test_find_datasets_filter(mocked_api):
         'filters[1][key]=user&filters[1][val]=joe')
 
 
+def test_iterate_datasets(mocked_api):
+    pages = [dict(next='http://localhost/api/datasets/?cursor=abc',
+                  results=[dict(id=43, name='b', filename='b.csv'),
+                           dict(id=42, name='a', filename='a.csv')]),
+             dict(next=None,
+                  results=[dict(id=41, name='c', filename='c.csv')])]
+    responses = [Mock(status_code=200, **{'json.return_value': page})
+                 for page in pages]
+    # noinspection PyUnresolvedReferences
+    Session.get.side_effect = responses
+
+    datasets = mocked_api.iterate_datasets(page_size=2, user='joe')
+
+    assert [dataset.name for dataset in datasets] == ['b', 'a', 'c']
+    # noinspection PyUnresolvedReferences
+    assert Session.get.call_args_list[0][0][0] == (
+        'http://localhost/api/datasets/?cursor=&page_size=2&'
+        'filters[0][key]=user&filters[0][val]=joe')
+    # noinspection PyUnresolvedReferences
+    assert Session.get.call_args_list[1][0][0] == (
+        'http://localhost/api/datasets/?cursor=abc')
+
+
+def test_lookup_datasets(mocked_api):
+    md5s = ['0' * 32, '1' * 32, '2' * 32]
+    pages = [{'md5_checksums': {md5s[0]: [42, 41], md5s[1]: []}},
+             {'md5_checksums': {md5s[2]: [43]}}]
+    # noinspection PyUnresolvedReferences
+    Session.post.side_effect = [
+        Mock(status_code=200, **{'json.return_value': page})
+        for page in pages]
+
+    matches = mocked_api.lookup_datasets(md5s, batch_size=2)
+
+    assert matches == {md5s[0]: [42, 41], md5s[1]: [], md5s[2]: [43]}
+    # noinspection PyUnresolvedReferences
+    assert Session.post.call_args_list[1][1]['json'] == dict(
+        md5_checksums=[md5s[2]])
+
+
+def test_add_dataset_chunked(mocked_api):
+    upload_url = 'http://localhost/api/datasets/uploads/7/'
+    finalize_url = upload_url + 'finalize/'
+    # noinspection PyUnresolvedReferences
+    Session.post.return_value.json.return_value = dict(url=upload_url,
+                                                       id=42,
+                                                       name='chunked',
+                                                       filename='chunked.txt')
+    # noinspection PyUnresolvedReferences
+    Session.get.return_value.json.return_value = dict(url=upload_url,
+                                                      finalize_url=finalize_url,
+                                                      size=10,
+                                                      received_ranges=[[0, 4]])
+    handle = BytesIO(b'0123456789')
+    handle.name = '/tmp/chunked.txt'
+
+    dataset = mocked_api.add_dataset('chunked',
+                                     'in chunks',
+                                     handle,
+                                     chunk_size=4)
+
+    assert dataset.name == 'chunked'
+    # noinspection PyUnresolvedReferences
+    assert Session.post.call_args_list[0][1]['json'] == dict(
+        file_name='chunked.txt',
+        size=10)
+    # noinspection PyUnresolvedReferences
+    put_calls = sorted((call[1]['headers']['Content-Range'], call[1]['data'])
+                       for call in Session.put.call_args_list)
+    # The first chunk was already received.
+    assert put_calls == [('bytes 4-7/10', b'4567'), ('bytes 8-9/10', b'89')]
+    # noinspection PyUnresolvedReferences
+    assert Session.post.call_args_list[1][0][0] == finalize_url
+
+
+def test_add_dataset_chunk_retry(mocked_api):
+    upload_url = 'http://localhost/api/datasets/uploads/7/'
+    # noinspection PyUnresolvedReferences
+    Session.get.return_value.json.return_value = dict(url=upload_url,
+                                                      finalize_url=upload_url + 'finalize/',
+                                                      size=3,
+                                                      received_ranges=[])
+    # noinspection PyUnresolvedReferences
+    Session.post.return_value.json.return_value = dict(id=42,
+                                                       name='retried',
+                                                       filename='retried.txt')
+    failed_response = Mock(status_code=502, ok=False)
+    # noinspection PyUnresolvedReferences
+    Session.put.side_effect = [failed_response, Session.put.return_value]
+
+    dataset = mocked_api.resume_dataset_upload(upload_url,
+                                               BytesIO(b'abc'),
+                                               dict(name='retried'),
+                                               chunk_size=10)
+
+    assert dataset.name == 'retried'
+    # noinspection PyUnresolvedReferences
+    assert Session.put.call_count == 2
+
+
 def test_dataset_download(mocked_api):
     dataset = Dataset(dict(id=42, filename='data.csv', name='my dataset'),
                       mocked_api)
@@ -18,15 +18,18 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
 from container.models import ContainerFamily, Container, ContainerApp, \
-    ContainerRun, Batch, ContainerArgument, ContainerDataset, ContainerLog, ExistingRunsError
+    ContainerRun, Batch, ContainerArgument, ContainerDataset, ContainerLog, ExistingRunsError, \
+    SlurmPoll
 from container.serializers import ContainerFamilySerializer, \
     ContainerSerializer, ContainerAppSerializer, \
     ContainerFamilyChoiceSerializer, ContainerRunSerializer, BatchSerializer, \
-    ContainerArgumentSerializer, ContainerDatasetSerializer, ContainerLogSerializer
+    ContainerArgumentSerializer, ContainerDatasetSerializer, ContainerLogSerializer, \
+    ContainerRunPhaseSerializer
 from file_access_utils import use_field_file, build_download_response
 from kive.ajax import CleanCreateModelMixin, RemovableModelViewSet, \
     SearchableModelMixin, IsDeveloperOrGrantedReadOnly, StandardPagination, \
-    IsGrantedReadCreate, GrantedModelMixin, IsGrantedReadOnly
+    IsGrantedReadCreate, GrantedModelMixin, IsGrantedReadOnly, \
+    FieldSelectionModelMixin
 from metadata.models import AccessControl
 from portal.views import admin_check
 
@@ -38,7 +41,8 @@ def parse_date_filter(text):
                                timezone.get_current_timezone())
 
 
-class ContainerFamilyViewSet(CleanCreateModelMixin,
+class ContainerFamilyViewSet(FieldSelectionModelMixin,
+                             CleanCreateModelMixin,
                              RemovableModelViewSet,
                              SearchableModelMixin):
     """ A container family is a set of Singularity containers that are all
@@ -67,6 +71,9 @@ class ContainerFamilyViewSet(CleanCreateModelMixin,
     queryset = ContainerFamily.objects.annotate(
         num_containers=Count('containers'))
     serializer_class = ContainerFamilySerializer
+    select_related_fields = dict(user=['user'])
+    prefetch_related_fields = dict(users_allowed=['users_allowed'],
+                                   groups_allowed=['groups_allowed'])
     permission_classes = (permissions.IsAuthenticated, IsDeveloperOrGrantedReadOnly)
     pagination_class = StandardPagination
     filters = dict(
@@ -168,7 +175,8 @@ class ContainerJSONParser(JSONParser):
     renderer_class = ContainerRenderer
 
 
-class ContainerViewSet(CleanCreateModelMixin,
+class ContainerViewSet(FieldSelectionModelMixin,
+                       CleanCreateModelMixin,
                        RemovableModelViewSet,
                        SearchableModelMixin):
     """ A Singularity container.
@@ -208,6 +216,9 @@ class ContainerViewSet(CleanCreateModelMixin,
     queryset = Container.objects.order_by('family__name', '-created').annotate(
         num_apps=Count('apps'))
     serializer_class = ContainerSerializer
+    select_related_fields = dict(family_name=['family'], user=['user'])
+    prefetch_related_fields = dict(users_allowed=['users_allowed'],
+                                   groups_allowed=['groups_allowed'])
     permission_classes = (permissions.IsAuthenticated, IsDeveloperOrGrantedReadOnly)
     pagination_class = StandardPagination
     parser_classes = [ContainerJSONParser, FormParser, MultiPartParser]
@@ -228,7 +239,7 @@ class ContainerViewSet(CleanCreateModelMixin,
     @action(detail=True)
     def download(self, request, pk=None):
         container = self.get_object()
-        return build_download_response(container.file)
+        return build_download_response(container.file, request)
 
     # noinspection PyUnusedLocal
     @action(detail=True, suffix='Apps')
@@ -285,7 +296,8 @@ class ContainerViewSet(CleanCreateModelMixin,
         return Response(response_data, status_code)
 
 
-class ContainerAppViewSet(CleanCreateModelMixin,
+class ContainerAppViewSet(FieldSelectionModelMixin,
+                          CleanCreateModelMixin,
                           RemovableModelViewSet,
                           SearchableModelMixin):
     """ An app within a Singularity container.
@@ -310,6 +322,7 @@ class ContainerAppViewSet(CleanCreateModelMixin,
     """
     queryset = ContainerApp.objects.all()
     serializer_class = ContainerAppSerializer
+    select_related_fields = dict(container_name=['container__family'])
     permission_classes = (permissions.IsAuthenticated, IsDeveloperOrGrantedReadOnly)
     pagination_class = StandardPagination
     filters = dict(
@@ -337,6 +350,12 @@ class ContainerAppViewSet(CleanCreateModelMixin,
                                                     context=dict(request=request),
                                                     many=True).data)
 
+    # noinspection PyUnusedLocal
+    @action(detail=True, suffix='Resource Stats')
+    def resource_stats(self, request, pk=None):
+        """ Percentiles of resources used by recent completed runs. """
+        return Response(self.get_object().get_resource_stats())
+
 
 class ContainerArgumentViewSet(ReadOnlyModelViewSet,
                                CleanCreateModelMixin,
@@ -371,7 +390,8 @@ class ContainerArgumentViewSet(ReadOnlyModelViewSet,
         return queryset.filter(app__container_id__in=granted_containers)
 
 
-class BatchViewSet(CleanCreateModelMixin,
+class BatchViewSet(FieldSelectionModelMixin,
+                   CleanCreateModelMixin,
                    RemovableModelViewSet,
                    SearchableModelMixin):
     """ A batch of container runs.
@@ -394,6 +414,9 @@ class BatchViewSet(CleanCreateModelMixin,
     """
     queryset = Batch.objects.all()
     serializer_class = BatchSerializer
+    select_related_fields = dict(user=['user'])
+    prefetch_related_fields = dict(users_allowed=['users_allowed'],
+                                   groups_allowed=['groups_allowed'])
     permission_classes = (permissions.IsAuthenticated, IsGrantedReadCreate)
     pagination_class = StandardPagination
     filters = dict(
@@ -449,7 +472,8 @@ class ContainerRunJSONParser(JSONParser):
     renderer_class = ContainerRunRenderer
 
 
-class ContainerRunViewSet(CleanCreateModelMixin,
+class ContainerRunViewSet(FieldSelectionModelMixin,
+                          CleanCreateModelMixin,
                           RemovableModelViewSet,
                           SearchableModelMixin):
     """ A container run is a running Singularity container app.
@@ -493,6 +517,12 @@ class ContainerRunViewSet(CleanCreateModelMixin,
     * filters[n][key]=states&filters[n][val]=match - runs with a state in the
         list of states. For example CFX would match complete, failed, and
         cancelled runs.
+    * page_size=n - limit the results and page through them
+    * cursor= - page through the list, newest first, by following the next
+        links, without counting the list. Add count=approximate for an
+        estimated count.
+    * fields=a,b,c - only include the listed fields in each run.
+    * omit=a,b,c - leave the listed fields out of each run.
 
     Parameter for a PATCH:
 
@@ -503,6 +533,16 @@ class ContainerRunViewSet(CleanCreateModelMixin,
     """
     queryset = ContainerRun.objects.all()
     serializer_class = ContainerRunSerializer
+    cursor_ordering = ('-submit_time', '-id')
+    select_related_fields = dict(
+        app_name=['app__container__family'],
+        batch_name=['batch'],
+        batch_absolute_url=['batch'],
+        has_changed=['original_run'],
+        stopped_by=['stopped_by'],
+        user=['user'])
+    prefetch_related_fields = dict(users_allowed=['users_allowed'],
+                                   groups_allowed=['groups_allowed'])
     permission_classes = (permissions.IsAuthenticated, ContainerRunPermission)
     pagination_class = StandardPagination
     parser_classes = [ContainerRunJSONParser, FormParser, MultiPartParser]
@@ -558,14 +598,30 @@ class ContainerRunViewSet(CleanCreateModelMixin,
                                                context=dict(request=request),
                                                many=True).data)
 
+    # noinspection PyUnusedLocal
+    @action(detail=True, suffix='Phases')
+    def phase_list(self, request, pk=None):
+        """ Timing and resource usage for each phase of the run. """
+        phases = self.get_object().phases.all()
+        return Response(ContainerRunPhaseSerializer(phases,
+                                                    context=dict(request=request),
+                                                    many=True).data)
+
+    @staticmethod
+    def add_poll_time(response):
+        """ Report when the Slurm states were last checked. """
+        poll_time = SlurmPoll.get_poll_time()
+        if poll_time is not None:
+            response['X-Kive-Slurm-Poll-Time'] = poll_time.isoformat()
+        return response
+
     def retrieve(self, request, *args, **kwargs):
-        pk = kwargs.get('pk')
-        ContainerRun.check_slurm_state(pk)
-        return super(ContainerRunViewSet, self).retrieve(request, *args, **kwargs)
+        response = super(ContainerRunViewSet, self).retrieve(request, *args, **kwargs)
+        return self.add_poll_time(response)
 
     def list(self, request, *args, **kwargs):
-        ContainerRun.check_slurm_state()
-        return super(ContainerRunViewSet, self).list(request, *args, **kwargs)
+        response = super(ContainerRunViewSet, self).list(request, *args, **kwargs)
+        return self.add_poll_time(response)
 
     # noinspection PyUnusedLocal
     def patch_object(self, request, pk=None):
@@ -624,6 +680,11 @@ class ContainerLogViewSet(GrantedModelMixin, ReadOnlyModelViewSet):
         type_names = dict(ContainerLog.TYPES)
         type_name = type_names[log.type]
         file_name = 'run_{}_{}.txt'.format(log.run_id, type_name)
+        if log.long_text:
+            return build_download_response(log.long_text,
+                                           request,
+                                           file_name,
+                                           content_type='text/plain')
         with self.read_content(log) as (content, size):
             response = HttpResponse(content, content_type='text/plain')
             response['Content-Length'] = size
@@ -0,0 +1,351 @@
+""" Executors launch container runs, either through Slurm or locally.
+
+Choose one with the KIVE_EXECUTOR setting. Each executor can submit a run,
+cancel it, and check that active runs haven't died without updating Kive.
+"""
+
+import logging
+import os
+import signal
+import sys
+from pathlib import Path
+from subprocess import Popen, check_call
+
+from django.conf import settings
+from django.db.models.functions import Now
+
+from container.models import ContainerRun, ContainerLog, multi_check_output, \
+    MANAGE_PY_FULLPATH
+
+logger = logging.getLogger(__name__)
+
+
+def build_child_environment():
+    """ Environment variables for the runcontainer child process. """
+    child_env = dict(os.environ)
+    extra_path = settings.SLURM_PATH
+    if extra_path is not None:
+        old_system_path = child_env['PATH']
+        system_path = extra_path + os.pathsep + old_system_path
+        child_env['PATH'] = system_path
+    child_env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    child_env.pop('KIVE_LOG', None)
+    return child_env
+
+
+class Executor:
+    """ Interface for launching container runs. """
+    name = None
+    can_submit_arrays = False
+
+    def submit(self, run, dependency_runs=()):
+        """ Launch a run that already has a sandbox.
+
+        :param ContainerRun run: the run to launch
+        :param dependency_runs: runs that must complete before this one
+            starts
+        """
+        raise NotImplementedError()
+
+    def submit_array(self, runs):
+        """ Launch a list of similar runs as one job. """
+        raise NotImplementedError()
+
+    def cancel(self, run):
+        """ Stop a run that has already started. """
+        raise NotImplementedError()
+
+    def check_states(self):
+        """ Fail any active runs that have died without updating Kive. """
+        raise NotImplementedError()
+
+
+class SlurmExecutor(Executor):
+    """ Submits runs to Slurm with sbatch. """
+    name = 'slurm'
+    can_submit_arrays = True
+
+    def submit(self, run, dependency_runs=()):
+        dependency_job_ids = [dependency_run.slurm_job_key
+                              for dependency_run in dependency_runs]
+        output = multi_check_output(run.build_slurm_command(settings.SLURM_QUEUES,
+                                                            dependency_job_ids),
+                                    env=build_child_environment())
+
+        run.slurm_job_id = int(output)
+        # It's just possible the slurm job has already started modifying the
+        # run, so only update the Slurm fields.
+        run.save(update_fields=['slurm_job_id',
+                                'requested_threads',
+                                'requested_memory',
+                                'requested_minutes'])
+
+    def submit_array(self, runs):
+        max_size = settings.SLURM_ARRAY_MAX_SIZE
+        child_env = build_child_environment()
+        for chunk_start in range(0, len(runs), max_size):
+            chunk = runs[chunk_start:chunk_start + max_size]
+            try:
+                output = multi_check_output(
+                    ContainerRun.build_slurm_array_command(
+                        chunk,
+                        settings.SLURM_QUEUES),
+                    env=child_env)
+            except Exception:
+                # Fail this chunk and all the later ones, because they
+                # were claimed with sandboxes, so schedule() won't retry them.
+                unsubmitted_runs = runs[chunk_start:]
+                ContainerRun.objects.filter(
+                    pk__in=[run.pk for run in unsubmitted_runs]).update(
+                    state=ContainerRun.FAILED,
+                    end_time=Now())
+                for run in unsubmitted_runs:
+                    run.state = ContainerRun.FAILED
+                raise
+            array_job_id = int(output)
+            first_run = chunk[0]
+            # Tasks may have started, so only update the Slurm fields.
+            ContainerRun.objects.filter(
+                pk__in=[run.pk for run in chunk]).update(
+                slurm_job_id=array_job_id,
+                requested_threads=first_run.requested_threads,
+                requested_memory=first_run.requested_memory,
+                requested_minutes=first_run.requested_minutes)
+            for run in chunk:
+                run.slurm_job_id = array_job_id
+
+    def cancel(self, run):
+        check_call(['scancel', '-f', run.slurm_job_key])
+
+    def check_states(self):
+        ContainerRun.check_slurm_state()
+
+
+class LocalExecutor(Executor):
+    """ Runs containers as child processes of one dispatcher on this host.
+
+    Any process can submit a run, because that just marks it as queued in its
+    sandbox. The run_local command must run as a single service that calls
+    dispatch(), which reads the queued runs from the database and only starts
+    a run when its app's threads and memory fit in what the active local runs
+    have left of the limits. Lower-priority runs can start ahead of a large
+    run that doesn't fit yet, but a run larger than the whole pool still
+    starts when nothing else is running. Each child gets its own process
+    group, so it survives a restart of the dispatcher, and cancelling it also
+    stops its containers.
+    """
+    name = 'local'
+    PID_FILE_NAME = 'local.pid'
+    QUEUE_FILE_NAME = 'local_queue.txt'
+    POLL_SECONDS = 1
+
+    def __init__(self, max_threads=None, max_memory=None):
+        """ Initialize.
+
+        :param max_threads: total threads for all children, defaults to
+            LOCAL_EXECUTOR_THREADS
+        :param max_memory: total megabytes for all children, defaults to
+            LOCAL_EXECUTOR_MEMORY, and zero means no limit
+        """
+        if max_threads is None:
+            max_threads = settings.LOCAL_EXECUTOR_THREADS or os.cpu_count()
+        if max_memory is None:
+            max_memory = settings.LOCAL_EXECUTOR_MEMORY
+        self.max_threads = max_threads
+        self.max_memory = max_memory
+        self.children = {}  # {run_id: Popen} started by this dispatcher
+
+    def get_app_memory(self, app):
+        if not self.max_memory:
+            return 0
+        # Zero memory means the app needs all of it.
+        return app.memory or self.max_memory
+
+    def build_command(self, run_id):
+        return [sys.executable, MANAGE_PY_FULLPATH, 'runcontainer', str(run_id)]
+
+    @staticmethod
+    def get_logs_path(run):
+        return Path(run.full_sandbox_path) / 'logs'
+
+    def submit(self, run, dependency_runs=()):
+        logs_path = self.get_logs_path(run)
+        queue_path = logs_path / self.QUEUE_FILE_NAME
+        temp_path = logs_path / (self.QUEUE_FILE_NAME + '.tmp')
+        temp_path.write_text(' '.join(str(dependency_run.pk)
+                                      for dependency_run in dependency_runs))
+        # Rename, so the dispatcher never reads a partial list.
+        temp_path.replace(queue_path)
+
+    def submit_array(self, runs):
+        for run in runs:
+            self.submit(run)
+
+    def find_local_runs(self):
+        """ Find active runs that were submitted to this executor.
+
+        :return: [(run, pid)] in launch order, where pid is None if the run
+            is still waiting to start.
+        """
+        local_runs = []
+        active_runs = ContainerRun.objects.filter(
+            state__in=ContainerRun.ACTIVE_STATES).exclude(
+            sandbox_path='').select_related('app').order_by('-priority', 'id')
+        for run in active_runs:
+            logs_path = self.get_logs_path(run)
+            pid = self.read_pid(run)
+            if pid is not None:
+                local_runs.append((run, pid))
+            elif (run.state == ContainerRun.NEW and
+                  (logs_path / self.QUEUE_FILE_NAME).exists()):
+                local_runs.append((run, None))
+        return local_runs
+
+    def dispatch(self):
+        """ Collect finished children, then start any runs that fit. """
+        self.collect_finished()
+        used_threads = used_memory = running_count = 0
+        waiting_runs = []
+        for run, pid in self.find_local_runs():
+            if pid is None:
+                waiting_runs.append(run)
+                continue
+            if run.pk not in self.children and not self.is_alive(pid):
+                self.fail(run.pk, 'Local process is no longer running.')
+                continue
+            used_threads += run.app.threads
+            used_memory += self.get_app_memory(run.app)
+            running_count += 1
+        for run in waiting_runs:
+            dependency_state = self.check_dependencies(run)
+            if dependency_state is None:
+                continue
+            if not dependency_state:
+                self.fail(run.pk,
+                          'A run that this run depends on did not complete.')
+                continue
+            app_memory = self.get_app_memory(run.app)
+            is_fit = (
+                used_threads + run.app.threads <= self.max_threads and
+                (not self.max_memory or
+                 used_memory + app_memory <= self.max_memory))
+            if not (is_fit or running_count == 0):
+                continue
+            self.launch(run)
+            used_threads += run.app.threads
+            used_memory += app_memory
+            running_count += 1
+
+    def check_dependencies(self, run):
+        """ Check whether a run's dependencies have finished.
+
+        :return: True if they all completed, False if any of them failed or
+            were cancelled, or None if some are still active.
+        """
+        queue_path = self.get_logs_path(run) / self.QUEUE_FILE_NAME
+        dependency_ids = [int(text) for text in queue_path.read_text().split()]
+        if not dependency_ids:
+            return True
+        states = set(ContainerRun.objects.filter(
+            pk__in=dependency_ids).values_list('state', flat=True))
+        if states - {ContainerRun.COMPLETE} - set(ContainerRun.ACTIVE_STATES):
+            return False
+        if states & set(ContainerRun.ACTIVE_STATES):
+            return None
+        return True
+
+    def launch(self, run):
+        logs_path = self.get_logs_path(run)
+        with (logs_path / 'local_stdout.txt').open('wb') as stdout, \
+                (logs_path / 'local_stderr.txt').open('wb') as stderr:
+            process = Popen(self.build_command(run.pk),
+                            stdout=stdout,
+                            stderr=stderr,
+                            env=build_child_environment(),
+                            start_new_session=True)
+        (logs_path / self.PID_FILE_NAME).write_text(str(process.pid))
+        self.children[run.pk] = process
+
+    def collect_finished(self):
+        finished_ids = [run_id
+                        for run_id, process in self.children.items()
+                        if process.poll() is not None]
+        for run_id in finished_ids:
+            process = self.children.pop(run_id)
+            if process.returncode != 0:
+                self.fail(run_id,
+                          'Local process exited with code {}.'.format(
+                              process.returncode))
+
+    def read_pid(self, run):
+        pid_path = self.get_logs_path(run) / self.PID_FILE_NAME
+        try:
+            return int(pid_path.read_text())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # Exists, but belongs to someone else.
+        return True
+
+    @staticmethod
+    def fail(run_id, reason):
+        """ Mark a run as failed, unless it already finished. """
+        run = ContainerRun.objects.filter(
+            pk=run_id,
+            state__in=ContainerRun.ACTIVE_STATES).first()
+        if run is None:
+            return
+        logger.error('Run id %d failed: %s', run_id, reason)
+        run.state = ContainerRun.FAILED
+        run.end_time = Now()
+        run.save()
+        stderr_path = Path(run.full_sandbox_path) / 'logs' / 'local_stderr.txt'
+        if stderr_path.exists():
+            run.load_log(stderr_path, ContainerLog.STDERR)
+
+    def cancel(self, run):
+        pid = self.read_pid(run)
+        if pid is None:
+            return  # Never started.
+        try:
+            # The child leads its own process group, so stop the containers too.
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def check_states(self):
+        """ Fail local runs whose processes died.
+
+        Only the dispatcher starts runs, so this doesn't launch anything.
+        """
+        for run, pid in self.find_local_runs():
+            if (pid is not None and
+                    run.pk not in self.children and
+                    not self.is_alive(pid)):
+                self.fail(run.pk, 'Local process is no longer running.')
+
+
+EXECUTOR_CLASSES = {executor_class.name: executor_class
+                    for executor_class in (SlurmExecutor, LocalExecutor)}
+executors = {}
+
+
+def get_executor(name=None):
+    """ Get the shared executor with a name, or the one from settings. """
+    if name is None:
+        name = settings.EXECUTOR
+    executor = executors.get(name)
+    if executor is None:
+        try:
+            executor_class = EXECUTOR_CLASSES[name]
+        except KeyError:
+            raise ValueError('Unknown executor: {!r}.'.format(name))
+        executor = executors[name] = executor_class()
+    return executor
@@ -15,7 +15,7 @@ logger = logging.getLogger(__name__)
 class BatchForm(PermissionsForm):
     class Meta:
         model = Batch
-        fields = ['name', 'description', 'permissions']
+        fields = ['name', 'description', 'reuse_results', 'permissions']
         widgets = dict(description=forms.Textarea(attrs=dict(cols=50, rows=10)))
 
 
@@ -0,0 +1,40 @@
+import logging
+from argparse import ArgumentDefaultsHelpFormatter
+from datetime import timedelta
+from time import sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from container.models import SlurmPoll
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Check the Slurm state of all active runs on a regular interval.'
+
+    def add_arguments(self, parser):
+        parser.formatter_class = ArgumentDefaultsHelpFormatter
+
+        parser.add_argument('--interval',
+                            help='Seconds between checks',
+                            default=settings.SLURM_POLL_INTERVAL,
+                            type=int)
+        parser.add_argument('--once',
+                            action='store_true',
+                            help='Check once, then exit.')
+
+    def handle(self, interval, once=False, **kwargs):
+        # Check a little early, so web requests don't beat us to it.
+        max_age = timedelta(seconds=interval * 0.9)
+        while True:
+            try:
+                SlurmPoll.refresh(max_age)
+            except Exception:
+                if once:
+                    raise
+                logger.error('Slurm poll failed.', exc_info=True)
+            if once:
+                break
+            sleep(interval)
@@ -4,13 +4,15 @@ import os
 import shutil
 from argparse import ArgumentDefaultsHelpFormatter
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from itertools import chain
+from time import perf_counter
 
 from django.contrib.humanize.templatetags.humanize import naturaltime
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import ExpressionWrapper, FloatField, DurationField
 from django.db.models.expressions import Value, F
 from django.db.models.fields.files import FieldFile
@@ -20,13 +22,14 @@ from django.template.defaultfilters import filesizeformat, pluralize
 from django.utils import timezone
 from django.utils.dateparse import parse_duration
 
-from container.models import ContainerRun, ContainerLog, Container
-from librarian.models import Dataset
-from portal.models import parse_file_size
+from container.models import ContainerRun, ContainerLog, Container, ChecksumCache
+from file_access_utils import ScanManifest
+from librarian.models import Dataset, DatasetUpload, DatasetContent
+from portal.models import parse_file_size, StorageLedger, StorageSnapshot
 
 # error - summary of unregistered files, can't meet purge target, or can't purge
 # warning - list each unregistered file
-# info - summary of regular purge
+# info - summary of regular purge, scan rate of synchronization
 # debug - list each purged file, summary even when nothing purged
 logger = logging.getLogger(__name__)
 
@@ -35,6 +38,12 @@ class Command(BaseCommand):
     help = 'Scan through storage files, recording the size of new files, ' \
            'and purging old files if needed.'
 
+    # Relative to MEDIA_ROOT, records the folders that were already synched.
+    MANIFEST_PATH = os.path.join('PurgeManifests', 'synch.json')
+    # Synch adjusts its batch size so each query takes about this many seconds.
+    SYNCH_QUERY_SECONDS = 0.2
+    MAX_SYNCH_BATCH_SIZE = 10000
+
     def add_arguments(self, parser):
         parser.formatter_class = ArgumentDefaultsHelpFormatter
 
@@ -67,13 +76,28 @@ class Command(BaseCommand):
                                  "files that don't have a matching entry in "
                                  "the database. Skips the regular purging.",
                             action="store_true")
+        parser.add_argument("--plan",
+                            help="Record new file sizes, then print what "
+                                 "would be purged without purging it.",
+                            action="store_true")
         parser.add_argument("--wait",
                             help="How long to wait before purging "
                                  "unsynchronized files.",
                             default=settings.PURGE_WAIT,
                             type=parse_duration)
+        parser.add_argument("--threads",
+                            help="Number of folders to scan at once while "
+                                 "recording new file sizes.",
+                            default=settings.PURGE_THREADS,
+                            type=int)
+        parser.add_argument("--rescan",
+                            help="How long before synch rescans folders that "
+                                 "haven't changed.",
+                            default=settings.PURGE_RESCAN,
+                            type=parse_duration)
         parser.add_argument("--batch_size",
-                            help="Number of files to check at a time.",
+                            help="Number of files to check at a time. Synch "
+                                 "adjusts it to keep queries quick.",
                             default=settings.PURGE_BATCH_SIZE,
                             type=int)
 
@@ -86,16 +110,29 @@ class Command(BaseCommand):
                synch=False,
                wait=timedelta(seconds=0),
                batch_size=100,
+               rescan=None,
+               threads=4,
+               plan=False,
                **kwargs):
         # noinspection PyBroadException
         try:
             if synch:
                 logger.debug('Starting purge synchronization.')
-                self.synch_model(Container, 'file', wait, batch_size)
-                self.synch_model(ContainerRun, 'sandbox_path', wait, batch_size)
-                self.synch_model(ContainerLog, 'long_text', wait, batch_size)
-                self.synch_model(Dataset, 'dataset_file', wait, batch_size)
+                manifest = ScanManifest(
+                    os.path.join(settings.MEDIA_ROOT, self.MANIFEST_PATH),
+                    rescan_age=None if rescan is None else rescan.total_seconds())
+                self.synch_model(Container, 'file', wait, batch_size, manifest)
+                self.synch_model(ContainerRun, 'sandbox_path', wait, batch_size, manifest)
+                self.synch_model(ContainerLog, 'long_text', wait, batch_size, manifest)
+                self.synch_model(Dataset, 'dataset_file', wait, batch_size, manifest)
+                manifest.save()
                 Dataset.external_file_check(batch_size=batch_size)
+                DatasetUpload.remove_stale(
+                    parse_duration(settings.DATASET_UPLOAD_MAX_AGE))
+                ChecksumCache.remove_stale(batch_size)
+                DatasetContent.recount()
+                StorageLedger.reconcile()
+                StorageSnapshot.record()
                 logger.debug('Finished purge synchronization.')
             else:
                 self.purge(start,
@@ -103,7 +140,11 @@ class Command(BaseCommand):
                            dataset_aging,
                            log_aging,
                            sandbox_aging,
-                           batch_size)
+                           batch_size,
+                           threads,
+                           plan)
+                if not plan:
+                    StorageSnapshot.record()
         except Exception:
             logger.error('Purge failed.', exc_info=True)
 
@@ -113,25 +154,46 @@ class Command(BaseCommand):
               dataset_aging,
               log_aging,
               sandbox_aging,
-              batch_size):
+              batch_size,
+              threads=1,
+              plan=False):
         logger.debug('Starting purge.')
-        container_total = self.set_file_sizes(Container,
-                                              'file',
-                                              'file_size',
-                                              'created')
-        sandbox_total = self.set_file_sizes(ContainerRun,
-                                            'sandbox_path',
-                                            'sandbox_size',
-                                            'end_time')
-        log_total = self.set_file_sizes(ContainerLog,
-                                        'long_text',
-                                        'log_size',
-                                        'run__end_time')
-        dataset_total = self.set_file_sizes(Dataset,
-                                            'dataset_file',
-                                            'dataset_size',
-                                            'date_created')
+        with ThreadPoolExecutor(threads) as executor:
+            self.set_file_sizes(Container,
+                                'file',
+                                'file_size',
+                                'created',
+                                executor,
+                                batch_size)
+            self.set_file_sizes(ContainerRun,
+                                'sandbox_path',
+                                'sandbox_size',
+                                'end_time',
+                                executor,
+                                batch_size)
+            self.set_file_sizes(ContainerLog,
+                                'long_text',
+                                'log_size',
+                                'run__end_time',
+                                executor,
+                                batch_size)
+            self.set_file_sizes(Dataset,
+                                'dataset_file',
+                                'dataset_size',
+                                'date_created',
+                                executor,
+                                batch_size)
 
+        if not StorageLedger.objects.filter(
+                user=None,
+                reconcile_time__isnull=False).exists():
+            # Never reconciled, so start the ledger from the records.
+            StorageLedger.reconcile()
+        totals = StorageLedger.get_totals()
+        container_total = totals[StorageLedger.CONTAINERS]
+        sandbox_total = totals[StorageLedger.SANDBOXES]
+        log_total = totals[StorageLedger.LOGS]
+        dataset_total = totals[StorageLedger.DATASETS]
         total_storage = remaining_storage = (
                 container_total + sandbox_total + log_total + dataset_total)
         if total_storage <= start:
@@ -139,93 +201,42 @@ class Command(BaseCommand):
                                                   dataset_total,
                                                   sandbox_total,
                                                   log_total)
+            if plan:
+                self.stdout.write('No purge needed for {}: {}.'.format(
+                    filesizeformat(total_storage),
+                    storage_text))
             logger.debug(u"No purge needed for %s: %s.",
                          filesizeformat(total_storage),
                          storage_text)
             return
 
-        sandbox_ages = ContainerRun.find_unneeded().annotate(
-            entry_type=Value('r', models.CharField()),
-            age=ExpressionWrapper(sandbox_aging * (Now() - F('end_time')),
-                                  output_field=DurationField())).values_list(
-            'entry_type',
-            'id',
-            'age').order_by()
-
-        log_ages = ContainerLog.find_unneeded().annotate(
-            entry_type=Value('l', models.CharField()),
-            age=ExpressionWrapper(log_aging * (Now() - F('run__end_time')),
-                                  output_field=DurationField())).values_list(
-            'entry_type',
-            'id',
-            'age').order_by()
-
-        dataset_ages = Dataset.find_unneeded().annotate(
-            entry_type=Value('d', models.CharField()),
-            age=ExpressionWrapper(dataset_aging * (Now() - F('date_created')),
-                                  output_field=FloatField())).values_list(
-            'entry_type',
-            'id',
-            'age').order_by()
-
+        planned_entries = self.plan_purge(total_storage - stop,
+                                          dataset_aging,
+                                          log_aging,
+                                          sandbox_aging)
         purge_counts = Counter()
         max_purge_dates = {}
         min_purge_dates = {}
-        purge_entries = sandbox_ages.union(log_ages,
-                                           dataset_ages,
-                                           all=True).order_by('-age')
-        while remaining_storage > stop:
-            entry_count = 0
-            for entry_type, entry_id, age in purge_entries[:batch_size]:
-                entry_count += 1
-                if entry_type == 'r':
-                    run = ContainerRun.objects.get(id=entry_id)
-                    entry_size = run.sandbox_size
-                    entry_date = run.end_time
-                    logger.debug("Purged container run %d containing %s.",
-                                 run.pk,
-                                 filesizeformat(entry_size))
-                    try:
-                        run.delete_sandbox()
-                    except OSError:
-                        logger.error(u"Failed to purge container run %d at %r.",
-                                     run.id,
-                                     run.sandbox_path,
-                                     exc_info=True)
-                        run.sandbox_path = ''
-                    run.save()
-                elif entry_type == 'l':
-                    log = ContainerLog.objects.get(id=entry_id)
-                    entry_size = log.log_size
-                    entry_date = log.run.end_time
-                    logger.debug("Purged container log %d containing %s.",
-                                 log.id,
-                                 filesizeformat(entry_size))
-                    log.long_text.delete()
-                else:
-                    assert entry_type == 'd'
-                    dataset = Dataset.objects.get(id=entry_id)
-                    entry_size = dataset.dataset_size
-                    dataset_total -= dataset.dataset_size
-                    entry_date = dataset.date_created
-                    logger.debug("Purged dataset %d containing %s.",
-                                 dataset.pk,
-                                 filesizeformat(entry_size))
-                    dataset.dataset_file.delete()
-                purge_counts[entry_type] += 1
-                purge_counts[entry_type + ' bytes'] += entry_size
-                # PyCharm false positives...
-                # noinspection PyUnresolvedReferences
-                min_purge_dates[entry_type] = min(entry_date,
-                                                  min_purge_dates.get(entry_type, entry_date))
-                # noinspection PyUnresolvedReferences
-                max_purge_dates[entry_type] = max(entry_date,
-                                                  max_purge_dates.get(entry_type, entry_date))
-                remaining_storage -= entry_size
-                if remaining_storage <= stop:
-                    break
-            if entry_count == 0:
-                break
+        with ThreadPoolExecutor(threads) as executor:
+            for batch_start in range(0, len(planned_entries), batch_size):
+                batch = planned_entries[batch_start:batch_start + batch_size]
+                entry_dates = self.purge_batch(batch, executor, plan)
+                for entry_type, entry_id, entry_size in batch:
+                    entry_date = entry_dates.get((entry_type, entry_id))
+                    if entry_date is None:
+                        continue  # Changed since the plan.
+                    if entry_type == 'd':
+                        dataset_total -= entry_size
+                    purge_counts[entry_type] += 1
+                    purge_counts[entry_type + ' bytes'] += entry_size
+                    # PyCharm false positives...
+                    # noinspection PyUnresolvedReferences
+                    min_purge_dates[entry_type] = min(entry_date,
+                                                      min_purge_dates.get(entry_type, entry_date))
+                    # noinspection PyUnresolvedReferences
+                    max_purge_dates[entry_type] = max(entry_date,
+                                                      max_purge_dates.get(entry_type, entry_date))
+                    remaining_storage -= entry_size
         for entry_type, entry_name in (('r', 'container run'),
                                        ('l', 'container log'),
                                        ('d', 'dataset')):
@@ -241,57 +252,228 @@ class Command(BaseCommand):
             date_range = (start_text
                           if start_text == end_text
                           else start_text + ' to ' + end_text)
-            logger.info("Purged %d %s containing %s from %s.",
-                        purged_count,
-                        collective,
-                        filesizeformat(bytes_removed),
-                        date_range)
+            if plan:
+                self.stdout.write('Would purge {} {} containing {} from {}.'.format(
+                    purged_count,
+                    collective,
+                    filesizeformat(bytes_removed),
+                    date_range))
+            else:
+                logger.info("Purged %d %s containing %s from %s.",
+                            purged_count,
+                            collective,
+                            filesizeformat(bytes_removed),
+                            date_range)
+        if plan:
+            self.stdout.write('Storage would go from {} to {}.'.format(
+                filesizeformat(total_storage),
+                filesizeformat(remaining_storage)))
         if remaining_storage > stop:
             storage_text = self.summarize_storage(container_total,
                                                   dataset_total)
-            logger.error('Cannot reduce storage to %s: %s.',
-                         filesizeformat(stop),
-                         storage_text)
+            if plan:
+                self.stdout.write('Cannot reduce storage to {}: {}.'.format(
+                    filesizeformat(stop),
+                    storage_text))
+            else:
+                logger.error('Cannot reduce storage to %s: %s.',
+                             filesizeformat(stop),
+                             storage_text)
 
-    def set_file_sizes(self, model, file_field, size_field, date_field):
+    def plan_purge(self, target_size, dataset_aging, log_aging, sandbox_aging):
+        """ Choose the oldest entries that add up to the target size.
+
+        The database adds up the sizes in order of age, and stops at the
+        first entry that reaches the target size.
+        :param int target_size: number of bytes to purge
+        :return: [(entry_type, entry_id, entry_size)] in the order they
+            should be purged, with entry_type 'r' for container runs, 'l' for
+            container logs, and 'd' for datasets.
+        """
+        sandbox_ages = ContainerRun.find_unneeded().annotate(
+            entry_type=Value('r', models.CharField()),
+            age=ExpressionWrapper(sandbox_aging * (Now() - F('end_time')),
+                                  output_field=DurationField()),
+            entry_size=F('sandbox_size')).values_list(
+            'entry_type',
+            'id',
+            'age',
+            'entry_size').order_by()
+
+        log_ages = ContainerLog.find_unneeded().annotate(
+            entry_type=Value('l', models.CharField()),
+            age=ExpressionWrapper(log_aging * (Now() - F('run__end_time')),
+                                  output_field=DurationField()),
+            entry_size=F('log_size')).values_list(
+            'entry_type',
+            'id',
+            'age',
+            'entry_size').order_by()
+
+        dataset_ages = Dataset.find_unneeded().annotate(
+            entry_type=Value('d', models.CharField()),
+            age=ExpressionWrapper(dataset_aging * (Now() - F('date_created')),
+                                  output_field=FloatField()),
+            entry_size=F('dataset_size')).values_list(
+            'entry_type',
+            'id',
+            'age',
+            'entry_size').order_by()
+
+        all_entries = sandbox_ages.union(log_ages, dataset_ages, all=True)
+        entries_sql, entries_params = all_entries.query.sql_with_params()
+        plan_sql = """\
+SELECT entry_type, id, entry_size
+FROM (
+    SELECT entry_type, id, age, entry_size,
+        SUM(entry_size) OVER (
+            ORDER BY age DESC, entry_type, id
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS running_size
+    FROM ({}) all_entries) running_entries
+WHERE running_size - entry_size < %s
+ORDER BY age DESC, entry_type, id
+""".format(entries_sql)
+        with connection.cursor() as cursor:
+            cursor.execute(plan_sql, entries_params + (target_size, ))
+            return cursor.fetchall()
+
+    def purge_batch(self, batch, executor, plan=False):
+        """ Purge a batch of planned entries.
+
+        Loads the records in bulk, deletes their files on the thread pool,
+        and clears their file fields in bulk.
+        :param batch: [(entry_type, entry_id, entry_size)] from plan_purge()
+        :param executor: a thread pool to delete files on
+        :param bool plan: True if nothing should be purged
+        :return: {(entry_type, entry_id): entry_date} for the entries found
+        """
+        ids = {entry_type: [entry_id
+                            for batch_type, entry_id, _ in batch
+                            if batch_type == entry_type]
+               for entry_type in 'rld'}
+        records = dict(
+            r=ContainerRun.find_unneeded().in_bulk(ids['r']),
+            l=ContainerLog.find_unneeded().select_related('run').in_bulk(ids['l']),
+            d=Dataset.find_unneeded().in_bulk(ids['d']))
+        entry_dates = {}
+        futures = []
+        released_content_ids = []
+        for entry_type, entry_id, entry_size in batch:
+            record = records[entry_type].get(entry_id)
+            if record is None:
+                continue
+            if entry_type == 'r':
+                entry_date = record.end_time
+                entry_name = 'container run'
+                purge_file = self.purge_sandbox
+            elif entry_type == 'l':
+                entry_date = record.run.end_time
+                entry_name = 'container log'
+                purge_file = self.purge_log
+            else:
+                assert entry_type == 'd'
+                entry_date = record.date_created
+                entry_name = 'dataset'
+                purge_file = self.purge_dataset
+            entry_dates[(entry_type, entry_id)] = entry_date
+            if plan:
+                continue
+            logger.debug("Purged %s %d containing %s.",
+                         entry_name,
+                         entry_id,
+                         filesizeformat(entry_size))
+            if entry_type == 'd' and record.content_id is not None:
+                # Shared files are released after the records are saved.
+                released_content_ids.append(purge_file(record))
+            else:
+                futures.append(executor.submit(purge_file, record))
+        for future in futures:
+            future.result()
+        if not plan:
+            with transaction.atomic():
+                ContainerRun.objects.bulk_update(records['r'].values(),
+                                                 ['sandbox_path'])
+                ContainerLog.objects.bulk_update(records['l'].values(),
+                                                 ['long_text'])
+                Dataset.objects.bulk_update(records['d'].values(),
+                                            ['dataset_file', 'dataset_size', 'content'])
+                for content_id in released_content_ids:
+                    DatasetContent.release(content_id)
+            for model_records in records.values():
+                StorageLedger.track_changes(list(model_records.values()))
+        return entry_dates
+
+    @staticmethod
+    def purge_sandbox(run):
+        try:
+            run.delete_sandbox()
+        except OSError:
+            logger.error(u"Failed to purge container run %d at %r.",
+                         run.id,
+                         run.sandbox_path,
+                         exc_info=True)
+            run.sandbox_path = ''
+
+    @staticmethod
+    def purge_log(log):
+        log.long_text.delete(save=False)
+
+    @staticmethod
+    def purge_dataset(dataset):
+        return dataset.purge_file(save=False)
+
+    def set_file_sizes(self,
+                       model,
+                       file_field,
+                       size_field,
+                       date_field,
+                       executor=None,
+                       batch_size=100):
         """
         Scan through all model rows that do not have their sizes set and set them.
-        :return: the total storage used by all files referenced by rows in the
-            model
+
+        Sizes are saved after each batch, so an interrupted scan continues
+        where it left off.
+        :param executor: scans several files or folders at once, if given
+        :param int batch_size: number of rows to scan and save at a time
         """
         rows_to_set = model.objects.filter(
             **{file_field+'__isnull': False,
                size_field+'__isnull': True}).exclude(
             **{file_field: ''}).exclude(
-            **{date_field: None}).annotate(extra__date=F(date_field))
+            **{date_field: None}).annotate(
+            extra__date=F(date_field)).order_by('id')
         model_name = getattr(model, '_meta').model_name
         min_missing_date = max_missing_date = None
         missing_count = 0
-        for row in rows_to_set:
-            f = getattr(row, file_field)
-            try:
-                if isinstance(f, FieldFile):
-                    file_size = f.size
-                else:
-                    file_size = self.scan_folder_size(f)
-            except OSError as ex:
-                if ex.errno != errno.ENOENT:
-                    raise
-                file_size = 0
-                row_date = row.extra__date
-                file_name = os.path.relpath(ex.filename, settings.MEDIA_ROOT)
-                setattr(row, file_field, '')
-                logger.warning('Missing %s file %r from %s.',
-                               model_name,
-                               str(file_name),
-                               naturaltime(row_date))
-                if min_missing_date is None or row_date < min_missing_date:
-                    min_missing_date = row_date
-                if max_missing_date is None or max_missing_date < row_date:
-                    max_missing_date = row_date
-                missing_count += 1
-            setattr(row, size_field, file_size)
-            row.save()
+        last_id = 0
+        while True:
+            rows = list(rows_to_set.filter(id__gt=last_id)[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1].id
+            files = [getattr(row, file_field) for row in rows]
+            if executor is None:
+                results = map(self.measure_file, files)
+            else:
+                results = executor.map(self.measure_file, files)
+            for row, (file_size, ex) in zip(rows, results):
+                if ex is not None:
+                    row_date = row.extra__date
+                    file_name = os.path.relpath(ex.filename, settings.MEDIA_ROOT)
+                    setattr(row, file_field, '')
+                    logger.warning('Missing %s file %r from %s.',
+                                   model_name,
+                                   str(file_name),
+                                   naturaltime(row_date))
+                    if min_missing_date is None or row_date < min_missing_date:
+                        min_missing_date = row_date
+                    if max_missing_date is None or max_missing_date < row_date:
+                        max_missing_date = row_date
+                    missing_count += 1
+                setattr(row, size_field, file_size)
+            model.objects.bulk_update(rows, [file_field, size_field])
+            StorageLedger.track_changes(rows)
         if missing_count:
             start_text = naturaltime(min_missing_date)
             end_text = naturaltime(max_missing_date)
@@ -304,15 +486,29 @@ class Command(BaseCommand):
                          pluralize(missing_count),
                          date_range)
 
-        # Get the total amount of active storage recorded.
-        return model.objects.exclude(
-            **{file_field: ''}).exclude(  # Already purged.
-            **{file_field: None}).aggregate(  # Not used.
-            models.Sum(size_field))[size_field + "__sum"] or 0
+    def measure_file(self, f):
+        """ Measure a file field or a folder path.
+
+        :return: (file_size, error), where error is the FileNotFoundError if
+            it's missing. file_size is None if files were deleted while the
+            folder was scanned.
+        """
+        try:
+            if isinstance(f, FieldFile):
+                return f.size, None
+            return self.scan_folder_size(f), None
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return 0, ex
 
     def scan_folder_size(self, folder_path, newest_allowed=None):
         """ Scan the total size of all the files in and below a folder.
 
+        Hard linked files are only counted once, and not at all if they have
+        links outside the folder, like inputs staged from the dataset store.
+        Those bytes are counted where they're stored, and removing the folder
+        wouldn't free them.
         :param str folder_path: the folder to scan, relative to MEDIA_ROOT.
         :param datetime newest_allowed: if there are any files newer than this,
             return None.
@@ -321,27 +517,62 @@ class Command(BaseCommand):
         """
         full_path = os.path.join(settings.MEDIA_ROOT, folder_path)
         size_accumulator = 0
-        sandbox_files = (os.path.join(root, file_name)
-                         for root, _, files in os.walk(full_path, onerror=raise_error)
-                         for file_name in files)
-        for file_path in sandbox_files:
-            file_size = self.get_file_size(file_path, newest_allowed)
-            if file_size is None:
-                return  # File was too new, or was deleted (indicating an active run).
-            size_accumulator += file_size
+        linked_files = {}  # {(st_dev, st_ino): [st_size, st_nlink, links_found]}
+        folders = [full_path]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            folders.append(entry.path)
+                        continue
+                    file_stat = self.get_file_stat(entry, newest_allowed)
+                    if file_stat is None:
+                        return  # File was too new, or was deleted (indicating an active run).
+                    if file_stat.st_nlink > 1 and not entry.is_symlink():
+                        key = (file_stat.st_dev, file_stat.st_ino)
+                        linked_file = linked_files.setdefault(
+                            key,
+                            [file_stat.st_size, file_stat.st_nlink, 0])
+                        linked_file[2] += 1
+                        continue
+                    size_accumulator += file_stat.st_size
+        for file_size, link_count, links_found in linked_files.values():
+            if links_found >= link_count:
+                size_accumulator += file_size
         return size_accumulator  # we don't set self.sandbox_size here, we do that explicitly elsewhere.
 
-    @staticmethod
-    def get_file_size(file_path, newest_allowed=None):
+    @classmethod
+    def get_file_size(cls, file_path, newest_allowed=None):
         """ Get the size of a file, if it exists and isn't too new.
 
-        :param str file_path: the absolute path of the file to check
+        :param file_path: the absolute path of the file to check, or an
+            os.DirEntry from scanning its folder. Symbolic links are measured
+            themselves, not their targets.
         :param datetime newest_allowed: if the file is newer than this,
             return None.
         :return: the file size if it's old enough or newest_allowed is None,
             otherwise return None.
         """
-        if os.path.islink(file_path):
+        file_stat = cls.get_file_stat(file_path, newest_allowed)
+        return None if file_stat is None else file_stat.st_size
+
+    @staticmethod
+    def get_file_stat(file_path, newest_allowed=None):
+        """ Get the stat of a file, if it exists and isn't too new.
+
+        :param file_path: the same as get_file_size()
+        :param datetime newest_allowed: if the file is newer than this,
+            return None.
+        :return: the os.stat_result if it's old enough or newest_allowed is
+            None, otherwise return None.
+        """
+        if isinstance(file_path, os.DirEntry):
+            try:
+                file_stat = file_path.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                return
+        elif os.path.islink(file_path):
             file_stat = os.lstat(file_path)
         else:
             try:
@@ -354,7 +585,7 @@ class Command(BaseCommand):
                 timezone.get_current_timezone())
             if modification_time > newest_allowed:
                 return
-        return file_stat.st_size
+        return file_stat
 
     def summarize_storage(self,
                           container_total,
@@ -373,21 +604,43 @@ class Command(BaseCommand):
         storage_text = ', '.join(remainders) if remainders else 'empty storage'
         return storage_text
 
-    def synch_model(self, model, path_field_name, wait, batch_size):
+    def synch_model(self, model, path_field_name, wait, batch_size, manifest=None):
+        if manifest is None:
+            manifest = ScanManifest()
+        start_time = perf_counter()
+        start_file_count = manifest.file_count
+        start_scanned_count = manifest.scanned_count
+        start_skipped_count = manifest.skipped_count
         file_names = set()
         total_files = total_bytes = 0
-        for file_name in chain(model.scan_file_names(), [None]):
+        for file_name in chain(model.scan_file_names(manifest), [None]):
             if file_name is not None:
                 file_names.add(file_name)
             if len(file_names) >= batch_size or file_name is None:
-                files_removed, bytes_removed = self.synch_model_files(
+                files_removed, bytes_removed, query_seconds = self.synch_model_files(
                     model,
                     path_field_name,
                     file_names,
-                    wait)
+                    wait,
+                    manifest)
                 total_files += files_removed
                 total_bytes += bytes_removed
+                if len(file_names) >= batch_size:
+                    batch_size = self.tune_batch_size(batch_size, query_seconds)
                 file_names.clear()
+        duration = perf_counter() - start_time
+        file_count = manifest.file_count - start_file_count
+        # noinspection PyProtectedMember
+        logger.info('Scanned %d %s file%s in %.1fs (%.0f per second), '
+                    'scanned %d folder%s and skipped %d unchanged.',
+                    file_count,
+                    model._meta.verbose_name,
+                    pluralize(file_count),
+                    duration,
+                    file_count / duration if duration else 0,
+                    manifest.scanned_count - start_scanned_count,
+                    pluralize(manifest.scanned_count - start_scanned_count),
+                    manifest.skipped_count - start_skipped_count)
         if total_files:
             # noinspection PyProtectedMember
             logger.error(
@@ -397,24 +650,44 @@ class Command(BaseCommand):
                 pluralize(total_files),
                 filesizeformat(total_bytes))
 
-    def synch_model_files(self, model, path_field_name, file_names, wait):
+    @classmethod
+    def tune_batch_size(cls, batch_size, query_seconds):
+        """ Adjust the batch size so each query takes about SYNCH_QUERY_SECONDS. """
+        if query_seconds < cls.SYNCH_QUERY_SECONDS / 2:
+            return min(batch_size * 2, cls.MAX_SYNCH_BATCH_SIZE)
+        if query_seconds > cls.SYNCH_QUERY_SECONDS * 2:
+            return max(batch_size // 2, 1)
+        return batch_size
+
+    def synch_model_files(self, model, path_field_name, file_names, wait, manifest=None):
+        """ Purge any of the files that aren't registered in the database.
+
+        :return: (files_removed, bytes_removed, query_seconds)
+        """
         remove_older_than = timezone.now() - wait
+        start_time = perf_counter()
         values_list = model.objects.filter(
             **{path_field_name+'__in': file_names}).values_list(path_field_name)
         found_file_names = {file_name for file_name, in values_list}
+        query_seconds = perf_counter() - start_time
         unknown_file_names = file_names - found_file_names
         bytes_removed = files_removed = 0
         for file_name in sorted(unknown_file_names):
             file_path = os.path.join(settings.MEDIA_ROOT, file_name)
-            if os.path.isdir(file_path):
+            is_folder = os.path.isdir(file_path)
+            if is_folder:
                 file_size = self.scan_folder_size(file_path, remove_older_than)
-                if file_size is None:
-                    continue  # Found some new files in there.
-                shutil.rmtree(file_path)
             else:
                 file_size = self.get_file_size(file_path, remove_older_than)
-                if file_size is None:
-                    continue  # File was too new or already deleted.
+            if file_size is None:
+                # Too new or already deleted, so check it again next time.
+                if manifest is not None:
+                    manifest.mark_changed(os.path.dirname(file_name))
+                    manifest.mark_changed(file_name)  # Might be empty folder.
+                continue
+            if is_folder:
+                shutil.rmtree(file_path)
+            else:
                 os.remove(file_path)
             logger.warning(
                 'Purged unregistered file %r containing %s.',
@@ -422,8 +695,4 @@ class Command(BaseCommand):
                 filesizeformat(file_size))
             files_removed += 1
             bytes_removed += file_size
-        return files_removed, bytes_removed
-
-
-def raise_error(ex):
-    raise ex
+        return files_removed, bytes_removed, query_seconds
@@ -0,0 +1,41 @@
+import logging
+from argparse import ArgumentDefaultsHelpFormatter
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from container.executors import LocalExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Start queued container runs on this host for the local executor. '
+            'Run exactly one of these as a service.')
+
+    def add_arguments(self, parser):
+        parser.formatter_class = ArgumentDefaultsHelpFormatter
+
+        parser.add_argument('--interval',
+                            help='Seconds between checks for queued runs',
+                            default=LocalExecutor.POLL_SECONDS,
+                            type=float)
+        parser.add_argument('--once',
+                            action='store_true',
+                            help='Check once, then exit.')
+
+    def handle(self, interval, once=False, **kwargs):
+        executor = LocalExecutor()
+        while True:
+            try:
+                executor.dispatch()
+            except Exception:
+                if once:
+                    raise
+                logger.error('Local dispatch failed.', exc_info=True)
+            finally:
+                close_old_connections()
+            if once:
+                break
+            sleep(interval)
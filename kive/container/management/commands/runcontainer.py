@@ -3,19 +3,27 @@ import json
 import logging
 import os
 import pathlib
+import resource
 import shutil
-from subprocess import call
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from subprocess import call, Popen
 import sys
+from time import perf_counter
 from traceback import format_exception_only
 import typing
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
+from constants import maxlengths
 from container.models import (
     ContainerRun, ContainerArgument, ContainerArgumentType,
-    ContainerLog, ContainerDataset,
+    ContainerLog, ContainerDataset, ChecksumCache, ContainerRunPhase,
 )
+from file_access_utils import stage_file, link_tree
 from librarian.models import Dataset
 
 KNOWN_EXTENSIONS = ('csv',
@@ -28,22 +36,57 @@ KNOWN_EXTENSIONS = ('csv',
                     'gz',
                     'zip')
 logger = logging.getLogger(__name__)
+NO_USAGE = resource.struct_rusage((0,) * resource.struct_rusage.n_sequence_fields)
+
+
+def call_with_usage(args, **kwargs):
+    """ Run a command like subprocess.call(), and measure what it used.
+
+    os.wait4() reports the usage of this one child, so it's still accurate
+    while other children run at the same time.
+    :return: (return_code, usage) where usage is a resource.struct_rusage
+    """
+    process = Popen(args, **kwargs)
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
 
 
 class Command(BaseCommand):
     help = "Executes a container run in singularity."
 
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.phases = []
+        self.phase_lock = threading.Lock()
+        self.bytes_staged = 0
+
     def add_arguments(self, parser):
         parser.add_argument(
             "run_id",
             type=int,
+            nargs='?',
             help='ContainerRun to execute')
-
-    def handle(self, run_id, **kwargs):
-        run = self.record_start(run_id)
+        parser.add_argument(
+            "--array_ids",
+            help='comma-separated ContainerRun ids for a Slurm job array, '
+                 'indexed by SLURM_ARRAY_TASK_ID')
+
+    def handle(self, run_id=None, array_ids=None, **kwargs):
+        if run_id is None:
+            run_id = self.find_array_run_id(array_ids)
+        with self.timed_phase('record_start'):
+            run = self.record_start(run_id)
         # noinspection PyBroadException
         try:
-            self.fill_sandbox(run)
+            with self.timed_phase('fill_sandbox') as phase:
+                self.fill_sandbox(run)
+                phase.bytes_staged = self.bytes_staged
             run.save()
 
             self.run_container(run)
@@ -51,22 +94,94 @@ class Command(BaseCommand):
 
             self.save_outputs(run)
             run.save()
+            self.save_phases(run)
         except Exception:
             run.state = ContainerRun.FAILED
             run.end_time = timezone.now()
             run.save()
             self.save_exception(run)
+            self.save_phases(run)
             logger.error('Running container failed.', exc_info=True)
             exit(1)
 
+    @contextmanager
+    def timed_phase(self, name, measure_children=True):
+        """ Record how long a phase takes, and what its child processes use.
+
+        :param name: the phase name to record
+        :param measure_children: False if the caller will measure its own
+            child processes with record_usage(), because other phases are
+            running children at the same time
+        :return: a ContainerRunPhase that the caller can add details to,
+            and that gets saved with the others by save_phases().
+        """
+        with self.phase_lock:
+            # Pipeline steps can run in parallel threads.
+            phase = ContainerRunPhase(name=name,
+                                      position=len(self.phases),
+                                      start_time=timezone.now())
+            self.phases.append(phase)
+        start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_bytes_hashed = ChecksumCache.stats['bytes_hashed']
+        start = perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.duration = perf_counter() - start
+            bytes_hashed = ChecksumCache.stats['bytes_hashed'] - start_bytes_hashed
+            if bytes_hashed:
+                phase.bytes_hashed = bytes_hashed
+            if measure_children:
+                self.record_usage(phase,
+                                  resource.getrusage(resource.RUSAGE_CHILDREN),
+                                  start_usage)
+
+    @staticmethod
+    def record_usage(phase, end_usage, start_usage=NO_USAGE):
+        """ Record the resources that child processes used during a phase.
+
+        :param phase: the ContainerRunPhase to update
+        :param end_usage: a resource.struct_rusage from the end of the phase
+        :param start_usage: one from the start of the phase, or nothing if
+            end_usage only covers this phase
+        """
+        if end_usage.ru_maxrss > start_usage.ru_maxrss:
+            phase.max_rss = end_usage.ru_maxrss
+        phase.user_cpu = end_usage.ru_utime - start_usage.ru_utime
+        phase.system_cpu = end_usage.ru_stime - start_usage.ru_stime
+        phase.block_input = end_usage.ru_inblock - start_usage.ru_inblock
+        phase.block_output = end_usage.ru_oublock - start_usage.ru_oublock
+
+    def save_phases(self, run):
+        for phase in self.phases:
+            phase.run = run
+        ContainerRunPhase.objects.bulk_create(self.phases)
+        self.phases = []
+
+    @staticmethod
+    def find_array_run_id(array_ids):
+        if array_ids is None:
+            raise CommandError('Either run_id or --array_ids is required.')
+        task_id = os.environ.get('SLURM_ARRAY_TASK_ID')
+        if task_id is None:
+            raise CommandError('SLURM_ARRAY_TASK_ID is not set.')
+        run_ids = array_ids.split(',')
+        return int(run_ids[int(task_id)])
+
     def record_start(self, run_id):
         old_state = ContainerRun.NEW
         new_state = ContainerRun.LOADING
-        slurm_job_id = os.environ.get('SLURM_JOB_ID')
+        array_job_id = os.environ.get('SLURM_ARRAY_JOB_ID')
+        if array_job_id is None:
+            slurm_ids = dict(slurm_job_id=os.environ.get('SLURM_JOB_ID'))
+        else:
+            slurm_ids = dict(
+                slurm_job_id=array_job_id,
+                slurm_array_task_id=os.environ.get('SLURM_ARRAY_TASK_ID'))
         rows_updated = ContainerRun.objects.filter(
             id=run_id, state=old_state).update(state=new_state,
                                                start_time=timezone.now(),
-                                               slurm_job_id=slurm_job_id)
+                                               **slurm_ids)
 
         # Defer the stopped_by field so we don't overwrite it when another
         # process tries to stop this job.
@@ -89,6 +204,9 @@ class Command(BaseCommand):
             raise RuntimeError('Inputs missing from reruns.')
         input_path = os.path.join(run.full_sandbox_path, 'input')
         os.mkdir(input_path)
+        staging_start = perf_counter()
+        strategies_used = []
+        self.bytes_staged = 0
         for dataset in run.datasets.all():
             if dataset.argument.argtype in (
                     ContainerArgumentType.OPTIONAL_MULTIPLE_INPUT,
@@ -101,36 +219,39 @@ class Command(BaseCommand):
                         format(unique_filename))
             else:
                 target_path = os.path.join(input_path, dataset.argument.name)
-            source_file = dataset.dataset.get_open_file_handle(raise_errors=True)
-            with source_file, open(target_path, 'wb') as target_file:
-                shutil.copyfileobj(source_file, target_file)
+            strategy = self.stage_input(dataset.dataset, target_path)
+            self.bytes_staged += os.stat(target_path).st_size
+            if strategy not in strategies_used:
+                strategies_used.append(strategy)
+        run.input_staging = ','.join(strategies_used)
+        run.input_staging_seconds = perf_counter() - staging_start
         os.mkdir(os.path.join(run.full_sandbox_path, 'output'))
 
         run.state = ContainerRun.RUNNING
 
+    @staticmethod
+    def stage_input(dataset, target_path):
+        """ Stage a dataset's file into the sandbox.
+
+        :return str: the staging strategy that was used
+        """
+        source_path = dataset.get_file_path()
+        if source_path is None:
+            raise ValueError('Dataset has no dataset_file or external_path.')
+        return stage_file(source_path,
+                          target_path,
+                          settings.INPUT_STAGING_STRATEGIES)
+
     def run_container(self, run):
         logs_path = os.path.join(run.full_sandbox_path, 'logs')
         stdout_path = os.path.join(logs_path, 'stdout.txt')
         stderr_path = os.path.join(logs_path, 'stderr.txt')
 
-        for input_cd in run.datasets.filter(argument__type=ContainerArgument.INPUT):
-            input_dataset = input_cd.dataset
-            current_md5 = input_dataset.compute_md5()
-            if current_md5 != input_dataset.MD5_checksum:
-                raise ValueError(
-                    "Dataset with pk={} has an inconsistent checksum (original {}; current {})".format(
-                        input_dataset.pk,
-                        input_dataset.MD5_checksum,
-                        current_md5
-                    )
-                )
-
-        container_to_run = run.app.container
-        container_to_run.validate_md5()
-        if not container_to_run.is_singularity():
-            container_to_run.parent.validate_md5()
+        with self.timed_phase('verify_md5'):
+            self.verify_md5s(run)
 
-        with open(stdout_path, 'w') as stdout, open(stderr_path, 'w') as stderr:
+        with open(stdout_path, 'w') as stdout, open(stderr_path, 'w') as stderr, \
+                self.timed_phase('execute'):
             if run.app.container.is_singularity():
                 # This is a Singularity container.
                 command = self.build_command(run)
@@ -141,7 +262,7 @@ class Command(BaseCommand):
             else:
                 # This is a child container to be run inside another Singularity container.
                 bin_dir = os.path.join(run.full_sandbox_path, "bin")
-                run.app.container.extract_archive(os.path.join(run.full_sandbox_path, "bin"))
+                is_bin_shared = run.app.container.extract_archive_cached(bin_dir)
                 pipeline_path = os.path.join(bin_dir, "kive", "pipeline.json")
                 with open(pipeline_path, "r") as f:
                     instructions = json.loads(f.read())
@@ -152,10 +273,42 @@ class Command(BaseCommand):
                     stderr,
                     bin_dir,
                     os.path.join(run.full_sandbox_path, "input"),
-                    os.path.join(run.full_sandbox_path, "output")
+                    os.path.join(run.full_sandbox_path, "output"),
+                    is_bin_read_only=is_bin_shared
                 )
         run.state = ContainerRun.SAVING
 
+    @staticmethod
+    def verify_md5s(run):
+        input_datasets = [
+            input_cd.dataset
+            for input_cd in run.datasets.filter(
+                argument__type=ContainerArgument.INPUT).select_related('dataset')]
+        file_paths = {input_dataset.pk: input_dataset.get_file_path()
+                      for input_dataset in input_datasets}
+        # Inputs that aren't in the cache are hashed in parallel.
+        current_md5s = ChecksumCache.compute_md5s(
+            file_path
+            for file_path in file_paths.values()
+            if file_path is not None)
+        for input_dataset in input_datasets:
+            file_path = file_paths[input_dataset.pk]
+            current_md5 = None if file_path is None else current_md5s[file_path]
+            if current_md5 != input_dataset.MD5_checksum:
+                raise ValueError(
+                    "Dataset with pk={} has an inconsistent checksum (original {}; current {})".format(
+                        input_dataset.pk,
+                        input_dataset.MD5_checksum,
+                        current_md5
+                    )
+                )
+
+        container_to_run = run.app.container
+        container_to_run.validate_md5()
+        if not container_to_run.is_singularity():
+            container_to_run.parent.validate_md5()
+        ChecksumCache.log_stats()
+
     @classmethod
     def build_command(cls, run):
         container_path = run.app.container.file.path
@@ -166,8 +319,8 @@ class Command(BaseCommand):
                    '--contain',
                    '--cleanenv',
                    '-B',
-                   '{}:/mnt/input,{}:/mnt/output'.format(input_path,
-                                                         output_path)]
+                   '{}:/mnt/input:ro,{}:/mnt/output'.format(input_path,
+                                                            output_path)]
         if run.app.name:
             command.append('--app')
             command.append(run.app.name)
@@ -241,17 +394,25 @@ class Command(BaseCommand):
         output_path = os.path.join(run.full_sandbox_path, 'output')
         upload_path = os.path.join(run.full_sandbox_path, 'upload')
         os.mkdir(upload_path)
-        for argument in run.app.arguments.filter(type=ContainerArgument.OUTPUT):
-            if argument.argtype == ContainerArgumentType.FIXED_OUTPUT:
-                self._save_output_argument(run, argument, output_path, upload_path)
-            elif argument.argtype == ContainerArgumentType.FIXED_DIRECTORY_OUTPUT:
-                self._save_output_directory_argument(run, argument, output_path, upload_path)
-            else:
-                raise RuntimeError(f"Invalid output argument type in {run}: {argument.argtype}")
+        with self.timed_phase('save_outputs') as phase:
+            file_count = 0
+            for argument in run.app.arguments.filter(type=ContainerArgument.OUTPUT):
+                if argument.argtype == ContainerArgumentType.FIXED_OUTPUT:
+                    file_count += self._save_output_argument(run, argument, output_path, upload_path)
+                elif argument.argtype == ContainerArgumentType.FIXED_DIRECTORY_OUTPUT:
+                    file_count += self._save_output_directory_argument(
+                        run,
+                        argument,
+                        output_path,
+                        upload_path)
+                else:
+                    raise RuntimeError(f"Invalid output argument type in {run}: {argument.argtype}")
+            phase.file_count = file_count
         logs_path = os.path.join(run.full_sandbox_path, 'logs')
-        for file_name, log_type in (('stdout.txt', ContainerLog.STDOUT),
-                                    ('stderr.txt', ContainerLog.STDERR)):
-            run.load_log(os.path.join(logs_path, file_name), log_type)
+        with self.timed_phase('load_log'):
+            for file_name, log_type in (('stdout.txt', ContainerLog.STDOUT),
+                                        ('stderr.txt', ContainerLog.STDERR)):
+                run.load_log(os.path.join(logs_path, file_name), log_type)
 
         run.set_md5()
         run.state = (ContainerRun.COMPLETE
@@ -265,7 +426,11 @@ class Command(BaseCommand):
         argument: ContainerArgument,
         output_path: str,
         upload_path: str,
-    ):
+    ) -> int:
+        """ Register a single output file as a dataset, if it was written.
+
+        :return: the number of files registered
+        """
         argument_path = os.path.join(output_path, argument.name)
         dataset_name = self.build_dataset_name(run, argument.name)
         new_argument_path = os.path.join(upload_path, dataset_name)
@@ -279,6 +444,8 @@ class Command(BaseCommand):
         except (OSError, IOError) as ex:
             if ex.errno != errno.ENOENT:
                 raise
+            return 0
+        return 1
 
     @staticmethod
     def _build_directory_file_name(runid: int, output_path: pathlib.Path, file_path: pathlib.Path) -> str:
@@ -308,9 +475,14 @@ class Command(BaseCommand):
     def _save_output_directory_argument(cls, run: ContainerRun,
                                         argument: ContainerArgument,
                                         output_path: str,
-                                        upload_path: str) -> None:
+                                        upload_path: str) -> int:
+        """ Register every file under a directory output as a dataset.
+
+        :return: the number of files registered
+        """
         output_path = pathlib.Path(output_path).absolute()
         dirarg_path = output_path / argument.name
+        file_names = []
         for dirpath, _, filenames in os.walk(dirarg_path):
             dirpath = pathlib.Path(dirpath)
             for filename in filenames:
@@ -322,16 +494,26 @@ class Command(BaseCommand):
                     run.id, output_path, datafile_path)
                 try:
                     os.rename(datafile_path, destination_path)
-                    dataset = Dataset.create_dataset(
-                        destination_path,
-                        name=dataset_name,
-                        user=run.user,
-                    )
-                    dataset.copy_permissions(run)
-                    run.datasets.create(dataset=dataset, argument=argument)
                 except (OSError, IOError) as ex:
                     if ex.errno != errno.ENOENT:
                         raise
+                    continue
+                file_names.append((destination_path, dataset_name))
+
+        def link_datasets(datasets):
+            ContainerDataset.objects.bulk_create(
+                ContainerDataset(run_id=run.id,
+                                 argument_id=argument.id,
+                                 dataset_id=dataset.pk)
+                for dataset in datasets)
+
+        # Link each batch in its own transaction, so a failure never leaves
+        # datasets that don't belong to the run.
+        datasets = Dataset.create_datasets(file_names,
+                                           user=run.user,
+                                           permissions_source=run,
+                                           on_batch=link_datasets)
+        return len(datasets)
 
     def save_exception(self, run):
         log_path = os.path.join(run.full_sandbox_path, 'logs', 'stderr.txt')
@@ -352,7 +534,8 @@ class Command(BaseCommand):
                      internal_binary_dir="/mnt/bin",
                      internal_inputs_dir="/mnt/input",
                      internal_outputs_dir="/mnt/output",
-                     internal_working_dir="/mnt/bin"):
+                     internal_working_dir="/mnt/bin",
+                     is_bin_read_only=False):
         """
         Run the pipeline dictated in the instructions.
 
@@ -367,7 +550,11 @@ class Command(BaseCommand):
         :param internal_inputs_dir: as it appears inside the container
         :param internal_outputs_dir: as it appears inside the container
         :param internal_working_dir: as it appears inside the container
-        :return:
+        :param is_bin_read_only: True if the extracted files are shared with
+            the extraction cache, so steps must not change them
+        :return: zero if all steps succeeded, otherwise the return code of
+            the first step to fail. Independent steps run in parallel, up to
+            the app's thread count, and no new steps start after a failure.
         """
         # The instructions take the form of a Python representation of a pipeline JSON file.
         # We keep track of what files were produced by what steps in file_map, which is a list of dictionaries.
@@ -379,13 +566,114 @@ class Command(BaseCommand):
             inputs_map[input_dict["dataset_name"]] = os.path.join(external_inputs_dir, input_dict["dataset_name"])
         file_map = [inputs_map]
 
+        steps = instructions["steps"]
+        for idx, step in enumerate(steps, 1):
+            external_step_output_dir = os.path.join(run.full_sandbox_path, "step{}".format(idx), "output")
+            outputs_map = {}
+            for dataset_name in step["outputs"]:
+                file_name = self.build_dataset_name(
+                    run,
+                    "step{}_{}".format(idx, dataset_name))
+                outputs_map[dataset_name] = os.path.join(external_step_output_dir, file_name)
+            file_map.append(outputs_map)
+        # Step 0 holds the pipeline inputs, so it's always finished.
+        step_dependencies = {
+            idx: {input_dict["source_step"] for input_dict in step["inputs"]} - {0}
+            for idx, step in enumerate(steps, 1)}
+
         final_return_code = 0
         log_path = os.path.dirname(standard_out.name)
-        for idx, step in enumerate(instructions["steps"], 1):
+        max_workers = max(run.app.threads, 1)
+        waiting_steps = list(range(1, len(steps) + 1))
+        started_steps = []
+        finished_steps = set()
+        running_steps = {}  # {future: idx}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                if final_return_code == 0:
+                    # Launch ready steps in order, unless a step has failed.
+                    for idx in list(waiting_steps):
+                        if len(running_steps) >= max_workers:
+                            break
+                        if not step_dependencies[idx] <= finished_steps:
+                            continue
+                        waiting_steps.remove(idx)
+                        started_steps.append(idx)
+                        future = executor.submit(self.run_step,
+                                                 run,
+                                                 idx,
+                                                 steps[idx - 1],
+                                                 file_map,
+                                                 log_path,
+                                                 extracted_archive_dir,
+                                                 internal_binary_dir,
+                                                 internal_inputs_dir,
+                                                 internal_outputs_dir,
+                                                 internal_working_dir,
+                                                 is_bin_read_only)
+                        running_steps[future] = idx
+                if not running_steps:
+                    break
+                done, _ = wait(running_steps, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=running_steps.get):
+                    idx = running_steps.pop(future)
+                    step_return_code = future.result()
+                    if step_return_code == 0:
+                        finished_steps.add(idx)
+                    elif final_return_code == 0:
+                        final_return_code = step_return_code
+        if waiting_steps and final_return_code == 0:
+            raise RuntimeError(
+                "Pipeline steps {} depend on steps that never ran.".format(
+                    waiting_steps))
+
+        # Merge the logs in step order, no matter which step finished first.
+        for idx in sorted(started_steps):
             step_header = "========\nProcessing step {}: {}\n========\n".format(
                 idx,
-                step["driver"])
+                steps[idx - 1]["driver"])
+            for stream_name, main_file in (('stdout', standard_out),
+                                           ('stderr', standard_err)):
+                step_path = os.path.join(log_path,
+                                         'step_{}_{}.txt'.format(idx, stream_name))
+                log_size = os.stat(step_path).st_size
+                if log_size:
+                    main_file.write(step_header)
+                    with open(step_path) as step_file:
+                        shutil.copyfileobj(step_file, main_file)
+
+        if final_return_code == 0:
+            # Now rename the outputs.
+            for output in instructions["outputs"]:
+                # This dictionary has fields
+                # - dataset_name
+                # - source (pairs that look like [step_num, output_name])
+                final_output_path = os.path.join(external_outputs_dir, output["dataset_name"])
+                source_step = output["source_step"]
+                source_dataset_name = output["source_dataset_name"]
+                os.link(file_map[source_step][source_dataset_name], final_output_path)
+
+        return final_return_code
 
+    def run_step(self,
+                 run,
+                 idx,
+                 step,
+                 file_map,
+                 log_path,
+                 extracted_archive_dir,
+                 internal_binary_dir,
+                 internal_inputs_dir,
+                 internal_outputs_dir,
+                 internal_working_dir,
+                 is_bin_read_only=False):
+        """ Run a single step of a pipeline, and write its logs to log_path.
+
+        :return: the step's return code
+        """
+        step_name = "step {}: {}".format(idx, step["driver"])
+        with self.timed_phase(step_name[:maxlengths.MAX_NAME_LENGTH],
+                              measure_children=False) as phase:
             external_step_input_dir = os.path.join(run.full_sandbox_path, "step{}".format(idx), "input")
             external_step_output_dir = os.path.join(run.full_sandbox_path, "step{}".format(idx), "output")
             os.makedirs(external_step_input_dir)
@@ -393,10 +681,9 @@ class Command(BaseCommand):
 
             external_step_bin_dir = os.path.join(run.full_sandbox_path, "step{}".format(idx), "bin")
             dependency_filter = DependencyFilter(extracted_archive_dir, step)
-            shutil.copytree(extracted_archive_dir,
-                            external_step_bin_dir,
-                            symlinks=True,
-                            ignore=dependency_filter.ignore)
+            link_tree(extracted_archive_dir,
+                      external_step_bin_dir,
+                      ignore=dependency_filter.ignore)
 
             # Each step is a dictionary with fields:
             # - driver (the executable)
@@ -405,7 +692,13 @@ class Command(BaseCommand):
             executable = os.path.join(internal_binary_dir, step["driver"])
             driver_external_path = os.path.join(external_step_bin_dir,
                                                 step["driver"])
-            os.chmod(driver_external_path, 0o777)
+            if not os.access(driver_external_path, os.X_OK):
+                # Change a copy, because the link shares its mode with the
+                # extracted file, and other steps or runs may use it.
+                driver_copy_path = driver_external_path + '.copy'
+                shutil.copyfile(driver_external_path, driver_copy_path)
+                os.chmod(driver_copy_path, 0o777)
+                os.replace(driver_copy_path, driver_external_path)
             input_paths = []
             for input_dict in step["inputs"]:
                 source_step = input_dict["source_step"]
@@ -414,24 +707,21 @@ class Command(BaseCommand):
                 external_path = step_outputs[source_dataset_name]
                 os.link(external_path, os.path.join(external_step_input_dir, input_dict["dataset_name"]))
                 input_paths.append(os.path.join(internal_inputs_dir, input_dict["dataset_name"]))
-            outputs_map = {}
-            output_paths = []
-            for dataset_name in step["outputs"]:
-                file_name = self.build_dataset_name(
-                    run,
-                    "step{}_{}".format(idx, dataset_name))
-                output_paths.append(os.path.join(internal_outputs_dir, file_name))
-                outputs_map[dataset_name] = os.path.join(external_step_output_dir, file_name)
-            file_map.append(outputs_map)
+            output_paths = [
+                os.path.join(internal_outputs_dir, os.path.basename(output_path))
+                for output_path in file_map[idx].values()]
 
             execution_args = [
                 "singularity",
                 "exec",
                 "--contain",
                 "-B",
-                external_step_bin_dir + ':' + internal_binary_dir,
+                external_step_bin_dir + ':' + internal_binary_dir + (
+                    ':ro' if is_bin_read_only else ''),
                 "-B",
-                external_step_input_dir + ':' + internal_inputs_dir,
+                # Inputs may be hard links to stored datasets, so a step must
+                # not change them.
+                external_step_input_dir + ':' + internal_inputs_dir + ':ro',
                 "-B",
                 external_step_output_dir + ':' + internal_outputs_dir,
                 "--pwd",
@@ -450,33 +740,12 @@ class Command(BaseCommand):
             step_stderr_path = os.path.join(log_path, 'step_{}_stderr.txt'.format(idx))
             with open(step_stdout_path, 'w') as step_stdout, \
                     open(step_stderr_path, 'w') as step_stderr:
-                step_return_code = call(all_args,
-                                        stdout=step_stdout,
-                                        stderr=step_stderr,
-                                        env=child_environment)
-            for step_path, main_file in ((step_stdout_path, standard_out),
-                                         (step_stderr_path, standard_err)):
-                log_size = os.stat(step_path).st_size
-                if log_size:
-                    main_file.write(step_header)
-                    with open(step_path) as step_file:
-                        shutil.copyfileobj(step_file, main_file)
-            if step_return_code != 0:
-                final_return_code = step_return_code
-                break
-
-        if final_return_code == 0:
-            # Now rename the outputs.
-            for output in instructions["outputs"]:
-                # This dictionary has fields
-                # - dataset_name
-                # - source (pairs that look like [step_num, output_name])
-                final_output_path = os.path.join(external_outputs_dir, output["dataset_name"])
-                source_step = output["source_step"]
-                source_dataset_name = output["source_dataset_name"]
-                os.link(file_map[source_step][source_dataset_name], final_output_path)
-
-        return final_return_code
+                return_code, usage = call_with_usage(all_args,
+                                                     stdout=step_stdout,
+                                                     stderr=step_stderr,
+                                                     env=child_environment)
+            self.record_usage(phase, usage)
+            return return_code
 
 
 class DependencyFilter:
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0202_alter_containerrun_submit_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='containerrun',
+            name='input_staging',
+            field=models.CharField(blank=True, help_text='How the input files were staged into the sandbox, like hardlink or copy. Lists all strategies used, if mixed.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='input_staging_seconds',
+            field=models.FloatField(blank=True, help_text='How long it took to stage the input files, in seconds.', null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:19
+
+import django.core.validators
+from django.db import migrations, models
+import re
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0203_containerrun_input_staging'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChecksumCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='Absolute path of the file.', max_length=4096, unique=True)),
+                ('device', models.BigIntegerField()),
+                ('inode', models.BigIntegerField()),
+                ('size', models.BigIntegerField(help_text='Size of the file in bytes.')),
+                ('mtime_ns', models.BigIntegerField(help_text='Modification time of the file in nanoseconds.')),
+                ('ctime_ns', models.BigIntegerField(help_text='Status change time of the file in nanoseconds. Only compared when MD5_CACHE_CHECK_CTIME is set, because hard links change it.')),
+                ('md5', models.CharField(max_length=64, validators=[django.core.validators.RegexValidator(message='MD5 checksum is not 32 hex characters', regex=re.compile('^[0-9A-Fa-f]{32}$'))])),
+                ('verify_time', models.DateTimeField(help_text='When the file was last hashed.')),
+                ('hit_count', models.BigIntegerField(default=0, help_text='How many times this entry saved rehashing the file.')),
+            ],
+        ),
+    ]
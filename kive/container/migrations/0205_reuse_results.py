@@ -0,0 +1,36 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:23
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0204_checksumcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='reuse_results',
+            field=models.BooleanField(default=False, help_text='Skip runs in this batch when a completed run already has the same app, containers, and input checksums, and reuse its outputs instead.'),
+        ),
+        migrations.AddField(
+            model_name='containerapp',
+            name='reuse_results',
+            field=models.BooleanField(default=False, help_text='Skip running this app when a completed run already has the same containers and input checksums, and reuse its outputs instead.'),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='input_md5',
+            field=models.CharField(blank=True, db_index=True, help_text="Summary of MD5's for inputs and containers, used to find runs with reusable results.", max_length=64, validators=[django.core.validators.RegexValidator(message='MD5 checksum is not either 32 hex characters or blank', regex=re.compile('(^[0-9A-Fa-f]{32}$)|(^$)'))]),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='reused_run',
+            field=models.ForeignKey(blank=True, help_text="This run's outputs were reused from an earlier run.", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reuses', to='container.containerrun'),
+        ),
+    ]
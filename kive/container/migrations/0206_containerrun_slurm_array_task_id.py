@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0205_reuse_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='containerrun',
+            name='slurm_array_task_id',
+            field=models.IntegerField(blank=True, help_text="Task index, if the run was submitted in a Slurm job array. Then slurm_job_id holds the array's job id.", null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0206_containerrun_slurm_array_task_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlurmPoll',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('poll_time', models.DateTimeField(blank=True, help_text='When the last Slurm state check finished.', null=True)),
+                ('duration', models.FloatField(blank=True, help_text='How many seconds the last Slurm state check took.', null=True)),
+            ],
+        ),
+    ]
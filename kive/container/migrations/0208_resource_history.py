@@ -0,0 +1,53 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0207_slurmpoll'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='containerapp',
+            name='size_from_history',
+            field=models.BooleanField(default=False, help_text='Request memory, CPUs, and time from Slurm based on the resources that recent completed runs used, instead of the fixed threads and memory.'),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='cpu_seconds',
+            field=models.FloatField(blank=True, help_text='Total CPU time used, as reported by Slurm.', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='elapsed_seconds',
+            field=models.FloatField(blank=True, help_text='Wall clock time of the Slurm job.', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='peak_memory',
+            field=models.PositiveIntegerField(blank=True, help_text='Peak memory used, in MB, as reported by Slurm.', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='requested_memory',
+            field=models.PositiveIntegerField(blank=True, help_text='Memory requested from Slurm, in MB (0 requests all).', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='requested_minutes',
+            field=models.PositiveIntegerField(blank=True, help_text='Time limit requested from Slurm, or null for none.', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='requested_threads',
+            field=models.PositiveIntegerField(blank=True, help_text='CPUs requested from Slurm.', null=True),
+        ),
+        migrations.AddField(
+            model_name='containerrun',
+            name='slurm_state',
+            field=models.CharField(blank=True, help_text='Final job state from Slurm, like COMPLETED or OUT_OF_MEMORY. Blank until resource usage is collected.', max_length=30),
+        ),
+    ]
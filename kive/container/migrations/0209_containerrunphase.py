@@ -0,0 +1,35 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0208_resource_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContainerRunPhase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=60)),
+                ('position', models.PositiveIntegerField(help_text='Order that the phases started in.')),
+                ('start_time', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Wall clock time in seconds.')),
+                ('bytes_staged', models.BigIntegerField(blank=True, help_text='Size of the input files staged into the sandbox.', null=True)),
+                ('bytes_hashed', models.BigIntegerField(blank=True, help_text='Bytes read to calculate MD5 checksums.', null=True)),
+                ('max_rss', models.BigIntegerField(blank=True, help_text='Peak memory of the largest child process so far, in kilobytes, if it grew during this phase.', null=True)),
+                ('user_cpu', models.FloatField(blank=True, help_text='Child CPU time in user mode, in seconds.', null=True)),
+                ('system_cpu', models.FloatField(blank=True, help_text='Child CPU time in system mode, in seconds.', null=True)),
+                ('block_input', models.BigIntegerField(blank=True, help_text='Child file system blocks read.', null=True)),
+                ('block_output', models.BigIntegerField(blank=True, help_text='Child file system blocks written.', null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phases', to='container.containerrun')),
+            ],
+            options={
+                'ordering': ('run', 'position'),
+            },
+        ),
+    ]
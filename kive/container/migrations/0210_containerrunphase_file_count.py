@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0209_containerrunphase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='containerrunphase',
+            name='file_count',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of files registered as datasets.', null=True),
+        ),
+    ]
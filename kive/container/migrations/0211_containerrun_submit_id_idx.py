@@ -0,0 +1,17 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0210_containerrunphase_file_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='containerrun',
+            index=models.Index(fields=['submit_time', 'id'], name='containerrun_submit_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0211_containerrun_submit_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slurmpoll',
+            name='claim_time',
+            field=models.DateTimeField(blank=True, help_text='When the Slurm state check in progress started.', null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.10 on 2026-10-17 08:20
+
+from django.db import migrations, models
+
+
+def clear_cache(apps, schema_editor):
+    """ Entries are just hints, so drop them instead of hashing old paths. """
+    ChecksumCache = apps.get_model('container', 'ChecksumCache')
+    ChecksumCache.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0212_slurm_poll_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_cache, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='checksumcache',
+            name='path',
+            field=models.CharField(help_text='Absolute path of the file.', max_length=4096),
+        ),
+        migrations.AddField(
+            model_name='checksumcache',
+            name='path_hash',
+            field=models.CharField(default='', help_text='SHA-256 of the path, as hex digits.', max_length=64, unique=True),
+            preserve_default=False,
+        ),
+    ]
@@ -3,15 +3,15 @@ import errno
 import hashlib
 import json
 import logging
+import math
 import os
 import re
-import sys
 import time
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 from itertools import count
 from pathlib import Path
-from subprocess import STDOUT, CalledProcessError, check_output, check_call
+from subprocess import STDOUT, CalledProcessError, check_output
 import tarfile
 from tarfile import TarFile, TarInfo
 from tempfile import mkdtemp, mkstemp
@@ -34,9 +34,10 @@ from django.dispatch import receiver
 from django.template.defaultfilters import filesizeformat
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_duration
 
 from constants import maxlengths
-from file_access_utils import compute_md5, use_field_file
+from file_access_utils import compute_md5, compute_md5s, use_field_file, link_tree, scan_media_folder
 from metadata.models import AccessControl, empty_removal_plan, remove_helper
 from stopwatch.models import Stopwatch
 import container.deffile as deffile
@@ -54,6 +55,48 @@ NUM_RETRY = settings.SLURM_COMMAND_RETRY_NUM
 SLEEP_SECS = settings.SLURM_COMMAND_RETRY_SLEEP_SECS
 
 
+def find_percentile(values, percent):
+    """ Nearest-rank percentile of a list of numbers, or None if empty. """
+    if not values:
+        return None
+    sorted_values = sorted(values)
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def parse_slurm_duration(text):
+    """ Convert a Slurm duration like 1-02:03:04 or 05:06.789 to seconds.
+
+    :return: the number of seconds, or None if it's blank or not a duration.
+    """
+    days, _, clock = text.rpartition('-')
+    try:
+        seconds = 0.0
+        for part in clock.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds + int(days or 0) * 24 * 60 * 60
+    except ValueError:
+        return None
+
+
+def parse_slurm_memory(text):
+    """ Convert a Slurm memory size like 123.45M to whole megabytes.
+
+    :return: the number of megabytes, or None if it's blank.
+    """
+    if not text:
+        return None
+    # Older versions of Slurm add n or c for per node or per CPU.
+    text = text.rstrip('nc')
+    unit_scales = dict(K=1 / 1024, M=1, G=1024, T=1024 * 1024)
+    scale = unit_scales.get(text[-1].upper())
+    if scale is None:
+        scale = 1 / 1024 / 1024  # No units, so it's bytes.
+    else:
+        text = text[:-1]
+    return math.ceil(float(text) * scale)
+
+
 def multi_check_output(cmd_lst, stderr=None, env=None, num_retry=NUM_RETRY):
     """ Perform a check_output command multiples times.
     We use this routine when calling slurm commands to counter time-outs under
@@ -228,6 +271,8 @@ def is_driver(archive, info):
 
 class Container(AccessControl):
     UPLOAD_DIR = "Containers"
+    CACHE_SIZE_SUFFIX = '.size'
+    CACHE_REMOVED_SUFFIX = '.removed'
 
     SIMG = "SIMG"
     ZIP = "ZIP"
@@ -433,10 +478,11 @@ class Container(AccessControl):
     def validate_md5(self):
         """
         Compute the MD5 and check that it is as expected.
+
+        Uses the checksum cache, so an unchanged file isn't always rehashed.
         :return:
         """
-        with self.file:
-            current_md5 = compute_md5(self.file)
+        current_md5 = ChecksumCache.compute_md5(self.file.path)
         if current_md5 != self.md5:
             raise ValueError(
                 "Container {} file MD5 has changed (original {}, current {})".format(self, self.md5, current_md5)
@@ -477,6 +523,122 @@ class Container(AccessControl):
                 new_name = os.path.join(extraction_path, 'kive', 'pipeline.json')
                 os.rename(old_name, new_name)
 
+    def extract_archive_cached(self, extraction_path):
+        """ Make this child container's contents available at a path.
+
+        Links to the files in the extraction cache when it's enabled, or
+        extracts them directly when it's not. Linked files are read-only,
+        because other runs share them.
+        :param extraction_path: where to put the contents, must not exist yet
+        :return: True if the files are linked from the cache, so nothing may
+            change them, otherwise False
+        """
+        if settings.CONTAINER_CACHE_MAX_SIZE:
+            try:
+                cache_path = self.get_cached_extraction()
+                link_tree(cache_path, extraction_path)
+                return True
+            except OSError:
+                # Probably evicted by another process, so just extract it.
+                logger.warning('Extraction cache failed for container %d.',
+                               self.pk,
+                               exc_info=True)
+                shutil.rmtree(extraction_path, ignore_errors=True)
+        os.makedirs(extraction_path)
+        self.extract_archive(extraction_path)
+        return False
+
+    def get_cached_extraction(self):
+        """ Find or create a shared extraction of this child container.
+
+        The folder is named after the container's MD5, so it's only
+        extracted once. It's extracted to a temporary folder first, then
+        renamed, so nobody sees a partial extraction.
+        :return: the path to the extracted folder. Its files are read-only,
+            and it's only safe to use until the next eviction.
+        """
+        cache_root = settings.CONTAINER_CACHE_ROOT
+        cache_path = os.path.join(cache_root, self.md5)
+        if os.path.isdir(cache_path):
+            # Record the use for least-recently-used eviction.
+            os.utime(cache_path)
+            return cache_path
+        os.makedirs(cache_root, exist_ok=True)
+        temp_path = mkdtemp(prefix=self.md5 + '.', suffix='.tmp', dir=cache_root)
+        try:
+            self.extract_archive(temp_path)
+            cache_size = self.make_read_only(temp_path)
+            with open(cache_path + self.CACHE_SIZE_SUFFIX, 'w') as f:
+                f.write(str(cache_size))
+            os.rename(temp_path, cache_path)
+        except OSError:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.isdir(cache_path):
+                raise
+            # Another process finished the same extraction first.
+        self.evict_cached_extractions(keep=cache_path)
+        return cache_path
+
+    @staticmethod
+    def make_read_only(folder_path):
+        """ Make all files in a cached extraction read-only and executable.
+
+        Steps link to these files, so they must not change them.
+        :return: the total size of the files
+        """
+        total_size = 0
+        for dir_path, _, file_names in os.walk(folder_path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if not os.path.islink(file_path):
+                    os.chmod(file_path, 0o555)
+                    total_size += os.stat(file_path).st_size
+        return total_size
+
+    @classmethod
+    def evict_cached_extractions(cls, keep=None):
+        """ Remove least recently used extractions until the cache fits.
+
+        Also finishes removing any folders that were left behind when a
+        process crashed while removing them.
+        :param keep: a cache folder that shouldn't be removed
+        """
+        max_size = settings.CONTAINER_CACHE_MAX_SIZE * 1024 * 1024
+        cache_root = settings.CONTAINER_CACHE_ROOT
+        entries = []
+        for size_entry in os.scandir(cache_root):
+            if size_entry.name.endswith(cls.CACHE_REMOVED_SUFFIX):
+                shutil.rmtree(size_entry.path, ignore_errors=True)
+                continue
+            if not size_entry.name.endswith(cls.CACHE_SIZE_SUFFIX):
+                continue
+            cache_path = size_entry.path[:-len(cls.CACHE_SIZE_SUFFIX)]
+            try:
+                with open(size_entry.path) as f:
+                    cache_size = int(f.read())
+                used_time = os.stat(cache_path).st_mtime
+            except (OSError, ValueError):
+                continue  # Being populated or removed by another process.
+            entries.append((used_time, cache_path, cache_size))
+        entries.sort()
+        total_size = sum(cache_size for _, _, cache_size in entries)
+        for used_time, cache_path, cache_size in entries:
+            if total_size <= max_size:
+                break
+            if cache_path == keep:
+                continue
+            # Rename first, so other processes see it disappear all at once.
+            removed_path = '{}.{}{}'.format(cache_path,
+                                            os.getpid(),
+                                            cls.CACHE_REMOVED_SUFFIX)
+            try:
+                os.rename(cache_path, removed_path)
+            except OSError:
+                continue
+            os.remove(cache_path + cls.CACHE_SIZE_SUFFIX)
+            shutil.rmtree(removed_path, ignore_errors=True)
+            total_size -= cache_size
+
     @contextmanager
     def open_content(self, mode='r'):
         if mode == 'r':
@@ -698,15 +860,13 @@ class Container(AccessControl):
         remove_helper(removal_plan)
 
     @classmethod
-    def scan_file_names(cls):
-        """ Yield all file names, relative to MEDIA_ROOT. """
-        relative_root = Container.UPLOAD_DIR
-        absolute_root = os.path.join(settings.MEDIA_ROOT, relative_root)
-        if not os.path.exists(absolute_root):
-            return
+    def scan_file_names(cls, manifest=None):
+        """ Yield all file names, relative to MEDIA_ROOT.
 
-        for file_name in os.listdir(absolute_root):
-            yield os.path.join(relative_root, file_name)
+        :param ScanManifest manifest: skips the scan if the folder hasn't
+            changed since the last scan
+        """
+        return scan_media_folder(Container.UPLOAD_DIR, manifest=manifest)
 
 
 class ZipHandler:
@@ -782,6 +942,16 @@ class ContainerApp(models.Model):
         help_text="Megabytes of memory Slurm will allocate for this app "
                   "(0 allocates all memory)",
         default=6000)
+    reuse_results = models.BooleanField(
+        default=False,
+        help_text="Skip running this app when a completed run already has "
+                  "the same containers and input checksums, and reuse its "
+                  "outputs instead.")
+    size_from_history = models.BooleanField(
+        default=False,
+        help_text="Request memory, CPUs, and time from Slurm based on the "
+                  "resources that recent completed runs used, instead of "
+                  "the fixed threads and memory.")
     arguments = None  # Filled in later from child table.
     runs = None  # Filled in later from child table.
     objects = None  # Filled in later by Django.
@@ -789,6 +959,36 @@ class ContainerApp(models.Model):
     class Meta:
         ordering = ('-container_id', 'name',)
 
+    def get_resource_stats(self):
+        """ Summarize the resources used by recent completed runs.
+
+        :return: a dict with run_count, and percentiles of memory_mb (peak
+            memory), cpus (average CPUs kept busy), and elapsed_seconds.
+        """
+        runs = self.runs.filter(
+            state=ContainerRun.COMPLETE,
+            peak_memory__isnull=False,
+            cpu_seconds__isnull=False,
+            elapsed_seconds__isnull=False).order_by('-end_time')
+        usage = list(runs.values_list('peak_memory',
+                                      'cpu_seconds',
+                                      'elapsed_seconds')[
+                     :settings.RESOURCE_HISTORY_SIZE])
+        memory_values = [memory for memory, _, _ in usage]
+        cpu_values = [cpu_seconds / elapsed_seconds if elapsed_seconds else 0
+                      for _, cpu_seconds, elapsed_seconds in usage]
+        elapsed_values = [elapsed_seconds for _, _, elapsed_seconds in usage]
+        percentiles = (50, settings.RESOURCE_HISTORY_PERCENTILE)
+        stats = dict(run_count=len(usage))
+        for name, values in (('memory_mb', memory_values),
+                             ('cpus', cpu_values),
+                             ('elapsed_seconds', elapsed_values)):
+            summary = {'p{}'.format(percent): find_percentile(values, percent)
+                       for percent in percentiles}
+            summary['max'] = max(values, default=None)
+            stats[name] = summary
+        return stats
+
     @property
     def display_name(self):
         name = self.container.display_name
@@ -986,6 +1186,11 @@ class Batch(AccessControl):
     description = models.TextField(
         max_length=maxlengths.MAX_DESCRIPTION_LENGTH,
         blank=True)
+    reuse_results = models.BooleanField(
+        default=False,
+        help_text="Skip runs in this batch when a completed run already has "
+                  "the same app, containers, and input checksums, and reuse "
+                  "its outputs instead.")
 
     runs = None  # Filled in later by Django.
 
@@ -1045,6 +1250,17 @@ class ContainerRun(Stopwatch, AccessControl):
     ]
     SANDBOX_ROOT = os.path.join(settings.MEDIA_ROOT, 'ContainerRuns')
 
+    # Slurm job states, from the sacct documentation.
+    SLURM_OUT_OF_MEMORY = 'OUT_OF_MEMORY'
+    SLURM_TIMEOUT = 'TIMEOUT'
+    SLURM_UNFINISHED_STATES = ('PENDING',
+                               'RUNNING',
+                               'REQUEUED',
+                               'RESIZING',
+                               'SUSPENDED',
+                               'COMPLETING')
+    STATS_COLLECTION_DAYS = 7
+
     app = models.ForeignKey(ContainerApp,
                             related_name="runs",
                             on_delete=models.CASCADE)
@@ -1066,6 +1282,11 @@ class ContainerRun(Stopwatch, AccessControl):
         max_length=maxlengths.MAX_EXTERNAL_PATH_LENGTH,
         blank=True)  # type: str
     slurm_job_id = models.IntegerField(blank=True, null=True)
+    slurm_array_task_id = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Task index, if the run was submitted in a Slurm job array. "
+                  "Then slurm_job_id holds the array's job id.")
     return_code = models.IntegerField(blank=True, null=True)
     stopped_by = models.ForeignKey(User,
                                    help_text="User that stopped this run",
@@ -1100,12 +1321,68 @@ class ContainerRun(Stopwatch, AccessControl):
             message="MD5 checksum is not either 32 hex characters or blank")],
         blank=True,
         help_text="Summary of MD5's for inputs, outputs, and containers.")
+    input_md5 = models.CharField(
+        max_length=64,
+        validators=[RegexValidator(
+            regex=re.compile("(^[0-9A-Fa-f]{32}$)|(^$)"),
+            message="MD5 checksum is not either 32 hex characters or blank")],
+        blank=True,
+        db_index=True,
+        help_text="Summary of MD5's for inputs and containers, used to find "
+                  "runs with reusable results.")
+    reused_run = models.ForeignKey(
+        'ContainerRun',
+        help_text="This run's outputs were reused from an earlier run.",
+        null=True,
+        blank=True,
+        related_name="reuses",
+        on_delete=models.SET_NULL)
     is_warned = models.BooleanField(
         default=False,
         help_text="True if a warning was logged because the Slurm job failed.")
+    input_staging = models.CharField(
+        max_length=100,
+        blank=True,
+        help_text="How the input files were staged into the sandbox, like "
+                  "hardlink or copy. Lists all strategies used, if mixed.")
+    input_staging_seconds = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="How long it took to stage the input files, in seconds.")
+    slurm_state = models.CharField(
+        max_length=30,
+        blank=True,
+        help_text="Final job state from Slurm, like COMPLETED or "
+                  "OUT_OF_MEMORY. Blank until resource usage is collected.")
+    peak_memory = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Peak memory used, in MB, as reported by Slurm.")
+    cpu_seconds = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Total CPU time used, as reported by Slurm.")
+    elapsed_seconds = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Wall clock time of the Slurm job.")
+    requested_threads = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="CPUs requested from Slurm.")
+    requested_memory = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Memory requested from Slurm, in MB (0 requests all).")
+    requested_minutes = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Time limit requested from Slurm, or null for none.")
 
     class Meta:
         ordering = ('-submit_time',)
+        indexes = [models.Index(fields=['submit_time', 'id'],
+                                name='containerrun_submit_id_idx')]
 
     def __str__(self):
         return self.name or 'Container run {}'.format(self.pk)
@@ -1167,51 +1444,177 @@ class ContainerRun(Stopwatch, AccessControl):
             return ''
         return os.path.join(settings.MEDIA_ROOT, self.sandbox_path)
 
-    def create_sandbox(self, prefix=None):
+    @property
+    def slurm_job_key(self):
+        """ The job id that Slurm commands expect, including any array task.
+        """
+        if self.slurm_job_id is None:
+            return None
+        if self.slurm_array_task_id is None:
+            return str(self.slurm_job_id)
+        return '{}_{}'.format(self.slurm_job_id, self.slurm_array_task_id)
+
+    def create_sandbox(self, prefix=None, name=None):
+        """ Create the sandbox folder.
+
+        :param prefix: start of a random folder name
+        :param name: exact folder name to use instead of a random one
+        """
         sandbox_root = self.SANDBOX_ROOT
         try:
             os.mkdir(sandbox_root)
         except OSError as ex:
             if ex.errno != errno.EEXIST:
                 raise
-        if prefix is None:
-            prefix = 'user{}_run{}_'.format(self.user.username, self.pk)
-        full_sandbox_path = mkdtemp(prefix=prefix, dir=sandbox_root)
+        if name is not None:
+            full_sandbox_path = os.path.join(sandbox_root, name)
+            os.mkdir(full_sandbox_path)
+        else:
+            if prefix is None:
+                prefix = 'user{}_run{}_'.format(self.user.username, self.pk)
+            full_sandbox_path = mkdtemp(prefix=prefix, dir=sandbox_root)
         os.mkdir(os.path.join(full_sandbox_path, 'logs'))
         self.sandbox_path = os.path.relpath(full_sandbox_path, settings.MEDIA_ROOT)
 
     def schedule(self, dependencies=None):
         try:
-            dependency_job_ids = []
+            executor = self.get_executor()
+            if (not dependencies and
+                    self.batch_id is not None and
+                    settings.SLURM_ARRAYS and
+                    executor.can_submit_arrays):
+                # Checks for reusable results while claiming the runs.
+                self.schedule_array(executor)
+                return
+            if self.reuse_results():
+                return
+            dependency_runs = []
             if dependencies:
                 for source_run_id, source_dependencies in dependencies.items():
                     source_run = ContainerRun.objects.get(id=source_run_id)
                     source_run.schedule(source_dependencies)
-                    dependency_job_ids.append(source_run.slurm_job_id)
+                    dependency_runs.append(source_run)
             self.create_sandbox()
             self.save()
 
-            child_env = dict(os.environ)
-            extra_path = settings.SLURM_PATH
-            if extra_path is not None:
-                old_system_path = child_env['PATH']
-                system_path = extra_path + os.pathsep + old_system_path
-                child_env['PATH'] = system_path
-            child_env['PYTHONPATH'] = os.pathsep.join(sys.path)
-            child_env.pop('KIVE_LOG', None)
-            output = multi_check_output(self.build_slurm_command(settings.SLURM_QUEUES,
-                                                                 dependency_job_ids),
-                                        env=child_env)
-
-            self.slurm_job_id = int(output)
-            # It's just possible the slurm job has already started modifying the
-            # run, so only update one field.
-            self.save(update_fields=['slurm_job_id'])
+            executor.submit(self, dependency_runs)
         except Exception:
             self.state = self.FAILED
             self.save(update_fields=['state'])
             raise
 
+    @staticmethod
+    def get_executor():
+        """ Get the executor that launches runs, chosen by settings. """
+        # Imported here, because the executors depend on this module.
+        from container.executors import get_executor
+        return get_executor()
+
+    def claim_array_runs(self):
+        """ Claim this run and its unscheduled siblings for a job array.
+
+        Siblings are new runs in the same batch with the same app and
+        priority, so they can share one set of Slurm options. Each claimed
+        run gets a sandbox named after its array task.
+        :return: a list of the claimed runs, possibly empty if another
+            process already claimed this run.
+        """
+        with transaction.atomic():
+            siblings = ContainerRun.objects.select_for_update(
+                skip_locked=True).filter(
+                batch_id=self.batch_id,
+                app_id=self.app_id,
+                priority=self.priority,
+                state=ContainerRun.NEW,
+                sandbox_path='',
+                original_run=None).order_by('id')
+            runs = [run for run in siblings if not run.reuse_results()]
+            if self.pk not in {run.pk for run in runs}:
+                return []
+            max_size = settings.SLURM_ARRAY_MAX_SIZE
+            for chunk_start in range(0, len(runs), max_size):
+                chunk = runs[chunk_start:chunk_start + max_size]
+                prefix = chunk[0].get_array_sandbox_prefix()
+                for task_id, run in enumerate(chunk):
+                    run.create_sandbox(name=prefix + str(task_id))
+                    run.slurm_array_task_id = task_id
+                    run.save(update_fields=['sandbox_path',
+                                            'slurm_array_task_id'])
+        return runs
+
+    def schedule_array(self, executor):
+        """ Submit this run and its siblings as job arrays. """
+        runs = self.claim_array_runs()
+        executor.submit_array(runs)
+        if self.pk in {run.pk for run in runs}:
+            self.refresh_from_db(fields=['sandbox_path',
+                                         'slurm_job_id',
+                                         'slurm_array_task_id'])
+
+    def get_array_sandbox_prefix(self):
+        """ Sandbox name for each task is this prefix plus the task id. """
+        return 'user{}_batch{}_run{}_task'.format(self.user.username,
+                                                  self.batch_id,
+                                                  self.pk)
+
+    def is_reuse_enabled(self):
+        return self.app.reuse_results or (self.batch is not None and
+                                          self.batch.reuse_results)
+
+    def find_reusable_run(self):
+        """ Find a completed run that had the same app and inputs.
+
+        Only considers runs this run's user can access, and whose outputs
+        haven't been purged.
+        :return: the most recent matching run, or None
+        """
+        candidates = ContainerRun.filter_by_user(self.user).filter(
+            state=ContainerRun.COMPLETE,
+            input_md5=self.input_md5,
+            app_id=self.app_id,
+            reused_run=None).exclude(pk=self.pk).order_by('-end_time')
+        for candidate in candidates[:10]:
+            output_entries = candidate.datasets.filter(
+                argument__type=ContainerArgument.OUTPUT).select_related(
+                'dataset')
+            if all(not entry.dataset.is_purged for entry in output_entries):
+                return candidate
+        return None
+
+    @transaction.atomic
+    def reuse_results(self):
+        """ Link the outputs from a matching run instead of running again.
+
+        Reruns are never reused, because they check that a run can be
+        reproduced.
+        :return: True if results were reused, otherwise False.
+        """
+        if self.original_run is not None or not self.is_reuse_enabled():
+            return False
+        self.set_md5()
+        source_run = self.find_reusable_run()
+        if source_run is None:
+            return False
+        output_entries = source_run.datasets.filter(
+            argument__type=ContainerArgument.OUTPUT)
+        ContainerDataset.objects.bulk_create(
+            ContainerDataset(run=self,
+                             argument_id=entry.argument_id,
+                             dataset_id=entry.dataset_id,
+                             multi_position=entry.multi_position)
+            for entry in output_entries)
+        self.logs.create(
+            type=ContainerLog.STDOUT,
+            short_text='Reused results from container run {}.\n'.format(
+                source_run.pk))
+        self.set_md5()
+        self.reused_run = source_run
+        self.state = ContainerRun.COMPLETE
+        self.return_code = source_run.return_code
+        self.start_time = self.end_time = timezone.now()
+        self.save(schedule=False)
+        return True
+
     def build_slurm_command(self, slurm_queues=None, dependency_job_ids=None):
         """Build a list of strings representing a slurm command"""
         if not self.sandbox_path:
@@ -1224,13 +1627,13 @@ class ContainerRun(Stopwatch, AccessControl):
         job_name = 'r{} {}'.format(self.pk,
                                    self.app.name or
                                    self.app.container.family.name)
+        self.plan_resources()
         command = ['sbatch',
                    '-J', job_name,
                    '--parsable',
                    '--output', slurm_prefix + 'stdout.txt',
-                   '--error', slurm_prefix + 'stderr.txt',
-                   '-c', str(self.app.threads),
-                   '--mem', str(self.app.memory)]
+                   '--error', slurm_prefix + 'stderr.txt']
+        command.extend(self.build_resource_options())
         if slurm_queues is not None:
             kive_name, slurm_name = slurm_queues[self.priority]
             command.extend(['-p', slurm_name])
@@ -1241,6 +1644,83 @@ class ContainerRun(Stopwatch, AccessControl):
         command.extend([MANAGE_PY_FULLPATH, 'runcontainer', str(self.pk)])
         return command
 
+    @classmethod
+    def build_slurm_array_command(cls, runs, slurm_queues=None):
+        """ Build a slurm command that runs a list of similar runs.
+
+        All runs must have the same app and priority, and their sandboxes
+        must be named with the first run's array sandbox prefix.
+        """
+        first_run = runs[0]
+        if not first_run.sandbox_path:
+            raise RuntimeError(
+                'Container runs need sandboxes before calling Slurm.')
+        slurm_prefix = os.path.join(cls.SANDBOX_ROOT,
+                                    first_run.get_array_sandbox_prefix() + '%a',
+                                    'logs',
+                                    'job%A_%a_node%N_')
+        job_name = 'b{} {}'.format(first_run.batch_id,
+                                   first_run.app.name or
+                                   first_run.app.container.family.name)
+        first_run.plan_resources()
+        command = ['sbatch',
+                   '-J', job_name,
+                   '--parsable',
+                   '--array', '0-{}'.format(len(runs) - 1),
+                   '--output', slurm_prefix + 'stdout.txt',
+                   '--error', slurm_prefix + 'stderr.txt']
+        command.extend(first_run.build_resource_options())
+        if slurm_queues is not None:
+            kive_name, slurm_name = slurm_queues[first_run.priority]
+            command.extend(['-p', slurm_name])
+        command.extend([MANAGE_PY_FULLPATH,
+                        'runcontainer',
+                        '--array_ids',
+                        ','.join(str(run.pk) for run in runs)])
+        return command
+
+    def plan_resources(self):
+        """ Choose the CPUs, memory, and time limit to request from Slurm.
+
+        Uses the app's fixed settings, unless it sizes requests from the
+        history of completed runs. A rerun of a job that ran out of memory
+        or time gets double what the original requested.
+        Note that this does not save the run.
+        """
+        app = self.app
+        threads = app.threads
+        memory = app.memory
+        minutes = None
+        if app.size_from_history:
+            stats = app.get_resource_stats()
+            if stats['run_count'] >= settings.RESOURCE_HISTORY_MIN_RUNS:
+                key = 'p{}'.format(settings.RESOURCE_HISTORY_PERCENTILE)
+                scale = 1 + settings.RESOURCE_HISTORY_MARGIN
+                history_memory = math.ceil(stats['memory_mb'][key] * scale)
+                memory = min(memory, history_memory) if memory else history_memory
+                history_threads = math.ceil(stats['cpus'][key] * scale)
+                threads = max(1, min(threads, history_threads))
+                minutes = max(settings.RESOURCE_HISTORY_MIN_MINUTES,
+                              math.ceil(stats['elapsed_seconds'][key] * scale / 60))
+        original_run = self.original_run
+        if original_run is not None:
+            if (original_run.slurm_state == self.SLURM_OUT_OF_MEMORY and
+                    original_run.requested_memory and memory):
+                memory = max(memory, original_run.requested_memory * 2)
+            if (original_run.slurm_state == self.SLURM_TIMEOUT and
+                    original_run.requested_minutes):
+                minutes = max(minutes or 0, original_run.requested_minutes * 2)
+        self.requested_threads = threads
+        self.requested_memory = memory
+        self.requested_minutes = minutes
+
+    def build_resource_options(self):
+        options = ['-c', str(self.requested_threads),
+                   '--mem', str(self.requested_memory)]
+        if self.requested_minutes is not None:
+            options.extend(['--time', str(self.requested_minutes)])
+        return options
+
     def create_inputs_from_original_run(self):
         """ Create input datasets by copying original run.
 
@@ -1277,8 +1757,8 @@ class ContainerRun(Stopwatch, AccessControl):
                                            stopped_by=user,
                                            end_time=end_time)
         if rows_updated == 0:
-            # Run has already started. Must call scancel.
-            check_call(['scancel', '-f', str(self.slurm_job_id)])
+            # Run has already started. Must ask the executor to stop it.
+            self.get_executor().cancel(self)
             self.state = ContainerRun.CANCELLED
             self.stopped_by = user
             self.end_time = end_time
@@ -1295,6 +1775,9 @@ class ContainerRun(Stopwatch, AccessControl):
             raise ValueError(
                 'ContainerRun id {} is still active.'.format(self.pk))
         removal_plan["ContainerRuns"].add(self)
+        if self.reused_run_id is not None:
+            # Outputs belong to the reused run.
+            return removal_plan
 
         for run_dataset in self.datasets.all():
             if run_dataset.argument.type == ContainerArgument.OUTPUT:
@@ -1345,48 +1828,67 @@ class ContainerRun(Stopwatch, AccessControl):
             sandbox_path='')
 
     @classmethod
-    def scan_file_names(cls):
-        """ Yield all file names, relative to MEDIA_ROOT. """
+    def scan_file_names(cls, manifest=None):
+        """ Yield all file names, relative to MEDIA_ROOT.
+
+        :param ScanManifest manifest: skips the scan if the folder hasn't
+            changed since the last scan
+        """
         relative_root = os.path.relpath(ContainerRun.SANDBOX_ROOT,
                                         settings.MEDIA_ROOT)
-        if not os.path.exists(ContainerRun.SANDBOX_ROOT):
-            return
-
-        for file_name in os.listdir(ContainerRun.SANDBOX_ROOT):
-            yield os.path.join(relative_root, file_name)
+        return scan_media_folder(relative_root, manifest=manifest)
 
     @classmethod
     def check_slurm_state(cls, pk=None):
-        """ Check active runs to make sure their Slurm jobs haven't died.
+        """ Check Slurm jobs with a single sacct call.
 
+        Active runs are checked to make sure their Slurm jobs haven't died,
+        and recently finished runs get their resource usage recorded.
         :param pk: a run id to check, or None if all active runs should be
-            checked.
+            checked, as well as finished runs that need usage.
         """
         runs = cls.objects.filter(state__in=cls.ACTIVE_STATES).only(
             'state',
             'end_time',
-            'slurm_job_id')
+            'slurm_job_id',
+            'slurm_array_task_id')
         if pk is not None:
             runs = runs.filter(pk=pk)
-        job_runs = {str(run.slurm_job_id): run
+        job_runs = {run.slurm_job_key: run
                     for run in runs
                     if run.slurm_job_id is not None}
-        if not job_runs:
+        stats_runs = {} if pk is not None else cls.find_slurm_stats_runs()
+        if not (job_runs or stats_runs):
             # No jobs to check.
             return
-        job_id_text = ','.join(job_runs)
+        job_id_text = ','.join(list(job_runs) + list(stats_runs))
         output = multi_check_output(['sacct',
                                      '-j', job_id_text,
-                                     '-o', 'jobid,end',
+                                     '-o', 'jobid,end,state,maxrss,totalcpu,elapsed,reqmem',
                                      '--noheader',
-                                     '--parsable2'])
+                                     '--parsable2',
+                                     '--units=M'])
+        rows = [line.split('|') for line in output.splitlines()]
+        cls.fail_ended_runs(job_runs, rows)
+        try:
+            cls.record_slurm_stats(stats_runs, rows)
+        except Exception:
+            # Resource usage is only advice, so don't stop checking states.
+            logger.warning('Recording Slurm stats failed.', exc_info=True)
+
+    @classmethod
+    def fail_ended_runs(cls, job_runs, rows):
+        """ Fail active runs whose Slurm jobs ended without updating Kive.
+
+        :param job_runs: {job_key: run} for active runs
+        :param rows: sacct rows, as lists of fields
+        """
         slurm_date_format = '%Y-%m-%dT%H:%M:%S'
         warn_end_time = datetime.now() - timedelta(minutes=1)
         max_end_time = warn_end_time - timedelta(minutes=14)
         warn_end_time_text = warn_end_time.strftime(slurm_date_format)
         max_end_time_text = max_end_time.strftime(slurm_date_format)
-        for line in output.splitlines():
-            job_id, end_time = line.split('|')
+        for job_id, end_time, *_ in rows:
             if end_time > warn_end_time_text:
                 continue
             run = job_runs.get(job_id)
@@ -1415,8 +1917,67 @@ class ContainerRun(Stopwatch, AccessControl):
                     if log_matches:
                         run.load_log(log_matches[0], ContainerLog.STDERR)
 
+    @classmethod
+    def find_slurm_stats_runs(cls):
+        """ Find recently finished runs that still need resource usage.
+
+        Runs are checked until Slurm reports a final state, or until they
+        are older than STATS_COLLECTION_DAYS.
+        :return: {job_key: run}
+        """
+        min_end_time = timezone.now() - timedelta(days=cls.STATS_COLLECTION_DAYS)
+        runs = cls.objects.filter(
+            slurm_state='',
+            slurm_job_id__isnull=False,
+            end_time__gte=min_end_time).exclude(
+            state__in=cls.ACTIVE_STATES).only(
+            'slurm_job_id',
+            'slurm_array_task_id',
+            'slurm_state',
+            'peak_memory',
+            'cpu_seconds',
+            'elapsed_seconds',
+            'requested_memory')
+        return {run.slurm_job_key: run for run in runs}
+
+    @classmethod
+    def record_slurm_stats(cls, job_runs, rows):
+        """ Record resource usage from Slurm for finished runs.
+
+        :param job_runs: {job_key: run} from find_slurm_stats_runs()
+        :param rows: sacct rows, as lists of fields
+        """
+        for job_id, _, state, max_rss, total_cpu, elapsed, req_mem in rows:
+            job_key, _, step_name = job_id.partition('.')
+            run = job_runs.get(job_key)
+            if run is None:
+                continue
+            if not step_name:
+                # Cancelled states look like "CANCELLED by 1234".
+                state = state.split(' ')[0]
+                if state not in cls.SLURM_UNFINISHED_STATES:
+                    run.slurm_state = state
+                run.cpu_seconds = parse_slurm_duration(total_cpu)
+                run.elapsed_seconds = parse_slurm_duration(elapsed)
+                if run.requested_memory is None:
+                    # Submitted before Kive recorded its requests.
+                    run.requested_memory = parse_slurm_memory(req_mem)
+            # Memory is only reported for each step of the job.
+            step_memory = parse_slurm_memory(max_rss)
+            if step_memory is not None:
+                run.peak_memory = max(run.peak_memory or 0, step_memory)
+        finished_runs = [run for run in job_runs.values() if run.slurm_state]
+        cls.objects.bulk_update(finished_runs, ['slurm_state',
+                                                'peak_memory',
+                                                'cpu_seconds',
+                                                'elapsed_seconds',
+                                                'requested_memory'])
+
     def set_md5(self):
-        """ Set this run's md5.  Note that this does not save the run. """
+        """ Set this run's md5 and input_md5.
+
+        Note that this does not save the run.
+        """
         encoding = 'utf8'
         md5gen = hashlib.md5()
         container = self.app.container
@@ -1428,13 +1989,102 @@ class ContainerRun(Stopwatch, AccessControl):
             md5gen.update(parent_md5)
 
         # Use explict sort order, so changes to default don't invalidate MD5's.
+        input_md5gen = None
         for container_dataset in self.datasets.order_by('argument__type',
                                                         'argument__position',
-                                                        'argument__name'):
+                                                        'argument__name',
+                                                        'multi_position'):
+            if (input_md5gen is None and
+                    container_dataset.argument.type == ContainerArgument.OUTPUT):
+                input_md5gen = md5gen.copy()
             dataset = container_dataset.dataset
             dataset_md5 = dataset.MD5_checksum.encode(encoding)
             md5gen.update(dataset_md5)
+        if input_md5gen is None:
+            input_md5gen = md5gen
         self.md5 = md5gen.hexdigest()
+        self.input_md5 = input_md5gen.hexdigest()
+
+
+class SlurmPoll(models.Model):
+    """ Records when the Slurm states of active runs were last checked.
+
+    There's only one record. A process briefly locks it to claim the next
+    check, then calls sacct without holding any lock or transaction, so only
+    one process checks at a time. Everyone else just reads poll_time.
+    """
+    SINGLETON_ID = 1
+    # A claim this old belongs to a process that died while checking.
+    CLAIM_TIMEOUT = timedelta(minutes=30)
+
+    poll_time = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the last Slurm state check finished.")
+    duration = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="How many seconds the last Slurm state check took.")
+    claim_time = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the Slurm state check in progress started.")
+
+    objects = None  # Filled in later by Django.
+
+    @classmethod
+    def get_poll_time(cls):
+        return cls.objects.filter(pk=cls.SINGLETON_ID).values_list(
+            'poll_time',
+            flat=True).first()
+
+    @classmethod
+    def claim(cls, start_time, max_age):
+        """ Claim the next check, unless it isn't due or someone else has it.
+
+        :return: True if this process should check the states.
+        """
+        cls.objects.get_or_create(pk=cls.SINGLETON_ID)
+        with transaction.atomic():
+            poll = cls.objects.select_for_update(skip_locked=True).filter(
+                pk=cls.SINGLETON_ID).first()
+            if poll is None:
+                return False  # Another process is claiming.
+            if (poll.poll_time is not None and
+                    start_time - poll.poll_time < max_age):
+                return False
+            if (poll.claim_time is not None and
+                    start_time - poll.claim_time < cls.CLAIM_TIMEOUT):
+                return False  # Another process is checking.
+            poll.claim_time = start_time
+            poll.save(update_fields=['claim_time'])
+        return True
+
+    @classmethod
+    def refresh(cls, max_age=None):
+        """ Check Slurm states, unless it was done recently.
+
+        If another process is already checking, don't wait for it.
+        :param max_age: a timedelta, skip the check if the last one finished
+            more recently than this. Defaults to SLURM_POLL_INTERVAL.
+        :return: True if this call checked the states, otherwise False.
+        """
+        if max_age is None:
+            max_age = timedelta(seconds=settings.SLURM_POLL_INTERVAL)
+        start_time = timezone.now()
+        if not cls.claim(start_time, max_age):
+            return False
+        polls = cls.objects.filter(pk=cls.SINGLETON_ID)
+        try:
+            ContainerRun.get_executor().check_states()
+        except Exception:
+            polls.update(claim_time=None)
+            raise
+        poll_time = timezone.now()
+        polls.update(poll_time=poll_time,
+                     duration=(poll_time - start_time).total_seconds(),
+                     claim_time=None)
+        return True
 
 
 class ContainerDataset(models.Model):
@@ -1481,7 +2131,8 @@ class ContainerDataset(models.Model):
             return self.dataset, None
 
         output_container_dataset = self.dataset.containers.get(
-            argument__type=ContainerArgument.OUTPUT)
+            argument__type=ContainerArgument.OUTPUT,
+            run__reused_run=None)
         output_argument = output_container_dataset.argument
         for rerun in output_container_dataset.run.reruns.all():
             rerun_container_dataset = rerun.datasets.get(argument=output_argument)
@@ -1582,12 +2233,263 @@ class ContainerLog(models.Model):
                     log_size=None)  # new log
 
     @classmethod
-    def scan_file_names(cls):
-        """ Yield all file names, relative to MEDIA_ROOT. """
-        relative_root = ContainerLog.UPLOAD_DIR
-        absolute_root = os.path.join(settings.MEDIA_ROOT, relative_root)
-        if not os.path.exists(absolute_root):
+    def scan_file_names(cls, manifest=None):
+        """ Yield all file names, relative to MEDIA_ROOT.
+
+        :param ScanManifest manifest: skips the scan if the folder hasn't
+            changed since the last scan
+        """
+        return scan_media_folder(ContainerLog.UPLOAD_DIR, manifest=manifest)
+
+
+class ContainerRunPhase(models.Model):
+    """ Timing and resource usage for one phase of running a container.
+
+    The rusage fields only count child processes, like Singularity, that
+    finished during the phase.
+    """
+    run = models.ForeignKey(ContainerRun,
+                            related_name="phases",
+                            on_delete=models.CASCADE)
+    name = models.CharField(max_length=maxlengths.MAX_NAME_LENGTH)
+    position = models.PositiveIntegerField(
+        help_text="Order that the phases started in.")
+    start_time = models.DateTimeField()
+    duration = models.FloatField(help_text="Wall clock time in seconds.")
+    bytes_staged = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Size of the input files staged into the sandbox.")
+    bytes_hashed = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Bytes read to calculate MD5 checksums.")
+    max_rss = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Peak memory of the largest child process so far, in "
+                  "kilobytes, if it grew during this phase.")
+    user_cpu = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Child CPU time in user mode, in seconds.")
+    system_cpu = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Child CPU time in system mode, in seconds.")
+    block_input = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Child file system blocks read.")
+    block_output = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Child file system blocks written.")
+    file_count = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Number of files registered as datasets.")
+
+    objects = None  # Filled in later by Django.
+
+    class Meta:
+        ordering = ('run', 'position')
+
+    @property
+    def files_per_second(self):
+        if self.file_count is None or not self.duration:
+            return None
+        return self.file_count / self.duration
+
+    def __str__(self):
+        return '{} {}: {:.3f}s'.format(self.run_id, self.name, self.duration)
+
+
+class ChecksumCache(models.Model):
+    """ Remembers MD5 checksums of files, so they don't have to be rehashed.
+
+    An entry is only trusted while the file's device, inode, size, and
+    modification time are the same as when it was hashed. The
+    MD5_CACHE_POLICY setting chooses whether to always hash, trust any
+    matching entry, or rehash matching entries after MD5_CACHE_VERIFY_AGE.
+    Paths can be too long for a unique index, so entries are looked up by
+    a hash of the path.
+    """
+    ALWAYS = 'always'
+    TRUST = 'trust'
+    PERIODIC = 'periodic'
+    POLICIES = (ALWAYS, TRUST, PERIODIC)
+
+    # Counters for this process, see log_stats().
+    stats = dict(hits=0, misses=0, bytes_skipped=0, bytes_hashed=0)
+
+    path = models.CharField(max_length=maxlengths.MAX_EXTERNAL_PATH_LENGTH,
+                            help_text='Absolute path of the file.')
+    path_hash = models.CharField(max_length=64,
+                                 unique=True,
+                                 help_text='SHA-256 of the path, as hex digits.')
+    device = models.BigIntegerField()
+    inode = models.BigIntegerField()
+    size = models.BigIntegerField(help_text='Size of the file in bytes.')
+    mtime_ns = models.BigIntegerField(
+        help_text='Modification time of the file in nanoseconds.')
+    ctime_ns = models.BigIntegerField(
+        help_text='Status change time of the file in nanoseconds. Only '
+                  'compared when MD5_CACHE_CHECK_CTIME is set, because hard '
+                  'links change it.')
+    md5 = models.CharField(
+        max_length=64,
+        validators=[RegexValidator(
+            regex=re.compile("^[0-9A-Fa-f]{32}$"),
+            message="MD5 checksum is not 32 hex characters")])
+    verify_time = models.DateTimeField(
+        help_text='When the file was last hashed.')
+    hit_count = models.BigIntegerField(
+        default=0,
+        help_text='How many times this entry saved rehashing the file.')
+
+    objects = None  # Filled in later by Django.
+
+    def __repr__(self):
+        return 'ChecksumCache(path={!r})'.format(self.path)
+
+    @staticmethod
+    def hash_path(path):
+        return hashlib.sha256(path.encode('utf8', 'surrogateescape')).hexdigest()
+
+    def matches(self, file_stat):
+        is_match = (self.device == file_stat.st_dev and
+                    self.inode == file_stat.st_ino and
+                    self.size == file_stat.st_size and
+                    self.mtime_ns == file_stat.st_mtime_ns)
+        if is_match and settings.MD5_CACHE_CHECK_CTIME:
+            is_match = self.ctime_ns == file_stat.st_ctime_ns
+        return is_match
+
+    @classmethod
+    def compute_md5(cls, path):
+        """ Compute a file's MD5, or look it up if the file hasn't changed.
+
+        :param str path: the file to check
+        :return str: the MD5 checksum as hex digits
+        """
+        path = os.path.abspath(path)
+        file_stat = os.stat(path)
+        md5 = cls.look_up(path, file_stat)
+        if md5 is None:
+            # Fingerprint was taken before hashing, so any change during the
+            # hash will make the entry stale.
+            with open(path, 'rb') as f:
+                md5 = compute_md5(f)
+            cls.store(path, file_stat, md5)
+        return md5
+
+    @classmethod
+    def compute_md5s(cls, paths):
+        """ Compute many files' MD5s, hashing the changed ones in parallel.
+
+        :param paths: an iterable of file paths
+        :return: {path: md5}, where md5 is None if the file couldn't be read
+        """
+        md5s = {}
+        missed_stats = {}  # {path: file_stat}
+        for path in paths:
+            full_path = os.path.abspath(path)
+            try:
+                file_stat = os.stat(full_path)
+            except OSError as ex:
+                logger.warning('Could not hash %s: %s', path, ex)
+                md5s[path] = None
+                continue
+            md5 = cls.look_up(full_path, file_stat)
+            if md5 is None:
+                missed_stats[path] = file_stat
+            else:
+                md5s[path] = md5
+        for path, md5 in compute_md5s(missed_stats):
+            md5s[path] = md5
+            if md5 is not None:
+                cls.store(os.path.abspath(path), missed_stats[path], md5)
+        return md5s
+
+    @classmethod
+    def look_up(cls, path, file_stat):
+        """ Find a file's MD5 in the cache, if it's still valid.
+
+        :param str path: the absolute path of the file
+        :param file_stat: the file's current os.stat() result
+        :return str: the cached MD5, or None if the file needs to be hashed
+        """
+        policy = settings.MD5_CACHE_POLICY
+        if policy not in cls.POLICIES:
+            raise ValueError('Unknown MD5 cache policy: {!r}.'.format(policy))
+        if policy == cls.ALWAYS:
+            return None
+        entry = cls.objects.filter(path_hash=cls.hash_path(path)).first()
+        if entry is None or not entry.matches(file_stat):
+            return None
+        verify_age = timezone.now() - entry.verify_time
+        max_age = parse_duration(settings.MD5_CACHE_VERIFY_AGE)
+        if policy != cls.TRUST and verify_age >= max_age:
+            return None
+        cls.objects.filter(pk=entry.pk).update(
+            hit_count=models.F('hit_count') + 1)
+        cls.stats['hits'] += 1
+        cls.stats['bytes_skipped'] += file_stat.st_size
+        return entry.md5
+
+    @classmethod
+    def store(cls, path, file_stat, md5):
+        """ Record a file's MD5, after hashing it.
+
+        :param str path: the absolute path of the file
+        :param file_stat: the os.stat() result from before it was hashed
+        :param str md5: the new checksum
+        """
+        cls.stats['misses'] += 1
+        cls.stats['bytes_hashed'] += file_stat.st_size
+        if settings.MD5_CACHE_POLICY == cls.ALWAYS:
             return
+        cls.objects.update_or_create(
+            path_hash=cls.hash_path(path),
+            defaults=dict(path=path,
+                          device=file_stat.st_dev,
+                          inode=file_stat.st_ino,
+                          size=file_stat.st_size,
+                          mtime_ns=file_stat.st_mtime_ns,
+                          ctime_ns=file_stat.st_ctime_ns,
+                          md5=md5,
+                          verify_time=timezone.now()))
+
+    @classmethod
+    def remove_stale(cls, batch_size=1000):
+        """ Remove entries for files that were deleted or changed.
 
-        for file_name in os.listdir(absolute_root):
-            yield os.path.join(relative_root, file_name)
+        :return: the number of entries removed
+        """
+        removed_count = 0
+        last_id = 0
+        while True:
+            entries = list(cls.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not entries:
+                return removed_count
+            last_id = entries[-1].id
+            stale_ids = []
+            for entry in entries:
+                try:
+                    file_stat = os.stat(entry.path)
+                except FileNotFoundError:
+                    stale_ids.append(entry.id)
+                    continue
+                if not entry.matches(file_stat):
+                    stale_ids.append(entry.id)
+            removed_count += len(stale_ids)
+            cls.objects.filter(id__in=stale_ids).delete()
+
+    @classmethod
+    def log_stats(cls, log=logger):
+        log.info('MD5 cache: %d hits, %d misses, %s skipped, %s hashed.',
+                 cls.stats['hits'],
+                 cls.stats['misses'],
+                 filesizeformat(cls.stats['bytes_skipped']),
+                 filesizeformat(cls.stats['bytes_hashed']))
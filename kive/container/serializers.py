@@ -3,12 +3,13 @@ from rest_framework import serializers
 from rest_framework.fields import URLField
 
 from container.models import ContainerFamily, Container, ContainerApp, ContainerRun, Batch, ContainerDataset, \
-    ContainerArgument, ContainerLog
-from kive.serializers import AccessControlSerializer
+    ContainerArgument, ContainerLog, ContainerRunPhase
+from kive.serializers import AccessControlSerializer, FieldSelectionMixin
 from librarian.models import Dataset
 
 
-class ContainerFamilySerializer(AccessControlSerializer,
+class ContainerFamilySerializer(FieldSelectionMixin,
+                                AccessControlSerializer,
                                 serializers.ModelSerializer):
     absolute_url = URLField(source='get_absolute_url', read_only=True)
     num_containers = serializers.IntegerField()
@@ -34,7 +35,8 @@ class ContainerFamilySerializer(AccessControlSerializer,
             "removal_plan")
 
 
-class ContainerSerializer(AccessControlSerializer,
+class ContainerSerializer(FieldSelectionMixin,
+                          AccessControlSerializer,
                           serializers.ModelSerializer):
     absolute_url = URLField(source='get_absolute_url', read_only=True)
     family = serializers.HyperlinkedRelatedField(
@@ -91,7 +93,7 @@ class ContainerSerializer(AccessControlSerializer,
         return container
 
 
-class ContainerAppSerializer(serializers.ModelSerializer):
+class ContainerAppSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     absolute_url = URLField(source='get_absolute_url', read_only=True)
     container = serializers.HyperlinkedRelatedField(
         view_name='container-detail',
@@ -105,6 +107,8 @@ class ContainerAppSerializer(serializers.ModelSerializer):
         view_name='containerapp-removal-plan')
     argument_list = serializers.HyperlinkedIdentityField(
         view_name='containerapp-argument-list')
+    resource_stats = serializers.HyperlinkedIdentityField(
+        view_name='containerapp-resource-stats')
 
     class Meta:
         model = ContainerApp
@@ -117,9 +121,12 @@ class ContainerAppSerializer(serializers.ModelSerializer):
                   'description',
                   'threads',
                   'memory',
+                  'reuse_results',
+                  'size_from_history',
                   'inputs',
                   'outputs',
                   'argument_list',
+                  'resource_stats',
                   'removal_plan')
 
     def save(self, **kwargs):
@@ -129,7 +136,7 @@ class ContainerAppSerializer(serializers.ModelSerializer):
         return app
 
 
-class ContainerArgumentSerializer(serializers.ModelSerializer):
+class ContainerArgumentSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     app = serializers.HyperlinkedRelatedField(
         view_name='containerapp-detail',
         lookup_field='pk',
@@ -194,7 +201,7 @@ class ContainerFamilyChoiceSerializer(AccessControlSerializer,
             "containers")
 
 
-class ContainerDatasetSerializer(serializers.ModelSerializer):
+class ContainerDatasetSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     run = serializers.HyperlinkedRelatedField(
         view_name='containerrun-detail',
         lookup_field='pk',
@@ -239,7 +246,8 @@ class ContainerDatasetSerializer(serializers.ModelSerializer):
                   'created')
 
 
-class ContainerRunSerializer(AccessControlSerializer,
+class ContainerRunSerializer(FieldSelectionMixin,
+                             AccessControlSerializer,
                              serializers.ModelSerializer):
     datasets = ContainerDatasetSerializer(many=True,
                                           required=False,
@@ -248,6 +256,8 @@ class ContainerRunSerializer(AccessControlSerializer,
         view_name='containerrun-dataset-list')
     log_list = serializers.HyperlinkedIdentityField(
         view_name='containerrun-log-list')
+    phase_list = serializers.HyperlinkedIdentityField(
+        view_name='containerrun-phase-list')
     absolute_url = URLField(source='get_absolute_url', read_only=True)
     app = serializers.HyperlinkedRelatedField(
         view_name='containerapp-detail',
@@ -276,6 +286,10 @@ class ContainerRunSerializer(AccessControlSerializer,
         lookup_field='pk',
         queryset=ContainerRun.objects.all(),
         required=False)
+    reused_run = serializers.HyperlinkedRelatedField(
+        view_name='containerrun-detail',
+        lookup_field='pk',
+        read_only=True)
     stopped_by = serializers.SlugRelatedField(
         slug_field='username',
         read_only=True)
@@ -293,29 +307,51 @@ class ContainerRunSerializer(AccessControlSerializer,
                   'batch_name',
                   'batch_absolute_url',
                   'original_run',
+                  'reused_run',
                   'has_changed',
                   'app',
                   'app_name',
                   'state',
                   'priority',
                   'slurm_job_id',
+                  'slurm_array_task_id',
                   'return_code',
                   'stopped_by',
                   'is_redacted',
                   'start_time',
                   'end_time',
+                  'input_staging',
+                  'input_staging_seconds',
+                  'slurm_state',
+                  'peak_memory',
+                  'cpu_seconds',
+                  'elapsed_seconds',
+                  'requested_threads',
+                  'requested_memory',
+                  'requested_minutes',
                   'user',
                   'users_allowed',
                   'groups_allowed',
                   'removal_plan',
                   'dataset_list',
                   'log_list',
+                  'phase_list',
                   'datasets')
         read_only_fields = ('state',
                             'slurm_job_id',
+                            'slurm_array_task_id',
                             'return_code',
                             'start_time',
-                            'end_time')
+                            'end_time',
+                            'input_staging',
+                            'input_staging_seconds',
+                            'slurm_state',
+                            'peak_memory',
+                            'cpu_seconds',
+                            'elapsed_seconds',
+                            'requested_threads',
+                            'requested_memory',
+                            'requested_minutes')
 
     def create(self, validated_data):
         """Create a Run and the inputs it contains."""
@@ -353,7 +389,7 @@ class ContainerRunSerializer(AccessControlSerializer,
         return rerun, dependencies
 
 
-class ContainerLogSerializer(serializers.ModelSerializer):
+class ContainerLogSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     run = serializers.HyperlinkedRelatedField(
         view_name='containerrun-detail',
         lookup_field='pk',
@@ -371,7 +407,26 @@ class ContainerLogSerializer(serializers.ModelSerializer):
                   'size')
 
 
-class BatchSerializer(AccessControlSerializer,
+class ContainerRunPhaseSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ContainerRunPhase
+        fields = ('name',
+                  'position',
+                  'start_time',
+                  'duration',
+                  'bytes_staged',
+                  'bytes_hashed',
+                  'max_rss',
+                  'user_cpu',
+                  'system_cpu',
+                  'block_input',
+                  'block_output',
+                  'file_count',
+                  'files_per_second')
+
+
+class BatchSerializer(FieldSelectionMixin,
+                      AccessControlSerializer,
                       serializers.ModelSerializer):
     runs = ContainerRunSerializer(many=True, required=False)
     # absolute_url = URLField(source='get_absolute_url', read_only=True)
@@ -389,6 +444,7 @@ class BatchSerializer(AccessControlSerializer,
                   'users_allowed',
                   'groups_allowed',
                   'removal_plan',
+                  'reuse_results',
                   'copy_permissions_to_runs',
                   'runs')
 
@@ -6,12 +6,13 @@ import re
 import shutil
 import warnings
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from io import BytesIO
+from io import BytesIO, StringIO
 import pathlib
 from tarfile import TarFile, TarInfo
-from tempfile import NamedTemporaryFile, mkstemp
+from tempfile import NamedTemporaryFile, mkstemp, TemporaryDirectory
 from time import time
 import unittest.mock
 from zipfile import ZipFile
@@ -23,7 +24,7 @@ from django.core.files.base import ContentFile, File
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.core.exceptions import ValidationError
-from django.test import TestCase, skipIfDBFeature
+from django.test import TestCase, skipIfDBFeature, override_settings
 from django.test.client import Client
 from django.urls import reverse, resolve
 from django.utils import timezone
@@ -40,12 +41,14 @@ from container.management.commands import purge, runcontainer
 from container.models import (
     ContainerFamily, ContainerApp, Container, ContainerRun, ContainerDataset,
     ContainerArgument, ContainerArgumentType, Batch, ContainerLog,
-    PipelineCompletionStatus, ExistingRunsError, multi_check_output
+    PipelineCompletionStatus, ExistingRunsError, multi_check_output,
+    ChecksumCache, SlurmPoll
 )
 from container.forms import ContainerForm
 from kive.tests import BaseTestCases, install_fixture_files, capture_log_stream
-from librarian.models import Dataset, ExternalFileDirectory, get_upload_path
-from file_access_utils import use_field_file
+from librarian.models import Dataset, ExternalFileDirectory, get_upload_path, DatasetContent
+from portal.models import StorageLedger, StorageSnapshot
+from file_access_utils import compute_md5, use_field_file
 
 
 def create_tar_content(container=None, content=None):
@@ -535,6 +538,83 @@ class ContainerTests(TestCase):
         finally:
             shutil.rmtree(sandbox_path)
 
+    def create_tar_container(self):
+        user = User.objects.first()
+        family = ContainerFamily.objects.create(user=user)
+        container = Container.objects.create(family=family, user=user)
+        self.create_tar_content(container)
+        container.save()
+        return container
+
+    def test_extract_cached(self):
+        container = self.create_tar_container()
+        with TemporaryDirectory() as temp_dir:
+            cache_root = os.path.join(temp_dir, 'cache')
+            extraction_path1 = os.path.join(temp_dir, 'bin1')
+            extraction_path2 = os.path.join(temp_dir, 'bin2')
+            with override_settings(CONTAINER_CACHE_ROOT=cache_root,
+                                   CONTAINER_CACHE_MAX_SIZE=10000), \
+                    patch.object(Container,
+                                 'extract_archive',
+                                 wraps=container.extract_archive) as mock_extract:
+                is_shared1 = container.extract_archive_cached(extraction_path1)
+                is_shared2 = container.extract_archive_cached(extraction_path2)
+
+            self.assertEqual(1, mock_extract.call_count)
+            self.assertTrue(is_shared1)
+            self.assertTrue(is_shared2)
+            cache_path = os.path.join(cache_root, container.md5)
+            foo_path = os.path.join(extraction_path2, 'foo.txt')
+            self.assertTrue(os.path.samefile(os.path.join(cache_path, 'foo.txt'),
+                                             foo_path))
+            self.assertEqual(0o555, os.stat(foo_path).st_mode & 0o777)
+            self.assertEqual(['bin1', 'bin2', 'cache'], sorted(os.listdir(temp_dir)))
+            self.assertEqual([container.md5, container.md5 + '.size'],
+                             sorted(os.listdir(cache_root)))
+
+    def test_extract_cache_disabled(self):
+        container = self.create_tar_container()
+        with TemporaryDirectory() as temp_dir:
+            cache_root = os.path.join(temp_dir, 'cache')
+            extraction_path = os.path.join(temp_dir, 'bin')
+            with override_settings(CONTAINER_CACHE_ROOT=cache_root,
+                                   CONTAINER_CACHE_MAX_SIZE=0):
+                is_shared = container.extract_archive_cached(extraction_path)
+
+            self.assertFalse(is_shared)
+            foo_path = os.path.join(extraction_path, 'foo.txt')
+            self.assertTrue(os.path.exists(foo_path))
+            self.assertFalse(os.path.exists(cache_root))
+            # Only shared extractions are made read-only.
+            self.assertTrue(os.stat(foo_path).st_mode & 0o200)
+
+    def test_extract_cache_eviction(self):
+        container = self.create_tar_container()
+        with TemporaryDirectory() as cache_root:
+            old_path = os.path.join(cache_root, 'old')
+            recent_path = os.path.join(cache_root, 'recent')
+            for path, cache_size, used_time in ((old_path, 2000000, 100),
+                                                (recent_path, 1000000, 200)):
+                os.mkdir(path)
+                with open(path + Container.CACHE_SIZE_SUFFIX, 'w') as f:
+                    f.write(str(cache_size))
+                os.utime(path, (used_time, used_time))
+            # Left behind by a process that crashed while removing it.
+            crashed_path = os.path.join(cache_root, 'crashed.123.removed')
+            os.makedirs(os.path.join(crashed_path, 'bin'))
+            with open(os.path.join(crashed_path, 'bin', 'tool'), 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(os.path.join(crashed_path, 'bin', 'tool'), 0o555)
+            with override_settings(CONTAINER_CACHE_ROOT=cache_root,
+                                   CONTAINER_CACHE_MAX_SIZE=1):
+                cache_path = container.get_cached_extraction()
+
+            self.assertFalse(os.path.exists(crashed_path))
+            self.assertFalse(os.path.exists(old_path))
+            self.assertFalse(os.path.exists(old_path + '.size'))
+            self.assertTrue(os.path.exists(recent_path))
+            self.assertTrue(os.path.exists(cache_path))
+
     def test_pipeline_state_valid(self):
         user = User.objects.first()
         family = ContainerFamily.objects.create(user=user)
@@ -1131,6 +1211,29 @@ class ContainerAppApiTests(BaseTestCases.ApiTestCase):
         end_count = ContainerApp.objects.all().count()
         self.assertEqual(end_count, start_count - 1)
 
+    def test_resource_stats(self):
+        user = self.test_app.container.user
+        for i in range(1, 5):
+            self.test_app.runs.create(user=user,
+                                      state=ContainerRun.COMPLETE,
+                                      peak_memory=100*i,
+                                      cpu_seconds=30*i,
+                                      elapsed_seconds=60)
+        self.test_app.runs.create(user=user)  # No stats yet.
+        stats_path = reverse("containerapp-resource-stats",
+                             kwargs={'pk': self.detail_pk})
+        stats_view, _, _ = resolve(stats_path)
+
+        request = self.factory.get(stats_path)
+        force_authenticate(request, user=self.kive_user)
+        response = stats_view(request, pk=self.detail_pk)
+
+        self.assertEqual(4, response.data['run_count'])
+        self.assertEqual(dict(p50=200, p95=400, max=400),
+                         response.data['memory_mb'])
+        self.assertEqual(dict(p50=1.0, p95=2.0, max=2.0),
+                         response.data['cpus'])
+
 
 @skipIfDBFeature('is_mocked')
 class ContainerRunApiTests(BaseTestCases.ApiTestCase):
@@ -1382,15 +1485,11 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         end_time = (datetime.now() -
                     timedelta(minutes=15, seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
 """.replace('<end-time>', end_time)
 
-        request = self.factory.get(self.detail_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.detail_view(request, pk=self.detail_pk)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         other_run.refresh_from_db()
         self.assertEqual(ContainerRun.FAILED, self.test_run.state)
@@ -1408,15 +1507,11 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         end_time = (datetime.now() -
                     timedelta(seconds=61)).strftime('%Y-%m-%dT%H:%M:%S')
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
 """.replace('<end-time>', end_time)
 
-        request = self.factory.get(self.detail_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.detail_view(request, pk=self.detail_pk)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         other_run.refresh_from_db()
         self.assertEqual(ContainerRun.NEW, self.test_run.state)
@@ -1435,15 +1530,11 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         end_time = (datetime.now() -
                     timedelta(seconds=58)).strftime('%Y-%m-%dT%H:%M:%S')
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
 """.replace('<end-time>', end_time)
 
-        request = self.factory.get(self.detail_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.detail_view(request, pk=self.detail_pk)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         other_run.refresh_from_db()
         self.assertEqual(ContainerRun.NEW, self.test_run.state)
@@ -1462,15 +1553,11 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         self.test_run.end_time = end_time
         self.test_run.save()
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
 """.replace('<end-time>', end_time_text)
 
-        request = self.factory.get(self.detail_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.detail_view(request, pk=self.detail_pk)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         self.assertEqual(ContainerRun.COMPLETE, self.test_run.state)
         self.assertEqual(end_time, self.test_run.end_time)
@@ -1485,17 +1572,13 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         end_time = (datetime.now() -
                     timedelta(minutes=16)).strftime('%Y-%m-%dT%H:%M:%S')
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
-43|<end-time>
-43.batch|<end-time>
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
+43|<end-time>|FAILED||||
+43.batch|<end-time>|FAILED||||
 """.replace('<end-time>', end_time)
 
-        request = self.factory.get(self.list_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.list_view(request)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         other_run.refresh_from_db()
         self.assertEqual(ContainerRun.FAILED, self.test_run.state)
@@ -1513,16 +1596,12 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
         end_time = (datetime.now() -
                     timedelta(minutes=16)).strftime('%Y-%m-%dT%H:%M:%S')
         mock_check_output.return_value = """\
-42|<end-time>
-42.batch|<end-time>
-43|Unknown
+42|<end-time>|FAILED||||
+42.batch|<end-time>|FAILED||||
+43|Unknown|RUNNING||||
 """.replace('<end-time>', end_time)
 
-        request = self.factory.get(self.list_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.list_view(request)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.test_run.refresh_from_db()
         other_run.refresh_from_db()
         self.assertEqual(ContainerRun.FAILED, self.test_run.state)
@@ -1534,23 +1613,151 @@ class ContainerRunApiTests(BaseTestCases.ApiTestCase):
     def test_no_active_runs(self, mock_check_output):
         ContainerRun.objects.update(state=ContainerRun.CANCELLED)
 
-        request = self.factory.get(self.list_path)
-        force_authenticate(request, user=self.kive_user)
-        response = self.list_view(request)
-
-        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        SlurmPoll.refresh()
         self.assertEqual([], mock_check_output.call_args_list)
 
     @patch('container.models.check_output')
     def test_null_slurm_job_id(self, mock_check_output):
         ContainerRun.objects.update(slurm_job_id=None)
 
+        SlurmPoll.refresh()
+        self.assertEqual([], mock_check_output.call_args_list)
+
+    @patch('container.models.check_output')
+    def test_collect_slurm_stats(self, mock_check_output):
+        ContainerRun.objects.update(slurm_job_id=None)
+        self.test_run.slurm_job_id = 42
+        self.test_run.state = ContainerRun.COMPLETE
+        self.test_run.end_time = timezone.now()
+        self.test_run.save()
+        array_run = self.test_run.app.runs.create(user=self.test_run.user,
+                                                  state=ContainerRun.FAILED,
+                                                  end_time=timezone.now(),
+                                                  slurm_job_id=50,
+                                                  slurm_array_task_id=2,
+                                                  requested_memory=4000)
+        running_run = self.test_run.app.runs.create(user=self.test_run.user,
+                                                    state=ContainerRun.COMPLETE,
+                                                    end_time=timezone.now(),
+                                                    slurm_job_id=51)
+        active_run = self.test_run.app.runs.create(user=self.test_run.user,
+                                                   state=ContainerRun.RUNNING,
+                                                   slurm_job_id=52)
+        mock_check_output.return_value = """\
+42|2020-01-01T00:03:00|COMPLETED||05:30.500|00:03:00|5000Mn
+42.batch|2020-01-01T00:03:00|COMPLETED|1500.50M|05:30.400|00:03:00|5000Mn
+42.extern|2020-01-01T00:03:00|COMPLETED|1M|00:00.100|00:03:00|5000Mn
+50_2|2020-01-01T00:03:00|OUT_OF_MEMORY||01:02:03|1-00:00:10|2G
+50_2.batch|2020-01-01T00:03:00|OUT_OF_MEMORY|2G|01:02:03|1-00:00:10|2G
+51|Unknown|COMPLETING||00:01.000|00:00:02|1G
+52|Unknown|RUNNING||00:01.000|00:00:02|1G
+"""
+
+        ContainerRun.check_slurm_state()
+
+        # Active runs and finished runs share one sacct call.
+        self.assertEqual(1, mock_check_output.call_count)
+        command = mock_check_output.call_args[0][0]
+        self.assertEqual('42,50_2,51,52', ','.join(sorted(command[2].split(','))))
+        self.test_run.refresh_from_db()
+        array_run.refresh_from_db()
+        running_run.refresh_from_db()
+        active_run.refresh_from_db()
+        self.assertEqual('COMPLETED', self.test_run.slurm_state)
+        self.assertEqual(1501, self.test_run.peak_memory)
+        self.assertEqual(330.5, self.test_run.cpu_seconds)
+        self.assertEqual(180, self.test_run.elapsed_seconds)
+        self.assertEqual(5000, self.test_run.requested_memory)
+        self.assertEqual('OUT_OF_MEMORY', array_run.slurm_state)
+        self.assertEqual(2048, array_run.peak_memory)
+        self.assertEqual(3723, array_run.cpu_seconds)
+        self.assertEqual(86410, array_run.elapsed_seconds)
+        self.assertEqual(4000, array_run.requested_memory)
+        self.assertEqual('', running_run.slurm_state)
+        self.assertEqual(ContainerRun.RUNNING, active_run.state)
+        self.assertEqual('', active_run.slurm_state)
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_not_in_requests(self, mock_check_output):
+        """ Web requests only report the poll time, they never call sacct. """
+        poll_time = timezone.now() - timedelta(hours=1)
+        SlurmPoll.objects.create(pk=SlurmPoll.SINGLETON_ID,
+                                 poll_time=poll_time)
+
         request = self.factory.get(self.list_path)
         force_authenticate(request, user=self.kive_user)
         response = self.list_view(request)
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual([], mock_check_output.call_args_list)
+        mock_check_output.assert_not_called()
+        self.assertEqual(poll_time.isoformat(),
+                         response['X-Kive-Slurm-Poll-Time'])
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_coalesced(self, mock_check_output):
+        ContainerRun.objects.update(slurm_job_id=None)
+        self.test_run.slurm_job_id = 42
+        self.test_run.save()
+        mock_check_output.return_value = '42|Unknown|RUNNING||||\n'
+
+        self.assertTrue(SlurmPoll.refresh())
+        self.assertFalse(SlurmPoll.refresh())
+
+        self.assertEqual(1, mock_check_output.call_count)
+        poll = SlurmPoll.objects.get()
+        self.assertIsNone(poll.claim_time)
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_claimed(self, mock_check_output):
+        """ Skip the check while another process is running sacct. """
+        SlurmPoll.objects.create(pk=SlurmPoll.SINGLETON_ID,
+                                 poll_time=timezone.now() - timedelta(hours=1),
+                                 claim_time=timezone.now())
+
+        self.assertFalse(SlurmPoll.refresh())
+
+        mock_check_output.assert_not_called()
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_stale_claim(self, mock_check_output):
+        """ A process that died while checking doesn't block checks forever. """
+        mock_check_output.return_value = ''
+        SlurmPoll.objects.create(
+            pk=SlurmPoll.SINGLETON_ID,
+            poll_time=timezone.now() - timedelta(hours=2),
+            claim_time=timezone.now() - timedelta(hours=1))
+
+        self.assertTrue(SlurmPoll.refresh())
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_failed(self, mock_check_output):
+        """ A failed check releases its claim, and doesn't count as a poll. """
+        ContainerRun.objects.update(slurm_job_id=None)
+        self.test_run.slurm_job_id = 42
+        self.test_run.save()
+        mock_check_output.side_effect = OSError(2, 'sacct not found')
+
+        with self.assertRaises(OSError):
+            SlurmPoll.refresh()
+
+        poll = SlurmPoll.objects.get()
+        self.assertIsNone(poll.poll_time)
+        self.assertIsNone(poll.claim_time)
+
+    @patch('container.models.check_output')
+    def test_slurm_poll_expired(self, mock_check_output):
+        ContainerRun.objects.update(slurm_job_id=None)
+        self.test_run.slurm_job_id = 42
+        self.test_run.save()
+        mock_check_output.return_value = '42|Unknown|RUNNING||||\n'
+        SlurmPoll.objects.create(pk=SlurmPoll.SINGLETON_ID,
+                                 poll_time=timezone.now() - timedelta(hours=1))
+
+        call_command('poll_slurm', once=True)
+
+        self.assertEqual(1, mock_check_output.call_count)
+        poll_time = SlurmPoll.get_poll_time()
+        self.assertLess(timezone.now() - poll_time, timedelta(minutes=1))
 
 
 @skipIfDBFeature('is_mocked')
@@ -1736,7 +1943,251 @@ class ContainerRunTests(TestCase):
         main_run_sbatch_args = mock_check_output.call_args_list[1][0][0]
         self.assertIn('--dependency=afterok:42', main_run_sbatch_args)
 
-    @patch('container.models.check_call')
+    @patch('container.models.check_output')
+    def test_resources_from_history(self, mock_check_output):
+        mock_check_output.return_value = '42\n'
+        run = ContainerRun.objects.get(id=1)
+        app = run.app
+        app.threads = 4
+        app.size_from_history = True
+        app.save()
+        for i in range(1, 6):
+            app.runs.create(user=run.user,
+                            state=ContainerRun.COMPLETE,
+                            peak_memory=100*i,
+                            cpu_seconds=900,
+                            elapsed_seconds=600)
+
+        run.schedule()
+
+        run.refresh_from_db()
+        sbatch_args = mock_check_output.call_args[0][0]
+        self.assertEqual(['-c', '2', '--mem', '625', '--time', '13'],
+                         sbatch_args[8:14])
+        self.assertEqual(625, run.requested_memory)
+
+    def test_resources_without_enough_history(self):
+        run = ContainerRun.objects.get(id=1)
+        app = run.app
+        app.size_from_history = True
+        app.save()
+        app.runs.create(user=run.user,
+                        state=ContainerRun.COMPLETE,
+                        peak_memory=100,
+                        cpu_seconds=60,
+                        elapsed_seconds=600)
+
+        run.plan_resources()
+
+        self.assertEqual(app.threads, run.requested_threads)
+        self.assertEqual(app.memory, run.requested_memory)
+        self.assertIsNone(run.requested_minutes)
+
+    def test_resources_after_out_of_memory(self):
+        original_run = ContainerRun.objects.get(id=1)
+        original_run.app.memory = 1000
+        original_run.app.save()
+        original_run.slurm_state = ContainerRun.SLURM_OUT_OF_MEMORY
+        original_run.requested_memory = 1000
+        original_run.save()
+        rerun = ContainerRun(app=original_run.app,
+                             user=original_run.user,
+                             original_run=original_run)
+
+        rerun.plan_resources()
+
+        self.assertEqual(2000, rerun.requested_memory)
+
+    def test_resources_after_timeout(self):
+        original_run = ContainerRun.objects.get(id=1)
+        original_run.slurm_state = ContainerRun.SLURM_TIMEOUT
+        original_run.requested_minutes = 30
+        original_run.save()
+        rerun = ContainerRun(app=original_run.app,
+                             user=original_run.user,
+                             original_run=original_run)
+
+        rerun.plan_resources()
+
+        self.assertEqual(60, rerun.requested_minutes)
+        self.assertEqual(original_run.app.memory, rerun.requested_memory)
+
+    def create_completed_run(self):
+        """ Complete the fixture's run, and create a new run with its inputs.
+
+        :return: (completed_run, new_run)
+        """
+        run = ContainerRun.objects.get(id=1)
+        run.state = ContainerRun.COMPLETE
+        run.return_code = 0
+        run.end_time = make_aware(datetime(2000, 1, 2), utc)
+        dataset = Dataset.create_dataset(
+            file_path=None,
+            user=run.user,
+            file_handle=ContentFile(b'greeting\nHello, Alice\n',
+                                    name='greetings.csv'),
+            name='greetings_1.csv')
+        argument = run.app.arguments.get(name='greetings_csv')
+        run.datasets.create(argument=argument, dataset=dataset)
+        run.set_md5()
+        run.save()
+
+        new_run = ContainerRun.objects.create(user=run.user, app=run.app)
+        for container_dataset in run.datasets.filter(
+                argument__type=ContainerArgument.INPUT):
+            new_run.datasets.create(argument=container_dataset.argument,
+                                    dataset=container_dataset.dataset)
+        return run, new_run
+
+    @patch('container.models.check_output')
+    def test_reuse_results(self, mock_check_output):
+        run, new_run = self.create_completed_run()
+        new_run.app.reuse_results = True
+        new_run.app.save()
+
+        new_run.schedule()
+
+        new_run.refresh_from_db()
+        self.assertEqual(0, mock_check_output.call_count)
+        self.assertEqual(ContainerRun.COMPLETE, new_run.state)
+        self.assertEqual(run, new_run.reused_run)
+        self.assertEqual(run.md5, new_run.md5)
+        self.assertEqual(run.input_md5, new_run.input_md5)
+        output_ids = set(run.datasets.values_list('dataset_id', flat=True))
+        new_output_ids = set(new_run.datasets.values_list('dataset_id',
+                                                          flat=True))
+        self.assertEqual(output_ids, new_output_ids)
+
+    @patch('container.models.check_output')
+    def test_reuse_results_in_batch(self, mock_check_output):
+        mock_check_output.return_value = '42\n'
+        run, new_run = self.create_completed_run()
+        new_run.batch = Batch.objects.create(user=new_run.user,
+                                             reuse_results=True)
+        new_run.save(schedule=False)
+
+        new_run.schedule()
+
+        new_run.refresh_from_db()
+        self.assertEqual(0, mock_check_output.call_count)
+        self.assertEqual(run, new_run.reused_run)
+
+    @patch('container.models.check_output')
+    def test_reuse_results_disabled(self, mock_check_output):
+        mock_check_output.return_value = '42\n'
+        run, new_run = self.create_completed_run()
+
+        new_run.schedule()
+
+        new_run.refresh_from_db()
+        self.assertEqual(1, mock_check_output.call_count)
+        self.assertEqual(42, new_run.slurm_job_id)
+        self.assertIsNone(new_run.reused_run)
+
+    @patch('container.models.check_output')
+    def test_reuse_results_other_app(self, mock_check_output):
+        """ An app with the same name and container is still a different app. """
+        mock_check_output.return_value = '42\n'
+        run, new_run = self.create_completed_run()
+        new_run.app.reuse_results = True
+        new_run.app.save()
+        other_app = ContainerApp.objects.create(container=run.app.container,
+                                                name=run.app.name,
+                                                description='copy')
+        ContainerRun.objects.filter(id=run.id).update(app=other_app)
+
+        new_run.schedule()
+
+        new_run.refresh_from_db()
+        self.assertEqual(1, mock_check_output.call_count)
+        self.assertIsNone(new_run.reused_run)
+
+    @patch('container.models.check_output')
+    def test_reuse_results_purged(self, mock_check_output):
+        mock_check_output.return_value = '42\n'
+        run, new_run = self.create_completed_run()
+        new_run.app.reuse_results = True
+        new_run.app.save()
+        output_dataset = run.datasets.get(
+            argument__type=ContainerArgument.OUTPUT).dataset
+        output_dataset.dataset_file.delete()
+
+        new_run.schedule()
+
+        new_run.refresh_from_db()
+        self.assertEqual(1, mock_check_output.call_count)
+        self.assertIsNone(new_run.reused_run)
+
+    @patch('container.models.check_output')
+    def test_launch_array(self, mock_check_output):
+        mock_check_output.return_value = '42\n'
+        run1 = ContainerRun.objects.filter(state=ContainerRun.NEW).first()
+        batch = Batch.objects.create(user=run1.user)
+        run1.batch = batch
+        run1.save(schedule=False)
+        run2 = ContainerRun.objects.create(user=run1.user,
+                                           app=run1.app,
+                                           batch=batch)
+        run3 = ContainerRun.objects.create(user=run1.user,
+                                           app=run1.app,
+                                           batch=batch,
+                                           priority=1)
+
+        with self.settings(SLURM_ARRAYS=True):
+            run1.schedule()
+            run2.schedule()  # Already claimed by run1's array.
+
+        run1.refresh_from_db()
+        run2.refresh_from_db()
+        run3.refresh_from_db()
+        self.assertEqual(1, mock_check_output.call_count)
+        sbatch_args = mock_check_output.call_args[0][0]
+        self.assertEqual(['--array', '0-1'], sbatch_args[4:6])
+        self.assertEqual('{},{}'.format(run1.pk, run2.pk), sbatch_args[-1])
+        self.assertEqual((42, 0), (run1.slurm_job_id, run1.slurm_array_task_id))
+        self.assertEqual((42, 1), (run2.slurm_job_id, run2.slurm_array_task_id))
+        self.assertEqual('42_1', run2.slurm_job_key)
+        self.assertTrue(run2.sandbox_path.endswith('_task1'))
+        self.assertTrue(os.path.isdir(run2.full_sandbox_path))
+        self.assertIsNone(run3.slurm_job_id)  # Different priority.
+
+    @patch('container.models.check_output')
+    def test_launch_array_fails(self, mock_check_output):
+        """ Runs in chunks after a failed sbatch don't stay new forever. """
+        mock_check_output.side_effect = OSError(2, 'sbatch not found')
+        run1 = ContainerRun.objects.filter(state=ContainerRun.NEW).first()
+        batch = Batch.objects.create(user=run1.user)
+        run1.batch = batch
+        run1.save(schedule=False)
+        other_runs = [ContainerRun.objects.create(user=run1.user,
+                                                  app=run1.app,
+                                                  batch=batch)
+                      for _ in range(4)]
+
+        with self.settings(SLURM_ARRAYS=True, SLURM_ARRAY_MAX_SIZE=2):
+            with self.assertRaises(OSError):
+                run1.schedule()
+
+        self.assertEqual(1, mock_check_output.call_count)
+        for run in [run1] + other_runs:
+            run.refresh_from_db()
+            self.assertEqual(ContainerRun.FAILED, run.state)
+            self.assertIsNone(run.slurm_job_id)
+            self.assertIsNotNone(run.end_time)
+
+    @patch('container.executors.check_call')
+    def test_cancel_array_task(self, mock_check_call):
+        run = ContainerRun.objects.filter(state=ContainerRun.NEW).first()
+        run.state = ContainerRun.RUNNING
+        run.slurm_job_id = 42
+        run.slurm_array_task_id = 3
+        run.save()
+
+        run.request_stop(run.user)
+
+        mock_check_call.assert_called_with(['scancel', '-f', '42_3'])
+
+    @patch('container.executors.check_call')
     def test_cancel_new_run(self, mock_check_call):
         run = ContainerRun.objects.filter(state=ContainerRun.NEW).first()
         self.assertIsNotNone(run)
@@ -1750,7 +2201,7 @@ class ContainerRunTests(TestCase):
         self.assertIsNotNone(run.end_time)
         self.assertEqual(0, mock_check_call.call_count)
 
-    @patch('container.models.check_call')
+    @patch('container.executors.check_call')
     def test_cancel_running(self, mock_check_call):
         run = ContainerRun.objects.filter(state=ContainerRun.NEW).first()
         self.assertIsNotNone(run)
@@ -2902,6 +3353,27 @@ Line 3
         self.assertEqual(expected_stdout, stdout.short_text)
         self.assertEqual(expected_stderr, stderr.short_text)
 
+    @patch('container.management.commands.runcontainer.call')
+    def test_phases(self, mocked_call):
+        mocked_call.side_effect = self.dummy_call
+        run = ContainerRun.objects.get(name='fixture run')
+        expected_names = ['record_start',
+                          'fill_sandbox',
+                          'verify_md5',
+                          'execute',
+                          'save_outputs',
+                          'load_log']
+
+        call_command('runcontainer', str(run.id))
+
+        phases = list(run.phases.all())
+        self.assertEqual(expected_names, [phase.name for phase in phases])
+        self.assertEqual(list(range(6)), [phase.position for phase in phases])
+        fill_sandbox_phase = phases[1]
+        self.assertGreater(fill_sandbox_phase.bytes_staged, 0)
+        for phase in phases:
+            self.assertGreaterEqual(phase.duration, 0)
+
     @patch('container.management.commands.runcontainer.call')
     def test_long_stderr(self, mocked_call):
         mocked_call.side_effect = self.dummy_call
@@ -3341,6 +3813,27 @@ class PurgeTests(TestCase):
         self.assertTrue(os.path.exists(run1.full_sandbox_path))
         self.assertEqual(100, run1.sandbox_size)
 
+    def test_purge_hard_links(self):
+        """ Staged inputs don't count, but links within the sandbox count once. """
+        run = self.create_sandbox(age=timedelta(minutes=20), size=100)
+        dataset_folder = os.path.join(settings.MEDIA_ROOT, Dataset.UPLOAD_DIR)
+        os.makedirs(dataset_folder, exist_ok=True)
+        dataset_path = os.path.join(dataset_folder, 'staged_input.txt')
+        with open(dataset_path, 'wb') as f:
+            f.write(b'.' * 1000)
+        input_path = os.path.join(run.full_sandbox_path, 'input', 'staged.txt')
+        os.link(dataset_path, input_path)
+        output_path = os.path.join(run.full_sandbox_path, 'output', 'a.txt')
+        with open(output_path, 'wb') as f:
+            f.write(b'.' * 30)
+        os.link(output_path,
+                os.path.join(run.full_sandbox_path, 'output', 'b.txt'))
+
+        purge.Command().handle(start=400, stop=400)
+
+        run.refresh_from_db()
+        self.assertEqual(130, run.sandbox_size)
+
     def test_purge_no_sandbox(self):
         """ Sometimes a sandbox doesn't get created, and the path is blank. """
         run = self.create_sandbox(size=500)
@@ -3402,6 +3895,42 @@ class PurgeTests(TestCase):
         self.assertEqual(expected_log_message, log_messages)
         self.assertEqual('', run1.sandbox_path)
 
+    def test_purge_plan(self):
+        run1 = self.create_sandbox(age=timedelta(minutes=11), size=100)
+        run2 = self.create_sandbox(age=timedelta(minutes=10), size=200)
+        run3 = self.create_sandbox(age=timedelta(minutes=9), size=400)
+        expected_output = """\
+Would purge 2 container runs containing 300 bytes from 11 minutes ago to 10 minutes ago.
+Storage would go from 700 bytes to 400 bytes.
+"""
+        stdout = StringIO()
+
+        purge.Command(stdout=stdout).handle(start=500, stop=500, plan=True)
+
+        for run in (run1, run2, run3):
+            run.refresh_from_db()
+            self.assertTrue(os.path.exists(run.full_sandbox_path))
+        self.assertEqual(expected_output, stdout.getvalue().replace('\xa0', ' '))
+
+    def test_purge_plan_short(self):
+        """ Report when even purging everything isn't enough. """
+        self.create_sandbox(age=timedelta(minutes=11), size=100)
+        family = ContainerFamily.objects.first()
+        container = family.containers.create(user=family.user)
+        with NamedTemporaryFile() as f:
+            f.write(b'.'*100)
+            container.file.save('new_container.simg', f)
+        expected_output = """\
+Would purge 1 container run containing 100 bytes from 11 minutes ago.
+Storage would go from 200 bytes to 100 bytes.
+Cannot reduce storage to 50 bytes: 100 bytes of containers.
+"""
+        stdout = StringIO()
+
+        purge.Command(stdout=stdout).handle(start=50, stop=50, plan=True)
+
+        self.assertEqual(expected_output, stdout.getvalue().replace('\xa0', ' '))
+
     def test_synch_broken_link(self):
         run1 = self.create_sandbox(age=timedelta(minutes=20), size=200)
         run1_path = run1.full_sandbox_path
@@ -3757,6 +4286,72 @@ Cannot reduce storage to 500 bytes: 1000 bytes of datasets.
 
         self.assertLogStreamEqual(expected_messages, log_messages)
 
+    def create_shared_datasets(self):
+        """ Create two output datasets that share a file.
+
+        :return: the older dataset, then the newer one
+        """
+        datasets = []
+        with override_settings(DATASET_SHARED_STORAGE=True):
+            for age in (timedelta(minutes=10), timedelta(minutes=1)):
+                run = self.create_sandbox(size=100, age=age)
+                self.create_outputs(run, output_size=200, age=age)
+                run.delete_sandbox()
+                run.save()
+                datasets.append(run.datasets.get(argument__type='O').dataset)
+        return datasets
+
+    def test_purge_shared_datasets(self):
+        """ A shared file is only deleted when its last dataset is purged. """
+        old_dataset, new_dataset = self.create_shared_datasets()
+        self.assertEqual(old_dataset.content_id, new_dataset.content_id)
+        shared_path = new_dataset.dataset_file.path
+
+        purge.Command().handle(start=300, stop=300)
+
+        old_dataset.refresh_from_db()
+        new_dataset.refresh_from_db()
+        self.assertEqual('', old_dataset.dataset_file)
+        self.assertIsNone(old_dataset.content)
+        self.assertEqual(1, new_dataset.content.ref_count)
+        self.assertTrue(os.path.exists(shared_path))
+
+        purge.Command().handle(start=0, stop=0)
+
+        new_dataset.refresh_from_db()
+        self.assertEqual('', new_dataset.dataset_file)
+        self.assertFalse(os.path.exists(shared_path))
+
+    def test_purge_shared_datasets_fails(self):
+        """ Shared files are only released when the records are saved. """
+        old_dataset, new_dataset = self.create_shared_datasets()
+        shared_path = new_dataset.dataset_file.path
+
+        with patch.object(Dataset.objects,
+                          'bulk_update',
+                          side_effect=RuntimeError('Database failed.')) as mock_bulk_update:
+            with self.capture_log_stream(logging.ERROR):
+                purge.Command().handle(start=0, stop=0)
+
+        self.assertEqual(['dataset_file', 'dataset_size', 'content'],
+                         mock_bulk_update.call_args[0][1])
+        old_dataset.refresh_from_db()
+        self.assertEqual(new_dataset.dataset_file.name, old_dataset.dataset_file.name)
+        self.assertEqual(2, old_dataset.content.ref_count)
+        self.assertTrue(os.path.exists(shared_path))
+
+    def test_synch_recounts_shared_files(self):
+        old_dataset, new_dataset = self.create_shared_datasets()
+        shared_path = new_dataset.dataset_file.path
+        DatasetContent.objects.update(ref_count=1)
+
+        with self.assertLogs('librarian.models', logging.WARNING):
+            purge.Command().handle(synch=True)
+
+        new_dataset.content.refresh_from_db()
+        self.assertEqual(2, new_dataset.content.ref_count)
+        self.assertTrue(os.path.exists(shared_path))
+
     def test_skip_purged_datasets(self):
         run = self.create_sandbox(size=200, age=timedelta(minutes=1))
         self.create_outputs(run, output_size=1000, age=timedelta(minutes=1))
@@ -3913,6 +4508,115 @@ Purged 1 unregistered container file containing 400 bytes.
 
         purge.Command().handle(synch=True)
 
+    def test_set_file_sizes_resumes(self):
+        """ Sizes are saved in batches, so an interrupted scan can resume. """
+        runs = [self.create_sandbox(age=timedelta(minutes=10), size=size)
+                for size in (100, 200, 300)]
+        command = purge.Command()
+        scan_results = [(100, None), (200, None), RuntimeError('Interrupted.')]
+
+        with patch.object(command, 'measure_file', side_effect=scan_results):
+            with self.assertRaises(RuntimeError):
+                command.set_file_sizes(ContainerRun,
+                                       'sandbox_path',
+                                       'sandbox_size',
+                                       'end_time',
+                                       batch_size=2)
+        for run in runs:
+            run.refresh_from_db()
+        self.assertEqual([100, 200, None], [run.sandbox_size for run in runs])
+
+        with ThreadPoolExecutor(2) as executor:
+            command.set_file_sizes(ContainerRun,
+                                   'sandbox_path',
+                                   'sandbox_size',
+                                   'end_time',
+                                   executor,
+                                   batch_size=2)
+
+        runs[2].refresh_from_db()
+        self.assertEqual(300, runs[2].sandbox_size)
+        totals = StorageLedger.get_totals()
+        self.assertEqual(600, totals[StorageLedger.SANDBOXES])
+
+    def test_purge_updates_ledger(self):
+        self.create_sandbox(age=timedelta(minutes=10), size=100)
+        self.create_sandbox(age=timedelta(minutes=1), size=100)
+
+        purge.Command().handle(start=150, stop=150)
+
+        totals = StorageLedger.get_totals()
+        self.assertEqual(100, totals[StorageLedger.SANDBOXES])
+        snapshot = StorageSnapshot.objects.get(category=StorageLedger.SANDBOXES)
+        self.assertEqual(100, snapshot.total_size)
+        self.assertEqual(1, snapshot.file_count)
+
+    def test_purge_plan_skips_snapshot(self):
+        self.create_sandbox(age=timedelta(minutes=10), size=100)
+
+        purge.Command(stdout=StringIO()).handle(start=50, stop=50, plan=True)
+
+        self.assertEqual(0, StorageSnapshot.objects.count())
+
+    def test_synch_reconciles_ledger(self):
+        self.create_sandbox(age=timedelta(minutes=10), size=100)
+        purge.Command().handle()
+        StorageLedger.objects.filter(category=StorageLedger.SANDBOXES).update(
+            total_size=1000)
+
+        with self.assertLogs('portal.models', logging.WARNING):
+            purge.Command().handle(synch=True)
+
+        totals = StorageLedger.get_totals()
+        self.assertEqual(100, totals[StorageLedger.SANDBOXES])
+
+    def test_synch_skips_unchanged_folders(self):
+        """ Skip unchanged folders, unless they haven't been scanned lately. """
+        dataset_name = os.path.join(Dataset.UPLOAD_DIR, '2018_06', 'forgotten.txt')
+        dataset_path = os.path.join(settings.MEDIA_ROOT, dataset_name)
+        os.makedirs(os.path.dirname(dataset_path))
+        with open(dataset_path, 'wb') as f:
+            f.write(b'.' * 100)
+        old_time = time() - 3600
+        os.utime(dataset_path, (old_time, old_time))
+        os.utime(os.path.dirname(dataset_path), (old_time, old_time))
+        dataset = Dataset.objects.create(user=User.objects.get(username='kive'),
+                                         name='forgotten',
+                                         dataset_file=dataset_name)
+
+        purge.Command().handle(synch=True)
+
+        # Removing the record doesn't change the folder.
+        Dataset.objects.filter(id=dataset.id).update(dataset_file='')
+        purge.Command().handle(synch=True)
+        self.assertTrue(os.path.exists(dataset_path))
+
+        purge.Command().handle(synch=True, rescan=timedelta(0))
+        self.assertFalse(os.path.exists(dataset_path))
+
+    def test_synch_logs_scan_rate(self):
+        with open(os.path.join(ContainerRun.SANDBOX_ROOT, 'extras.txt'),
+                  'wb') as f:
+            f.write(b'.' * 100)
+
+        with self.capture_log_stream(logging.INFO) as mocked_stderr:
+            purge.Command().handle(synch=True)
+            log_messages = mocked_stderr.getvalue()
+
+        self.assertRegex(
+            log_messages,
+            r'Scanned 1 container run file in [0-9.]+s \([0-9]+ per second\), '
+            r'scanned 1 folder and skipped 0 unchanged\.')
+
+    def test_synch_batch_tuning(self):
+        command = purge.Command()
+
+        self.assertEqual(200, command.tune_batch_size(100, 0.01))
+        self.assertEqual(100, command.tune_batch_size(100, 0.2))
+        self.assertEqual(50, command.tune_batch_size(100, 1.0))
+        self.assertEqual(10000, command.tune_batch_size(10000, 0.01))
+        self.assertEqual(1, command.tune_batch_size(1, 1.0))
+
     def test_no_purging_containers(self):
         family = ContainerFamily.objects.first()
         container = family.containers.create(user=family.user)
@@ -4462,3 +5166,146 @@ class ContainerArgumentTests(TestCase):
         for expected_type, kwargs in specs:
             arg = ContainerArgument(name="test_arg", **kwargs)
             self.assertEqual(expected_type, arg.argtype)
+
+
+@skipIfDBFeature('is_mocked')
+@override_settings(MD5_CACHE_POLICY='periodic')
+class ChecksumCacheTests(TestCase):
+    def setUp(self):
+        super(ChecksumCacheTests, self).setUp()
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(b'example contents\n')
+        self.file_path = f.name
+        self.addCleanup(os.remove, self.file_path)
+        with open(self.file_path, 'rb') as f:
+            self.expected_md5 = compute_md5(f)
+        self.stats_before = dict(ChecksumCache.stats)
+
+    def stat_changes(self):
+        return {key: value - self.stats_before[key]
+                for key, value in ChecksumCache.stats.items()}
+
+    def test_miss(self):
+        md5 = ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(self.expected_md5, md5)
+        self.assertEqual(1, self.stat_changes()['misses'])
+        entry = ChecksumCache.objects.get(path=self.file_path)
+        self.assertEqual(self.expected_md5, entry.md5)
+
+    def test_hit(self):
+        ChecksumCache.compute_md5(self.file_path)
+
+        with patch('container.models.compute_md5') as mock_compute:
+            md5 = ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(self.expected_md5, md5)
+        mock_compute.assert_not_called()
+        changes = self.stat_changes()
+        self.assertEqual(1, changes['hits'])
+        self.assertEqual(17, changes['bytes_skipped'])
+        entry = ChecksumCache.objects.get(path=self.file_path)
+        self.assertEqual(1, entry.hit_count)
+
+    def test_many_files(self):
+        ChecksumCache.compute_md5(self.file_path)
+        with NamedTemporaryFile() as new_file:
+            new_file.write(b'new contents\n')
+            new_file.flush()
+            missing_path = new_file.name + '.missing'
+
+            with self.assertLogs('container.models', logging.WARNING):
+                md5s = ChecksumCache.compute_md5s([self.file_path,
+                                                   new_file.name,
+                                                   missing_path])
+
+            new_file.seek(0)
+            new_md5 = compute_md5(new_file)
+            new_entry = ChecksumCache.objects.get(path=new_file.name)
+
+        self.assertEqual({self.file_path: self.expected_md5,
+                          new_file.name: new_md5,
+                          missing_path: None},
+                         md5s)
+        changes = self.stat_changes()
+        self.assertEqual(1, changes['hits'])
+        self.assertEqual(2, changes['misses'])
+        self.assertEqual(new_md5, new_entry.md5)
+
+    def test_changed_file(self):
+        ChecksumCache.compute_md5(self.file_path)
+        with open(self.file_path, 'ab') as f:
+            f.write(b'more\n')
+        with open(self.file_path, 'rb') as f:
+            expected_md5 = compute_md5(f)
+
+        md5 = ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(expected_md5, md5)
+        self.assertEqual(2, self.stat_changes()['misses'])
+
+    def test_always_policy(self):
+        ChecksumCache.compute_md5(self.file_path)
+
+        with self.settings(MD5_CACHE_POLICY=ChecksumCache.ALWAYS):
+            ChecksumCache.compute_md5(self.file_path)
+            os.remove(self.file_path)
+            with open(self.file_path, 'wb') as f:
+                f.write(b'other contents\n')
+            ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(3, self.stat_changes()['misses'])
+        # The cache isn't updated when it isn't used.
+        entry = ChecksumCache.objects.get(path=self.file_path)
+        self.assertEqual(self.expected_md5, entry.md5)
+
+    def test_long_path(self):
+        long_folder = os.path.join(os.path.dirname(self.file_path), 'x' * 200)
+        os.makedirs(long_folder, exist_ok=True)
+        self.addCleanup(os.rmdir, long_folder)
+        long_path = os.path.join(long_folder, 'y' * 200)
+        shutil.copy(self.file_path, long_path)
+        self.addCleanup(os.remove, long_path)
+
+        ChecksumCache.compute_md5(long_path)
+        md5 = ChecksumCache.compute_md5(long_path)
+
+        self.assertEqual(self.expected_md5, md5)
+        self.assertEqual(1, self.stat_changes()['hits'])
+
+    def test_remove_stale(self):
+        ChecksumCache.compute_md5(self.file_path)
+        with NamedTemporaryFile() as f:
+            ChecksumCache.compute_md5(f.name)
+        with NamedTemporaryFile() as f:
+            f.write(b'changed later\n')
+            f.flush()
+            ChecksumCache.compute_md5(f.name)
+            os.utime(f.name, ns=(0, 0))
+
+            removed_count = ChecksumCache.remove_stale(batch_size=2)
+
+        self.assertEqual(2, removed_count)
+        self.assertEqual([self.file_path],
+                         list(ChecksumCache.objects.values_list('path', flat=True)))
+
+    def test_periodic_policy_expired(self):
+        ChecksumCache.compute_md5(self.file_path)
+        ChecksumCache.objects.update(
+            verify_time=timezone.now() - timedelta(days=8))
+
+        with self.settings(MD5_CACHE_POLICY=ChecksumCache.PERIODIC,
+                           MD5_CACHE_VERIFY_AGE='7 days, 0:00:00'):
+            ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(2, self.stat_changes()['misses'])
+
+    def test_trust_policy(self):
+        ChecksumCache.compute_md5(self.file_path)
+        ChecksumCache.objects.update(
+            verify_time=timezone.now() - timedelta(days=8))
+
+        with self.settings(MD5_CACHE_POLICY=ChecksumCache.TRUST):
+            ChecksumCache.compute_md5(self.file_path)
+
+        self.assertEqual(1, self.stat_changes()['hits'])
@@ -5,6 +5,11 @@ import io
 import zipfile
 import tarfile
 import json
+import resource
+import signal
+import sys
+from threading import Barrier
+from time import sleep
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
@@ -16,9 +21,12 @@ from mock import patch, Mock, call
 from rest_framework.test import force_authenticate
 
 from container.ajax import ContainerAppViewSet
+from container.executors import LocalExecutor
 from container.management.commands import runcontainer
 from container.models import Container, ContainerFamily, ContainerApp, \
-    ContainerArgument, ContainerRun, ContainerDataset, ZipHandler, TarHandler
+    ContainerArgument, ContainerRun, ContainerDataset, ZipHandler, TarHandler, \
+    Batch, find_percentile, parse_slurm_duration, parse_slurm_memory
+from file_access_utils import link_tree
 from kive.tests import BaseTestCases, strip_removal_plan
 from librarian.models import Dataset
 from metadata.models import KiveUser
@@ -898,6 +906,47 @@ class ContainerRunMockTests(TestCase):
 
         self.assertListEqual(expected_command, command)
 
+    def test_slurm_array_command(self):
+        batch = Batch(pk=7)
+        runs = []
+        for task_id, run_id in enumerate((99, 100, 101)):
+            run = ContainerRun(pk=run_id, batch=batch)
+            run.user = User(username='bob')
+            run.app = ContainerApp(threads=3, memory=100)
+            run.app.container = Container()
+            run.app.container.family = ContainerFamily(name='my container')
+            run.sandbox_path = 'ContainerRuns/userbob_batch7_run99_task{}'.format(
+                task_id)
+            runs.append(run)
+        expected_prefix = ('/tmp/kive_media/ContainerRuns/'
+                           'userbob_batch7_run99_task%a/logs/job%A_%a_node%N_')
+        expected_command = [
+            'sbatch',
+            '-J', 'b7 my container',
+            '--parsable',
+            '--array', '0-2',
+            '--output', expected_prefix + 'stdout.txt',
+            '--error', expected_prefix + 'stderr.txt',
+            '-c', '3',
+            '--mem', '100',
+            EXPECTED_MANAGE_PATH,
+            'runcontainer',
+            '--array_ids',
+            '99,100,101']
+
+        with patch.object(ContainerRun,
+                          'SANDBOX_ROOT',
+                          '/tmp/kive_media/ContainerRuns'):
+            command = ContainerRun.build_slurm_array_command(runs)
+
+        self.assertListEqual(expected_command, command)
+
+    def test_slurm_job_key(self):
+        self.assertIsNone(ContainerRun().slurm_job_key)
+        self.assertEqual('42', ContainerRun(slurm_job_id=42).slurm_job_key)
+        self.assertEqual('42_3', ContainerRun(slurm_job_id=42,
+                                              slurm_array_task_id=3).slurm_job_key)
+
     def test_rerun_names(self):
         expectations = [('example', 'example (rerun)'),
                         ('', '(rerun)'),
@@ -1005,7 +1054,7 @@ class RunContainerMockTests(TestCase):
             'run',
             '--contain',
             '--cleanenv',
-            '-B', '/tmp/box23/input:/mnt/input,/tmp/box23/output:/mnt/output',
+            '-B', '/tmp/box23/input:/mnt/input:ro,/tmp/box23/output:/mnt/output',
             '/tmp/foo.simg',
             '/mnt/input/in_csv',
             '/mnt/output/out_csv']
@@ -1014,6 +1063,222 @@ class RunContainerMockTests(TestCase):
 
         self.assertListEqual(expected_command, command)
 
+    def run_test_pipeline(self,
+                          threads,
+                          step_returns,
+                          step_barrier=None,
+                          cache_path=None):
+        """ Run a diamond-shaped pipeline with a fake singularity call.
+
+        Step 1 feeds steps 2 and 3, and they both feed step 4.
+        :param threads: the app's thread count
+        :param step_returns: {step_num: return_code} for steps that fail
+        :param step_barrier: a threading.Barrier for steps 2 and 3 to wait on
+        :param cache_path: a folder of extracted files to link the bin folder
+            to, like the extraction cache, or None to write the bin folder
+        :return: (return_code, stdout_text, called_steps)
+        """
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        sandbox_path = temp_dir.name
+        bin_path = os.path.join(sandbox_path, 'bin')
+        if cache_path is None:
+            os.makedirs(bin_path)
+            for step_num in range(1, 5):
+                with open(os.path.join(bin_path, 'step{}.py'.format(step_num)), 'w'):
+                    pass
+        else:
+            link_tree(cache_path, bin_path)
+        for folder in ('input', 'output', 'logs'):
+            os.mkdir(os.path.join(sandbox_path, folder))
+        with open(os.path.join(sandbox_path, 'input', 'in_csv'), 'w') as f:
+            f.write('x\n')
+        run = ContainerRun(id=42, sandbox_path=sandbox_path)
+        run.app = ContainerApp(threads=threads)
+        run.app.container = Container()
+        run.app.container.parent = Container()
+        run.app.container.parent.file = Namespace(path='/tmp/parent.simg')
+
+        def step_dict(step_num, *source_steps):
+            return dict(driver='step{}.py'.format(step_num),
+                        inputs=[dict(dataset_name='in{}_csv'.format(source_step),
+                                     source_step=source_step,
+                                     source_dataset_name=(
+                                         'in_csv'
+                                         if source_step == 0
+                                         else 'out_csv'))
+                                for source_step in source_steps],
+                        outputs=['out_csv'])
+        instructions = dict(
+            inputs=[dict(dataset_name='in_csv')],
+            steps=[step_dict(1, 0),
+                   step_dict(2, 1),
+                   step_dict(3, 1),
+                   step_dict(4, 2, 3)],
+            outputs=[dict(dataset_name='out_csv',
+                          source_step=4,
+                          source_dataset_name='out_csv')])
+        called_steps = []
+        self.step_args = {}  # {step_num: args}
+
+        def fake_call(args, stdout, stderr, env):
+            driver = args[args.index('/tmp/parent.simg') + 1]
+            step_num = int(driver[-4])
+            called_steps.append(step_num)
+            self.step_args[step_num] = args
+            output_bind = args[args.index('--pwd') - 1]
+            external_output_path = output_bind.split(':')[0]
+            for arg in args:
+                if arg.startswith('/mnt/output/'):
+                    with open(os.path.join(external_output_path,
+                                           os.path.basename(arg)), 'w'):
+                        pass
+            if step_barrier is not None and step_num in (2, 3):
+                step_barrier.wait()
+                # Make step 3 finish first, so logs get sorted.
+                if step_num == 2:
+                    sleep(0.1)
+            stdout.write('step {} ran.\n'.format(step_num))
+            usage = resource.struct_rusage(
+                (step_num, 0) + (0,) * (resource.struct_rusage.n_sequence_fields - 2))
+            return step_returns.get(step_num, 0), usage
+
+        handler = runcontainer.Command()
+        stdout_path = os.path.join(sandbox_path, 'logs', 'stdout.txt')
+        stderr_path = os.path.join(sandbox_path, 'logs', 'stderr.txt')
+        with patch('container.management.commands.runcontainer.call_with_usage',
+                   side_effect=fake_call), \
+                open(stdout_path, 'w') as stdout, \
+                open(stderr_path, 'w') as stderr:
+            return_code = handler.run_pipeline(instructions,
+                                               run,
+                                               stdout,
+                                               stderr,
+                                               bin_path,
+                                               os.path.join(sandbox_path, 'input'),
+                                               os.path.join(sandbox_path, 'output'),
+                                               is_bin_read_only=cache_path is not None)
+        with open(stdout_path) as f:
+            stdout_text = f.read()
+        self.phases = handler.phases
+        self.sandbox_path = sandbox_path
+        return return_code, stdout_text, called_steps
+
+    def test_pipeline_parallel_steps(self):
+        # Times out if steps 2 and 3 don't run at the same time.
+        step_barrier = Barrier(2, timeout=10)
+        expected_stdout = ''.join(
+            '========\nProcessing step {0}: step{0}.py\n========\n'
+            'step {0} ran.\n'.format(step_num)
+            for step_num in range(1, 5))
+
+        return_code, stdout_text, called_steps = self.run_test_pipeline(
+            threads=2,
+            step_returns={},
+            step_barrier=step_barrier)
+
+        self.assertEqual(0, return_code)
+        self.assertEqual(expected_stdout, stdout_text)
+        self.assertEqual(1, called_steps[0])
+        self.assertEqual({2, 3}, set(called_steps[1:3]))
+        self.assertEqual(4, called_steps[3])
+        # Each step only counts its own child's CPU, even in parallel.
+        self.assertEqual({'step 1: step1.py': 1,
+                          'step 2: step2.py': 2,
+                          'step 3: step3.py': 3,
+                          'step 4: step4.py': 4},
+                         {phase.name: phase.user_cpu for phase in self.phases})
+
+    def test_pipeline_sequential_with_one_thread(self):
+        return_code, stdout_text, called_steps = self.run_test_pipeline(
+            threads=1,
+            step_returns={})
+
+        self.assertEqual(0, return_code)
+        self.assertEqual([1, 2, 3, 4], called_steps)
+
+    def test_pipeline_binds(self):
+        self.run_test_pipeline(threads=1, step_returns={})
+
+        step_path = os.path.join(self.sandbox_path, 'step1')
+        args = self.step_args[1]
+        binds = [args[i + 1] for i, arg in enumerate(args) if arg == '-B']
+        self.assertEqual([step_path + '/bin:/mnt/bin',
+                          step_path + '/input:/mnt/input:ro',
+                          step_path + '/output:/mnt/output'],
+                         binds)
+
+    def test_pipeline_cached_bin(self):
+        """ Steps can't change the files they share with the cache. """
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        cache_path = cache_dir.name
+        for step_num in range(1, 5):
+            step_path = os.path.join(cache_path, 'step{}.py'.format(step_num))
+            with open(step_path, 'w') as f:
+                f.write('# cached step\n')
+            # Not executable, so the driver has to be made executable.
+            os.chmod(step_path, 0o444)
+
+        return_code, _, _ = self.run_test_pipeline(threads=1,
+                                                   step_returns={},
+                                                   cache_path=cache_path)
+
+        self.assertEqual(0, return_code)
+        for step_num in range(1, 5):
+            file_name = 'step{}.py'.format(step_num)
+            cached_file_path = os.path.join(cache_path, file_name)
+            self.assertEqual(0o444, os.stat(cached_file_path).st_mode & 0o777)
+            with open(cached_file_path) as f:
+                self.assertEqual('# cached step\n', f.read())
+            step_bin_path = os.path.join(self.sandbox_path,
+                                         'step{}'.format(step_num),
+                                         'bin')
+            driver_path = os.path.join(step_bin_path, file_name)
+            self.assertTrue(os.access(driver_path, os.X_OK))
+            self.assertFalse(os.path.samefile(cached_file_path, driver_path))
+            args = self.step_args[step_num]
+            self.assertIn(step_bin_path + ':/mnt/bin:ro', args)
+
+    def test_pipeline_failure_stops_launches(self):
+        return_code, stdout_text, called_steps = self.run_test_pipeline(
+            threads=1,
+            step_returns={2: 7})
+
+        self.assertEqual(7, return_code)
+        self.assertEqual([1, 2], called_steps)
+        self.assertNotIn('step 3', stdout_text)
+
+    def test_timed_phase(self):
+        handler = runcontainer.Command()
+
+        with handler.timed_phase('first'):
+            pass
+        with handler.timed_phase('second') as phase:
+            phase.bytes_staged = 100
+
+        self.assertEqual(['first', 'second'],
+                         [phase.name for phase in handler.phases])
+        self.assertEqual(1, phase.position)
+        self.assertEqual(100, phase.bytes_staged)
+        self.assertGreaterEqual(phase.duration, 0)
+        self.assertIsNotNone(phase.user_cpu)
+
+    def test_call_with_usage(self):
+        return_code, usage = runcontainer.call_with_usage(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'])
+
+        self.assertEqual(3, return_code)
+        self.assertGreater(usage.ru_maxrss, 0)
+
+    @patch.dict('os.environ', SLURM_ARRAY_TASK_ID='2')
+    def test_array_run_id(self):
+        handler = runcontainer.Command()
+
+        run_id = handler.find_array_run_id('97,98,99,100')
+
+        self.assertEqual(99, run_id)
+
     def test_named_app(self):
         run = self.build_run()
         run.app.name = 'other_app'
@@ -1023,7 +1288,7 @@ class RunContainerMockTests(TestCase):
             'run',
             '--contain',
             '--cleanenv',
-            '-B', '/tmp/box23/input:/mnt/input,/tmp/box23/output:/mnt/output',
+            '-B', '/tmp/box23/input:/mnt/input:ro,/tmp/box23/output:/mnt/output',
             '--app', 'other_app',
             '/tmp/foo.simg',
             '/mnt/input/in_csv',
@@ -1049,6 +1314,7 @@ class RunContainerMockTests(TestCase):
 
             self.assertEqual(expected_dataset_name, dataset_name)
 
+    @patch("container.management.commands.runcontainer.ContainerDataset")
     @patch("container.management.commands.runcontainer.Dataset")
     @patch("os.rename")
     @patch("os.walk",
@@ -1057,7 +1323,11 @@ class RunContainerMockTests(TestCase):
                ('/tmp/runsandbox/output/datafiles', ['subdir'], ['a.txt', 'b.txt']),
                ('/tmp/runsandbox/output/datafiles/subdir', [], ['c.txt'])
            ]))
-    def test_save_output_directory(self, mock_walk, mock_rename, dataset_mock):
+    def test_save_output_directory(self,
+                                   mock_walk,
+                                   mock_rename,
+                                   dataset_mock,
+                                   container_dataset_mock):
         """Simulate saving a directory output called "datafiles/" with the following structure:
 
         /tmp/runsandbox/output/
@@ -1076,9 +1346,13 @@ class RunContainerMockTests(TestCase):
         output_path = "/tmp/runsandbox/output/"
         upload_path = "/tmp/runsandbox/upload"
 
-        dataset_mock.create_dataset = Mock(return_value=Mock())
+        def create_datasets(file_names, on_batch, **kwargs):
+            datasets = [Mock() for _ in file_names]
+            on_batch(datasets)
+            return datasets
+        dataset_mock.create_datasets = Mock(side_effect=create_datasets)
 
-        runcontainer.Command._save_output_directory_argument(
+        file_count = runcontainer.Command._save_output_directory_argument(
             run,
             argument,
             output_path,
@@ -1104,3 +1378,237 @@ class RunContainerMockTests(TestCase):
             ],
             any_order=True,
         )
+        self.assertEqual(3, file_count)
+        dataset_mock.create_datasets.assert_called_once()
+        file_names = dataset_mock.create_datasets.call_args[0][0]
+        self.assertIn(("/tmp/runsandbox/upload/datafiles__subdir__c_9981.txt",
+                       "datafiles/subdir/c_9981.txt"),
+                      file_names)
+        container_dataset_mock.objects.bulk_create.assert_called_once()
+
+
+@mocked_relations(ContainerRun)
+@patch('container.executors.Popen')
+class LocalExecutorMockTests(TestCase):
+    def setUp(self):
+        super(LocalExecutorMockTests, self).setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.sandbox_root = temp_dir.name
+        self.next_id = 100
+
+    def create_run(self, threads=1, memory=100, priority=0):
+        self.next_id += 1
+        run = ContainerRun(id=self.next_id,
+                           state=ContainerRun.NEW,
+                           priority=priority)
+        run.app = ContainerApp(threads=threads, memory=memory)
+        run.sandbox_path = os.path.join(self.sandbox_root, str(run.id))
+        os.makedirs(os.path.join(run.sandbox_path, 'logs'))
+        ContainerRun.objects.add(run)
+        return run
+
+    @staticmethod
+    def get_launched_ids(mock_popen):
+        return [int(args[0][-1]) for args, kwargs in mock_popen.call_args_list]
+
+    def test_submit(self, mock_popen):
+        """ Submitting only queues the run for the dispatcher. """
+        executor = LocalExecutor(max_threads=4, max_memory=0)
+        run1 = self.create_run()
+        run2 = self.create_run()
+
+        executor.submit(run2, [run1])
+
+        mock_popen.assert_not_called()
+        queue_path = os.path.join(run2.sandbox_path,
+                                  'logs',
+                                  LocalExecutor.QUEUE_FILE_NAME)
+        with open(queue_path) as f:
+            self.assertEqual(str(run1.id), f.read())
+
+    def test_thread_limit(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=4, max_memory=0)
+        run1 = self.create_run(threads=2)
+        run2 = self.create_run(threads=2)
+        run3 = self.create_run(threads=2)
+        for run in (run1, run2, run3):
+            executor.submit(run)
+
+        executor.dispatch()
+
+        self.assertEqual([run1.id, run2.id], self.get_launched_ids(mock_popen))
+        args, kwargs = mock_popen.call_args_list[0]
+        self.assertEqual(['runcontainer', str(run1.id)], args[0][-2:])
+        self.assertTrue(kwargs['start_new_session'])
+        pid_path = os.path.join(run1.sandbox_path,
+                                'logs',
+                                LocalExecutor.PID_FILE_NAME)
+        with open(pid_path) as f:
+            self.assertEqual('4321', f.read())
+
+    def test_memory_limit(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=8, max_memory=1000)
+        run1 = self.create_run(memory=600)
+        run2 = self.create_run(memory=600)
+        run3 = self.create_run(memory=400)
+        for run in (run1, run2, run3):
+            executor.submit(run)
+
+        executor.dispatch()
+
+        self.assertEqual([run1.id, run3.id], self.get_launched_ids(mock_popen))
+
+    def test_launch_after_finish(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        mock_popen.return_value.returncode = 0
+        executor = LocalExecutor(max_threads=2, max_memory=0)
+        run1 = self.create_run(threads=2)
+        run2 = self.create_run(threads=2)
+        executor.submit(run1)
+        executor.submit(run2)
+        executor.dispatch()
+        self.assertEqual([run1.id], self.get_launched_ids(mock_popen))
+        mock_popen.return_value.poll.return_value = 0
+        run1.state = ContainerRun.COMPLETE
+
+        executor.dispatch()
+
+        self.assertEqual([run1.id, run2.id], self.get_launched_ids(mock_popen))
+
+    def test_oversized_run(self, mock_popen):
+        """ A run bigger than the pool still gets to run by itself. """
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=2, max_memory=1000)
+        run1 = self.create_run(threads=4, memory=0)
+        run2 = self.create_run(threads=1)
+        executor.submit(run1)
+        executor.submit(run2)
+
+        executor.dispatch()
+
+        self.assertEqual([run1.id], self.get_launched_ids(mock_popen))
+
+    def test_priority(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=1, max_memory=0)
+        run1 = self.create_run()
+        run2 = self.create_run(priority=0)
+        run3 = self.create_run(priority=2)
+        for run in (run1, run2, run3):
+            executor.submit(run)
+
+        executor.dispatch()
+
+        self.assertEqual([run3.id], self.get_launched_ids(mock_popen))
+
+    def test_dependencies(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=4, max_memory=0)
+        run1 = self.create_run()
+        run2 = self.create_run()
+        executor.submit(run1)
+        executor.submit(run2, [run1])
+        executor.dispatch()
+        self.assertEqual([run1.id], self.get_launched_ids(mock_popen))
+        mock_popen.return_value.poll.return_value = 0
+        mock_popen.return_value.returncode = 0
+        run1.state = ContainerRun.COMPLETE
+
+        executor.dispatch()
+
+        self.assertEqual([run1.id, run2.id], self.get_launched_ids(mock_popen))
+
+    def test_cancel_waiting(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=1, max_memory=0)
+        run = self.create_run()
+        executor.submit(run)
+        run.state = ContainerRun.CANCELLED
+
+        executor.dispatch()
+
+        mock_popen.assert_not_called()
+
+    @patch('container.executors.os.killpg')
+    def test_cancel_running(self, mock_killpg, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        executor = LocalExecutor(max_threads=1, max_memory=0)
+        run = self.create_run()
+        executor.submit(run)
+        executor.dispatch()
+
+        # Another process cancels it, so it only has the pid file.
+        LocalExecutor().cancel(run)
+
+        mock_killpg.assert_called_once_with(4321, signal.SIGTERM)
+
+    @patch('container.executors.LocalExecutor.is_alive', return_value=True)
+    def test_restart(self, mock_is_alive, mock_popen):
+        """ Runs from a previous dispatcher still count against the limits. """
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        run1 = self.create_run()
+        run2 = self.create_run()
+        LocalExecutor(max_threads=1, max_memory=0).submit(run1)
+        LocalExecutor(max_threads=1, max_memory=0).submit(run2)
+        LocalExecutor(max_threads=1, max_memory=0).dispatch()
+
+        LocalExecutor(max_threads=1, max_memory=0).dispatch()
+
+        self.assertEqual([run1.id], self.get_launched_ids(mock_popen))
+        mock_is_alive.assert_called_once_with(4321)
+
+    @patch('container.executors.LocalExecutor.fail')
+    @patch('container.executors.LocalExecutor.is_alive', return_value=False)
+    def test_dead_process(self, mock_is_alive, mock_fail, mock_popen):
+        mock_popen.return_value.poll.return_value = None
+        mock_popen.return_value.pid = 4321
+        run = self.create_run()
+        LocalExecutor().submit(run)
+        LocalExecutor().dispatch()
+
+        LocalExecutor().check_states()
+
+        mock_fail.assert_called_once_with(run.id,
+                                          'Local process is no longer running.')
+
+
+class SlurmParsingMockTests(TestCase):
+    def test_durations(self):
+        scenarios = [('00:03:00', 180),
+                     ('05:30.500', 330.5),
+                     ('1-02:03:04', 93784),
+                     ('', None),
+                     ('INVALID', None)]
+
+        for text, expected_seconds in scenarios:
+            self.assertEqual(expected_seconds, parse_slurm_duration(text), text)
+
+    def test_memory(self):
+        scenarios = [('1500.50M', 1501),
+                     ('2G', 2048),
+                     ('512K', 1),
+                     ('0', 0),
+                     ('', None)]
+
+        for text, expected_megabytes in scenarios:
+            self.assertEqual(expected_megabytes, parse_slurm_memory(text), text)
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+
+        self.assertEqual(3, find_percentile(values, 50))
+        self.assertEqual(5, find_percentile(values, 95))
+        self.assertEqual(1, find_percentile(values, 0))
+        self.assertIsNone(find_percentile([], 50))
@@ -18,7 +18,7 @@ import rest_framework.reverse
 from container.forms import ContainerFamilyForm, ContainerForm, \
     ContainerUpdateForm, ContainerAppForm, ContainerRunForm, BatchForm
 from container.models import ContainerFamily, Container, ContainerApp, \
-    ContainerRun, ContainerArgument, ContainerLog, Batch
+    ContainerRun, ContainerArgument, ContainerLog, Batch, SlurmPoll
 from container.runutils import compare_rerun_datasets
 from portal.views import developer_check, AdminViewMixin
 
@@ -293,6 +293,7 @@ class ContainerRunUpdate(UpdateView, AdminViewMixin):
         context['is_dev'] = developer_check(self.request.user)
         state_names = dict(ContainerRun.STATES)
         context['state_name'] = state_names.get(self.object.state)
+        context['slurm_poll_time'] = SlurmPoll.get_poll_time()
         data_entries = []
 
         if self.object.original_run:
@@ -319,17 +320,12 @@ class ContainerRunUpdate(UpdateView, AdminViewMixin):
                 size=log.size_display,
                 created=self.object.end_time))
         context['data_entries'] = data_entries
+        context['phases'] = self.object.phases.all()
         return context
 
     def get_success_url(self):
         return reverse('container_runs')
 
-    def get(self, request, *args, **kwargs):
-        # noinspection PyTypeChecker
-        pk = kwargs.get('pk')
-        ContainerRun.check_slurm_state(pk)
-        return super(ContainerRunUpdate, self).get(request, *args, **kwargs)
-
 
 @method_decorator(login_required, name='dispatch')
 class ContainerLogDetail(DetailView):
@@ -2,28 +2,185 @@
 Basic file-checking functionality used by Kive.
 """
 
+import errno
 import hashlib
+import json
+import logging
 import mimetypes
 import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from contextlib import contextmanager
+from time import perf_counter, sleep, time
+from urllib.parse import quote
 
-from django.http import FileResponse
+from django.conf import settings
+from django.core.files import File
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
 
+logger = logging.getLogger(__name__)
+
+# Ioctl request number for FICLONE on Linux, from linux/fs.h.
+FICLONE = 0x40049409
+STAGING_STRATEGIES = ('hardlink', 'reflink', 'copy_range', 'copy')
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def _find_local_path(field_file):
+    """ Find the file's path on disk, or None if it isn't a local file. """
+    try:
+        path = field_file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        path = field_file.name
+    if path and os.path.isabs(path) and os.path.isfile(path):
+        return path
+    return None
+
+
+def _parse_range(request, size, etag, last_modified):
+    """ Parse a single byte range from the request's Range header.
+
+    :return: (start, end) with end included, or None to send the whole file,
+        because there was no range, the If-Range validator didn't match, or
+        it asked for several ranges at once.
+    :raises RangeNotSatisfiable: if the range starts past the end of the file
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if not range_header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and (etag is None or
+                                 if_range not in (etag, last_modified)):
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        return None
+    start_text, end_text = match.groups()
+    if not start_text:
+        if not end_text:
+            return None
+        suffix_length = int(end_text)
+        if suffix_length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - suffix_length, 0), size - 1
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def _read_range(field_file, start, length, chunk_size=FileResponse.block_size):
+    try:
+        field_file.seek(start)
+        while length > 0:
+            chunk = field_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        field_file.close()
+
+
+def _build_offload_response(file_path):
+    """ Ask the web server to send the file, or return None if it can't. """
+    if settings.DOWNLOAD_OFFLOAD == 'xsendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = file_path
+        return response
+    if settings.DOWNLOAD_OFFLOAD == 'xaccel':
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        relative_path = os.path.relpath(file_path, media_root)
+        if relative_path.startswith(os.pardir):
+            # nginx can only see MEDIA_ROOT, so stream external files.
+            return None
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = quote(
+            settings.DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' +
+            relative_path.replace(os.sep, '/'))
+        return response
+    if settings.DOWNLOAD_OFFLOAD:
+        raise ValueError('Unknown DOWNLOAD_OFFLOAD: {!r}.'.format(
+            settings.DOWNLOAD_OFFLOAD))
+    return None
+
+
+def build_download_response(field_file,
+                            request=None,
+                            file_name=None,
+                            content_type=None):
+    """ Build a response that downloads a file as an attachment.
+
+    If DOWNLOAD_OFFLOAD is set, the web server sends files from disk.
+    Otherwise, the file is streamed, and a single range from the request's
+    Range header gets a partial response, so clients can resume downloads.
+    :param field_file: a FieldFile or File to send
+    :param request: the request, to check for Range and If-Range headers
+    :param file_name: the attachment's name, defaults to the file's name
+    :param content_type: defaults to a guess from the attachment's name
+    """
+    if file_name is None:
+        file_name = os.path.basename(field_file.name)
+    if content_type is None:
+        content_type = (mimetypes.guess_type(file_name)[0] or
+                        'application/octet-stream')
+    disposition = 'attachment; filename="{}"'.format(file_name)
+    file_path = _find_local_path(field_file)
+    if file_path is None:
+        etag = last_modified = None
+    else:
+        response = _build_offload_response(file_path)
+        if response is not None:
+            field_file.close()
+            response['Content-Type'] = content_type
+            response['Content-Disposition'] = disposition
+            return response
+        file_stat = os.stat(file_path)
+        etag = '"{:x}-{:x}"'.format(file_stat.st_size, file_stat.st_mtime_ns)
+        last_modified = http_date(file_stat.st_mtime)
 
-def build_download_response(field_file):
     # Intentionally leave this open for streaming response.
-    # FileResponse will close it when streaming finishes.
+    # The response will close it when streaming finishes.
     field_file.open('rb')
-
-    mimetype = mimetypes.guess_type(field_file.name)[0]
-    response = FileResponse(field_file, content_type=mimetype)
-    response['Content-Length'] = field_file.size
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
-        os.path.basename(field_file.name))
+    size = field_file.size
+    try:
+        byte_range = (None
+                      if request is None
+                      else _parse_range(request, size, etag, last_modified))
+    except RangeNotSatisfiable:
+        field_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+    if byte_range is None:
+        response = FileResponse(field_file, content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            _read_range(field_file, start, length),
+            status=206,
+            content_type=content_type)
+        response['Content-Length'] = length
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Content-Disposition'] = disposition
+    response['Accept-Ranges'] = 'bytes'
+    if etag is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
     return response
 
 
-def compute_md5(file_to_checksum, chunk_size=1024*64):
+def compute_md5(file_to_checksum, chunk_size=1024*64, buffer=None, limiter=None):
     """Computes MD5 checksum of specified file.
 
     file_to_checksum should be an open, readable, file handle, with
@@ -31,13 +188,151 @@ def compute_md5(file_to_checksum, chunk_size=1024*64):
     entire contents of the file.
     NOTE: under python3, the file should have been open in binary mode ("rb")
     so that bytes (not strings) are returned when iterating over the file.
+
+    :param chunk_size: number of bytes to read at a time
+    :param bytearray buffer: reused for reading, if its size is chunk_size,
+        so many files can be hashed without allocating each chunk
+    :param BandwidthLimiter limiter: slows down reading to share the file
+        system with other users
     """
     md5gen = hashlib.md5()
+    readinto = getattr(file_to_checksum, 'readinto', None)
+    if readinto is None:
+        while True:
+            chunk = file_to_checksum.read(chunk_size)
+            if not chunk:
+                return md5gen.hexdigest()
+            if limiter is not None:
+                limiter.consume(len(chunk))
+            md5gen.update(chunk)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
     while True:
-        chunk = file_to_checksum.read(chunk_size)
-        if not chunk:
+        byte_count = readinto(view)
+        if not byte_count:
             return md5gen.hexdigest()
+        if limiter is not None:
+            limiter.consume(byte_count)
+        md5gen.update(view[:byte_count])
+
+
+def compute_checksums(file_to_checksum, chunk_size=1024*64):
+    """ Computes MD5 and SHA-256 checksums of a file in a single pass.
+
+    :param file_to_checksum: an open, binary file handle at the start of
+        the file
+    :return: (md5, sha256) as hex strings
+    """
+    md5gen = hashlib.md5()
+    sha256gen = hashlib.sha256()
+    for chunk in iter(lambda: file_to_checksum.read(chunk_size), b''):
         md5gen.update(chunk)
+        sha256gen.update(chunk)
+    return md5gen.hexdigest(), sha256gen.hexdigest()
+
+
+class HashingFile(File):
+    """ Calculates an MD5 while storage reads the file's chunks.
+
+    Saving one of these in a FileField copies and hashes the file in a single
+    pass, then the checksum is available in the md5 attribute. If sha256 is
+    True, the SHA-256 checksum is also available in the sha256 attribute.
+    """
+    def __init__(self, file, name=None, sha256=False):
+        super().__init__(file, name)
+        self.md5 = None
+        self.sha256 = None
+        self.is_sha256_needed = sha256
+
+    def chunks(self, chunk_size=None):
+        md5gen = hashlib.md5()
+        sha256gen = hashlib.sha256() if self.is_sha256_needed else None
+        for chunk in super().chunks(chunk_size):
+            md5gen.update(chunk)
+            if sha256gen is not None:
+                sha256gen.update(chunk)
+            yield chunk
+        self.md5 = md5gen.hexdigest()
+        if sha256gen is not None:
+            self.sha256 = sha256gen.hexdigest()
+
+
+class BandwidthLimiter:
+    """ Caps the total read rate of all the threads that share it. """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.start = None
+        self.byte_count = 0
+
+    def consume(self, byte_count):
+        """ Record bytes that were read, and sleep if they were too fast. """
+        with self.lock:
+            now = perf_counter()
+            if self.start is None:
+                self.start = now
+            self.byte_count += byte_count
+            delay = self.start + self.byte_count / self.bytes_per_second - now
+        if delay > 0:
+            sleep(delay)
+
+
+def compute_md5s(files, thread_count=None, chunk_size=None, max_bandwidth=None):
+    """ Compute MD5 checksums of many files on a pool of threads.
+
+    hashlib releases the GIL on large chunks, so threads can hash in
+    parallel, as well as waiting for slow file systems.
+    :param files: an iterable of file paths or open binary file handles,
+        read lazily so it can be a generator over many files
+    :param thread_count: number of files to hash at once, defaults to
+        MD5_THREADS
+    :param chunk_size: bytes to read at a time, defaults to MD5_CHUNK_SIZE
+    :param max_bandwidth: total megabytes per second for all threads to
+        read, defaults to MD5_MAX_BANDWIDTH, and zero means no limit
+    :return: a generator of (file, md5) pairs as each file is finished, not
+        in the original order. md5 is None if the file could not be read.
+    """
+    if thread_count is None:
+        thread_count = settings.MD5_THREADS
+    if chunk_size is None:
+        chunk_size = settings.MD5_CHUNK_SIZE
+    if max_bandwidth is None:
+        max_bandwidth = settings.MD5_MAX_BANDWIDTH
+    limiter = (BandwidthLimiter(max_bandwidth * 1024 * 1024)
+               if max_bandwidth
+               else None)
+    buffers = threading.local()
+
+    def hash_file(file_to_checksum):
+        buffer = getattr(buffers, 'buffer', None)
+        if buffer is None:
+            buffer = buffers.buffer = bytearray(chunk_size)
+        try:
+            if not isinstance(file_to_checksum, (str, os.PathLike)):
+                return compute_md5(file_to_checksum, chunk_size, buffer, limiter)
+            with open(file_to_checksum, 'rb') as f:
+                return compute_md5(f, chunk_size, buffer, limiter)
+        except OSError as ex:
+            logger.warning('Could not hash %s: %s', file_to_checksum, ex)
+            return None
+
+    # Only queue a few files per thread, so results start streaming back
+    # without reading the whole list of files first.
+    max_pending = thread_count * 4
+    executor = ThreadPoolExecutor(max_workers=thread_count)
+    try:
+        pending = {}
+        for file_to_checksum in files:
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(hash_file, file_to_checksum)] = file_to_checksum
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
 
 
 @contextmanager
@@ -60,3 +355,238 @@ def use_field_file(field_file, mode='rb'):
             field_file.close()
         else:
             field_file.seek(start_position)
+
+
+def _stage_hardlink(source_path, target_path):
+    os.link(source_path, target_path)
+
+
+def _stage_reflink(source_path, target_path):
+    import fcntl  # Not available on Windows.
+    with open(source_path, 'rb') as source_file, \
+            open(target_path, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+
+def _stage_copy_range(source_path, target_path):
+    """ Copy inside the kernel, without passing through user space. """
+    with open(source_path, 'rb') as source_file, \
+            open(target_path, 'wb') as target_file:
+        remaining = os.fstat(source_file.fileno()).st_size
+        copy_range = getattr(os, 'copy_file_range', None)
+        while remaining > 0:
+            if copy_range is not None:
+                try:
+                    copied = copy_range(source_file.fileno(),
+                                        target_file.fileno(),
+                                        remaining)
+                except OSError as ex:
+                    if ex.errno not in (errno.EXDEV,
+                                        errno.ENOSYS,
+                                        errno.EINVAL,
+                                        errno.EOPNOTSUPP):
+                        raise
+                    # Older kernels can't copy between file systems.
+                    copy_range = None
+                    continue
+            else:
+                copied = os.sendfile(target_file.fileno(),
+                                     source_file.fileno(),
+                                     None,
+                                     remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def _stage_copy(source_path, target_path):
+    with open(source_path, 'rb') as source_file, \
+            open(target_path, 'wb') as target_file:
+        shutil.copyfileobj(source_file, target_file)
+
+
+STAGING_FUNCTIONS = dict(hardlink=_stage_hardlink,
+                         reflink=_stage_reflink,
+                         copy_range=_stage_copy_range,
+                         copy=_stage_copy)
+
+
+def stage_file(source_path, target_path, strategies=STAGING_STRATEGIES):
+    """ Make a file's contents available at a new path as cheaply as possible.
+
+    Tries each strategy in order, and falls back to the next one when the
+    file system doesn't support it. A hard link shares the source file, so
+    the caller must make sure nothing writes to the target. A reflink shares
+    the data blocks until either copy is written, and the other strategies
+    make a full copy.
+    :param str source_path: the file to stage
+    :param str target_path: where to stage it, must not exist yet
+    :param strategies: a sequence of names from STAGING_STRATEGIES
+    :return str: the name of the strategy that succeeded
+    """
+    if not strategies:
+        raise ValueError('No staging strategies given.')
+    for i, strategy in enumerate(strategies):
+        stage_function = STAGING_FUNCTIONS[strategy]
+        is_last = i == len(strategies) - 1
+        try:
+            stage_function(source_path, target_path)
+            return strategy
+        except (OSError, IOError) as ex:
+            if is_last or ex.errno == errno.ENOENT and not os.path.exists(source_path):
+                raise
+            logger.debug('Staging strategy %s failed for %s: %s',
+                         strategy,
+                         source_path,
+                         ex)
+            if strategy != 'hardlink':
+                # Remove any partial copy before trying the next strategy.
+                try:
+                    os.remove(target_path)
+                except FileNotFoundError:
+                    pass
+
+
+def _link_or_copy(source_path, target_path):
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+
+
+def link_tree(source_path, target_path, ignore=None):
+    """ Copy a folder tree by hard linking all the files.
+
+    Files that can't be linked, like on another file system, are copied.
+    The linked files share their permissions with the source tree, so make
+    the source files read-only if nothing should change them.
+    :param str source_path: the folder to copy
+    :param str target_path: where to copy it, must not exist yet
+    :param ignore: a callable like the ignore parameter of shutil.copytree
+    """
+    shutil.copytree(source_path,
+                    target_path,
+                    symlinks=True,
+                    ignore=ignore,
+                    copy_function=_link_or_copy)
+
+
+class ScanManifest:
+    """ Remember each folder's modification time when it was scanned.
+
+    A folder's modification time only changes when entries are added,
+    removed, or renamed, so unchanged folders can be skipped on the next
+    scan. Files that were deleted from the database without removing them
+    from disk don't change anything, so each folder is rescanned anyway
+    after rescan_age seconds.
+    """
+    # Folders changed this recently might still change within the same tick.
+    MIN_AGE = 1.0
+
+    def __init__(self, path=None, rescan_age=None):
+        """ Initialize.
+
+        :param str path: the JSON file to load from and save to, or None to
+            keep it in memory
+        :param float rescan_age: seconds before unchanged folders get
+            rescanned, or None to never rescan them
+        """
+        self.path = path
+        self.rescan_age = rescan_age
+        self.folders = {}  # {relative_path: [mtime_ns, scan_time, child_names]}
+        self.visited_folders = {}
+        self.changed_folders = set()
+        self.scanned_count = self.skipped_count = self.file_count = 0
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.folders = json.load(f)['folders']
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError):
+                logger.warning('Ignoring invalid scan manifest %r.', path)
+
+    def find_unchanged(self, relative_path, mtime_ns):
+        """ Find the child folders of a folder, if it hasn't changed.
+
+        :return: a list of child folder names, or None if it needs a scan
+        """
+        entry = self.folders.get(relative_path)
+        if entry is None:
+            return None
+        old_mtime_ns, scan_time, child_names = entry
+        if old_mtime_ns != mtime_ns:
+            return None
+        if self.rescan_age is not None and time() - scan_time > self.rescan_age:
+            return None
+        self.visited_folders[relative_path] = entry
+        self.skipped_count += 1
+        return child_names
+
+    def record(self, relative_path, mtime_ns, child_names):
+        self.scanned_count += 1
+        if time() - mtime_ns / 1e9 < self.MIN_AGE:
+            return
+        self.visited_folders[relative_path] = [mtime_ns, time(), child_names]
+
+    def mark_changed(self, relative_path):
+        """ Scan a folder again next time, like when some files were kept. """
+        self.changed_folders.add(relative_path)
+
+    def save(self):
+        """ Save the folders visited since loading, and forget the others. """
+        for relative_path in self.changed_folders:
+            self.visited_folders.pop(relative_path, None)
+        self.folders = self.visited_folders
+        self.visited_folders = {}
+        self.changed_folders.clear()
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(dict(folders=self.folders), f)
+        os.replace(temp_path, self.path)
+
+
+def scan_media_folder(relative_root, recursive=False, manifest=None):
+    """ Yield all file names in a folder, relative to MEDIA_ROOT.
+
+    :param str relative_root: the folder to scan, relative to MEDIA_ROOT
+    :param bool recursive: True if files in child folders should be listed,
+        as well as empty child folders. Otherwise, child folders are listed
+        like files.
+    :param ScanManifest manifest: records scanned folders, and skips the
+        ones that haven't changed since the last scan
+    """
+    folders = [relative_root]
+    while folders:
+        relative_folder = folders.pop()
+        absolute_folder = os.path.join(settings.MEDIA_ROOT, relative_folder)
+        try:
+            mtime_ns = os.stat(absolute_folder).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if manifest is not None:
+            child_names = manifest.find_unchanged(relative_folder, mtime_ns)
+            if child_names is not None:
+                folders.extend(os.path.join(relative_folder, child_name)
+                               for child_name in child_names)
+                continue
+        child_names = []
+        file_count = 0
+        with os.scandir(absolute_folder) as entries:
+            for entry in entries:
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    child_names.append(entry.name)
+                else:
+                    file_count += 1
+                    yield os.path.join(relative_folder, entry.name)
+        if recursive and not (child_names or file_count) and relative_folder != relative_root:
+            # Empty folder can be purged.
+            yield relative_folder
+        if manifest is not None:
+            manifest.file_count += file_count
+            manifest.record(relative_folder, mtime_ns, child_names)
+        folders.extend(os.path.join(relative_folder, child_name)
+                       for child_name in child_names)
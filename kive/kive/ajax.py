@@ -1,6 +1,11 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
 from django.core.exceptions import ValidationError as DjangoValidationError, \
     NON_FIELD_ERRORS as DJANGO_NON_FIELD_ERRORS
-from django.db import transaction
+from django.db import transaction, connections
+from django.db.models import Q
 
 from rest_framework import permissions, mixins, serializers
 from rest_framework.decorators import action
@@ -8,10 +13,12 @@ from rest_framework.generics import GenericAPIView
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.viewsets import ReadOnlyModelViewSet
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, ParseError
 
 from archive.models import summarize_redaction_plan
+from kive.serializers import is_field_selected
 from metadata.models import AccessControl
 from portal.views import developer_check, admin_check
 
@@ -35,8 +42,111 @@ def convert_validation(ex):
     return serializers.ValidationError(errors)
 
 
+def estimate_count(queryset):
+    """ Ask the query planner how many rows there are, instead of counting.
+
+    Only PostgreSQL gives estimates, so other databases count the rows.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
 class StandardPagination(PageNumberPagination):
+    """ Page numbers, with an optional cursor mode for large tables.
+
+    If the view sets cursor_ordering to a pair of fields, like
+    ('-date_created', '-id'), then these query parameters page through the
+    list without counting it or skipping over an offset:
+
+    * cursor= - start at the first page, then follow the next links
+    * page_size=n - the number of records on each page, default 100
+    * count=approximate - include an estimated count of all the records
+    """
     page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    cursor_page_size = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_ordering = getattr(view, 'cursor_ordering', None)
+        if (self.cursor_ordering is None or
+                self.cursor_query_param not in request.query_params):
+            self.cursor_ordering = None
+            return super(StandardPagination, self).paginate_queryset(queryset,
+                                                                     request,
+                                                                     view)
+        self.request = request
+        page_size = self.get_page_size(request) or self.cursor_page_size
+        queryset = queryset.order_by(*self.cursor_ordering)
+        if request.query_params.get('count') == 'approximate':
+            self.estimated_count = estimate_count(queryset)
+        else:
+            self.estimated_count = None
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            queryset = queryset.filter(
+                self.build_cursor_filter(queryset.model, cursor))
+        page = list(queryset[:page_size + 1])
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = self.encode_cursor(page[-1])
+        else:
+            self.next_cursor = None
+        return page
+
+    def get_paginated_response(self, data):
+        if self.cursor_ordering is None:
+            return super(StandardPagination, self).get_paginated_response(data)
+        response_data = OrderedDict()
+        if self.estimated_count is not None:
+            response_data['count'] = self.estimated_count
+        response_data['next'] = self.get_next_link()
+        response_data['results'] = data
+        return Response(response_data)
+
+    def get_next_link(self):
+        if self.cursor_ordering is None:
+            return super(StandardPagination, self).get_next_link()
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param,
+                                   self.next_cursor)
+
+    def encode_cursor(self, instance):
+        """ Record the ordering values of the last instance on a page. """
+        values = [instance._meta.get_field(name.lstrip('-')).value_to_string(
+            instance) for name in self.cursor_ordering]
+        return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def build_cursor_filter(self, model, cursor):
+        """ Select the records that come after the cursor.
+
+        The first field gets an inclusive bound by itself, so the database
+        can scan the composite index from there.
+        """
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()))
+            (first_name, first_value), (second_name, second_value) = [
+                (name.lstrip('-'), model._meta.get_field(
+                    name.lstrip('-')).to_python(value))
+                for name, value in zip(self.cursor_ordering, values)]
+        except (TypeError, ValueError, DjangoValidationError):
+            raise ParseError(self.invalid_cursor_message)
+        first_lookup, second_lookup = [
+            'lt' if name.startswith('-') else 'gt'
+            for name in self.cursor_ordering]
+        return Q(**{first_name + '__' + first_lookup + 'e': first_value}) & (
+            Q(**{first_name + '__' + first_lookup: first_value}) |
+            Q(**{second_name + '__' + second_lookup: second_value}))
 
 
 class IsGrantedReadOnly(permissions.BasePermission):
@@ -120,6 +230,42 @@ class GrantedModelMixin:
                                             queryset=queryset)
 
 
+class FieldSelectionModelMixin:
+    """ Only load related records for the fields that will be serialized.
+
+    Mix this in with a view set whose serializer uses FieldSelectionMixin, and
+    set either of these class attributes to {field_name: [lookup]}:
+
+    * select_related_fields - foreign keys to join for each field
+    * prefetch_related_fields - relations to prefetch for each field
+
+    The lookups are skipped when the fields or omit query parameters leave
+    their fields out.
+    """
+    select_related_fields = None
+    prefetch_related_fields = None
+
+    def get_queryset(self):
+        queryset = super(FieldSelectionModelMixin, self).get_queryset()
+        select_lookups = self.find_related_lookups(self.select_related_fields)
+        if select_lookups:
+            queryset = queryset.select_related(*select_lookups)
+        prefetch_lookups = self.find_related_lookups(
+            self.prefetch_related_fields)
+        if prefetch_lookups:
+            queryset = queryset.prefetch_related(*prefetch_lookups)
+        return queryset
+
+    def find_related_lookups(self, related_fields):
+        lookups = []
+        for field_name, field_lookups in (related_fields or {}).items():
+            if is_field_selected(self.request, field_name):
+                lookups.extend(lookup
+                               for lookup in field_lookups
+                               if lookup not in lookups)
+        return lookups
+
+
 class RedactModelMixin:
     """ Redacts a model instance and build a redaction plan.
 
@@ -1,5 +1,49 @@
 from django.contrib.auth.models import User, Group
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def is_field_selected(request, field_name):
+    """ Check a field against the fields and omit query parameters.
+
+    Both parameters are comma-separated lists of field names, and they only
+    apply to GET requests, so writable fields are never dropped.
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return True
+    selected_names = request.GET.get('fields')
+    if selected_names and field_name not in selected_names.split(','):
+        return False
+    omitted_names = request.GET.get('omit')
+    if omitted_names and field_name in omitted_names.split(','):
+        return False
+    return True
+
+
+class FieldSelectionMixin:
+    """ Lets clients choose which fields to serialize.
+
+    Mix this in with a serializer to add query parameters:
+
+    * fields=a,b,c - only include the listed fields
+    * omit=a,b,c - include all fields except the listed ones
+
+    Unrequested fields are dropped before any values are read, so leaving out
+    fields like has_data or removal_plan skips their queries and file access.
+    Nested serializers always include all their fields.
+    """
+    def get_fields(self):
+        fields = super(FieldSelectionMixin, self).get_fields()
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None:
+            return fields
+        request = self.context.get('request')
+        for field_name in list(fields):
+            if not is_field_selected(request, field_name):
+                del fields[field_name]
+        return fields
 
 
 class GroupSerializer(serializers.ModelSerializer):
@@ -14,7 +58,7 @@ class TinyUserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username')
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     groups = serializers.SerializerMethodField()
 
     class Meta:
@@ -20,7 +20,9 @@
 import os
 import json
 
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.utils import get_random_secret_key
+from django.utils.dateparse import parse_duration
 
 # Turn this off in production!
 DEBUG = os.environ.get("KIVE_DEBUG", 'True').lower() != 'false'
@@ -148,6 +150,7 @@ MIDDLEWARE = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'metadata.middleware.AccessGroupCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -259,6 +262,28 @@ REST_FRAMEWORK = {
 
 FILE_UPLOAD_PERMISSIONS = 0o644
 
+# Uploads are hashed while they are received, so datasets don't have to read
+# them again. Large uploads are spooled to the temporary folder, and moving
+# them into MEDIA_ROOT is just a rename if they're on the same file system.
+FILE_UPLOAD_HANDLERS = [
+    'kive.upload_handlers.HashingMemoryFileUploadHandler',
+    'kive.upload_handlers.HashingTemporaryFileUploadHandler']
+FILE_UPLOAD_TEMP_DIR = os.environ.get('KIVE_FILE_UPLOAD_TEMP_DIR') or None
+
+# Chunked dataset uploads that haven't been finished are removed by purge
+# --synch after this long. It gets parsed by parse_duration().
+DATASET_UPLOAD_MAX_AGE = os.environ.get('KIVE_DATASET_UPLOAD_MAX_AGE',
+                                        '2 days, 0:00:00')
+
+# Downloads can be handed off to the web server after Kive checks
+# permissions, so a worker isn't tied up for the whole transfer: "xsendfile"
+# for Apache's mod_xsendfile, "xaccel" for nginx's X-Accel-Redirect, or blank
+# to stream files through Kive. For nginx, configure an internal location at
+# DOWNLOAD_ACCEL_PREFIX that is an alias for MEDIA_ROOT.
+DOWNLOAD_OFFLOAD = os.environ.get('KIVE_DOWNLOAD_OFFLOAD', '')
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('KIVE_DOWNLOAD_ACCEL_PREFIX',
+                                       '/kive_media/')
+
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
 LOGIN_URL = "login"
@@ -276,6 +301,44 @@ PURGE_SANDBOX_AGING = os.environ.get('KIVE_PURGE_SANDBOX_AGING', '10.0')
 # This gets parsed by django.utils.dateparse.parse_duration().
 PURGE_WAIT = os.environ.get('KIVE_PURGE_WAIT', '0 days, 1:00:00')
 PURGE_BATCH_SIZE = int(os.environ.get('KIVE_PURGE_BATCH_SIZE', '100'))
+# Purge --synch skips folders that haven't changed since they were last
+# scanned, but rescans them after this long, in case their files were removed
+# from the database. This gets parsed by django.utils.dateparse.parse_duration().
+PURGE_RESCAN = os.environ.get('KIVE_PURGE_RESCAN', '7 days, 0:00:00')
+# Number of threads that scan new files and folders to record their sizes.
+PURGE_THREADS = int(os.environ.get('KIVE_PURGE_THREADS', '4'))
+
+# Checksum cache for run inputs and containers: "always" rehashes every file
+# and doesn't use the cache, "trust" reuses a checksum while the file's size,
+# inode, and modification time are unchanged, and "periodic" trusts it until
+# MD5_CACHE_VERIFY_AGE has passed since the file was hashed. That gets parsed
+# by django.utils.dateparse.parse_duration().
+MD5_CACHE_POLICY = os.environ.get('KIVE_MD5_CACHE_POLICY', 'always')
+MD5_CACHE_VERIFY_AGE = os.environ.get('KIVE_MD5_CACHE_VERIFY_AGE',
+                                      '7 days, 0:00:00')
+# Hard links change a file's ctime, so it's only checked when requested.
+MD5_CACHE_CHECK_CTIME = (
+    os.environ.get('KIVE_MD5_CACHE_CHECK_CTIME', 'False').lower() == 'true')
+
+# Report bad values at startup, instead of failing when they're first used.
+if MD5_CACHE_POLICY not in ('always', 'trust', 'periodic'):
+    raise ImproperlyConfigured(
+        'Unknown MD5 cache policy: {!r}.'.format(MD5_CACHE_POLICY))
+for _setting_name in ('DATASET_UPLOAD_MAX_AGE',
+                      'PURGE_WAIT',
+                      'PURGE_RESCAN',
+                      'MD5_CACHE_VERIFY_AGE'):
+    if parse_duration(globals()[_setting_name]) is None:
+        raise ImproperlyConfigured('Invalid duration for {}: {!r}.'.format(
+            _setting_name,
+            globals()[_setting_name]))
+
+# Hashing many files at once reads this many in parallel, with reads of the
+# chunk size in bytes. The maximum bandwidth in MB/s protects a shared file
+# system, and 0 means no limit.
+MD5_THREADS = int(os.environ.get('KIVE_MD5_THREADS', '4'))
+MD5_CHUNK_SIZE = int(os.environ.get('KIVE_MD5_CHUNK_SIZE', str(1024*1024)))
+MD5_MAX_BANDWIDTH = float(os.environ.get('KIVE_MD5_MAX_BANDWIDTH', '0'))
 
 # A list, ordered from lowest-priority to highest-priority, of Slurm queues to
 # be used by Kive.  Fill these in with the names of the queues as you have them
@@ -289,6 +352,15 @@ SLURM_QUEUES = json.loads(os.environ.get("KIVE_SLURM_QUEUES", """\
 ]
 """))
 
+# How to launch container runs: 'slurm' submits them with sbatch, and 'local'
+# queues them for the run_local command, which must run as a single service
+# on the host that runs the containers. It only starts a run when the app's
+# threads and memory (in MB) fit under these totals. Zero threads means the
+# CPU count, and zero memory means no limit.
+EXECUTOR = os.environ.get('KIVE_EXECUTOR', 'slurm')
+LOCAL_EXECUTOR_THREADS = int(os.environ.get('KIVE_LOCAL_EXECUTOR_THREADS', '0'))
+LOCAL_EXECUTOR_MEMORY = int(os.environ.get('KIVE_LOCAL_EXECUTOR_MEMORY', '0'))
+
 # The number of times to retry a slurm command such as sbatch or sacct,
 # and the interval in seconds to wait between retries.
 SLURM_COMMAND_RETRY_NUM = int(
@@ -300,6 +372,63 @@ SLURM_COMMAND_RETRY_SLEEP_SECS = int(
 # Often useful to choose a Python virtual environment.
 SLURM_PATH = os.environ.get('KIVE_SLURM_PATH')
 
+# Seconds between checks on the Slurm state of active runs. The poll_slurm
+# command checks on this schedule, and web requests just report when the
+# last check finished.
+SLURM_POLL_INTERVAL = int(os.environ.get('KIVE_SLURM_POLL_INTERVAL', '60'))
+
+# Submit the new runs in a batch as Slurm job arrays, grouped by app and
+# priority, instead of one sbatch call per run. The size limit should not be
+# more than Slurm's MaxArraySize - 1.
+SLURM_ARRAYS = os.environ.get('KIVE_SLURM_ARRAYS', 'False').lower() == 'true'
+SLURM_ARRAY_MAX_SIZE = int(os.environ.get('KIVE_SLURM_ARRAY_MAX_SIZE', '1000'))
+
+# Apps that size their Slurm requests from history use this many recent
+# completed runs, and only once there are at least the minimum number. The
+# requests cover the chosen percentile of memory, CPU, and elapsed time, plus
+# a fractional safety margin, and time limits are never below the minimum.
+RESOURCE_HISTORY_SIZE = int(os.environ.get('KIVE_RESOURCE_HISTORY_SIZE', '100'))
+RESOURCE_HISTORY_MIN_RUNS = int(
+    os.environ.get('KIVE_RESOURCE_HISTORY_MIN_RUNS', '5'))
+RESOURCE_HISTORY_PERCENTILE = int(
+    os.environ.get('KIVE_RESOURCE_HISTORY_PERCENTILE', '95'))
+RESOURCE_HISTORY_MARGIN = float(
+    os.environ.get('KIVE_RESOURCE_HISTORY_MARGIN', '0.25'))
+RESOURCE_HISTORY_MIN_MINUTES = int(
+    os.environ.get('KIVE_RESOURCE_HISTORY_MIN_MINUTES', '10'))
+
+# Archive containers are extracted once into this cache, in a folder named
+# after the container's MD5, and each run links to those files instead of
+# extracting its own copy. When the cache grows past the maximum size in MB,
+# the least recently used folders are removed. A maximum of 0 turns off the
+# cache, and that's the default, because cached files are read-only, and
+# pipeline steps get their bin folder, which is also their working folder,
+# mounted read-only.
+CONTAINER_CACHE_ROOT = os.environ.get('KIVE_CONTAINER_CACHE_ROOT',
+                                      os.path.join(MEDIA_ROOT, 'ContainerCache'))
+CONTAINER_CACHE_MAX_SIZE = int(
+    os.environ.get('KIVE_CONTAINER_CACHE_MAX_SIZE', '0'))
+
+# Directory outputs are registered in bulk: this many threads hash and copy
+# the files into the datasets folder, then the rows are inserted in
+# transactions of the batch size.
+SAVE_OUTPUTS_THREADS = int(os.environ.get('KIVE_SAVE_OUTPUTS_THREADS', '4'))
+SAVE_OUTPUTS_BATCH_SIZE = int(
+    os.environ.get('KIVE_SAVE_OUTPUTS_BATCH_SIZE', '1000'))
+
+# Store each distinct dataset file once under Datasets/Shared, and let all
+# the datasets with the same MD5 and SHA-256 checksums share it. Existing
+# files can be moved there with the dedup_datasets command.
+DATASET_SHARED_STORAGE = (
+    os.environ.get('KIVE_DATASET_SHARED_STORAGE', 'False').lower() == 'true')
+
+# How to stage input files into a run's sandbox, a comma-separated list tried
+# in order until one works: hardlink, reflink, copy_range (kernel copy), and
+# copy (user space). Inputs are mounted read-only, so hard links are safe.
+INPUT_STAGING_STRATEGIES = os.environ.get(
+    'KIVE_INPUT_STAGING_STRATEGIES',
+    'hardlink,reflink,copy_range,copy').split(',')
+
 # Container file in Containers folder
 DEFAULT_CONTAINER = os.environ.get('KIVE_DEFAULT_CONTAINER', 'kive-default.simg')
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
@@ -11,5 +11,5 @@ def clean_up_all_files():
     # but we move it here.
     for dataset in Dataset.objects.all():
         dataset.dataset_file.close()
-        dataset.dataset_file.delete()
+        dataset.release_file()
         dataset.delete()
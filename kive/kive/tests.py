@@ -20,7 +20,7 @@ from rest_framework.test import APIRequestFactory, force_authenticate
 from django_mock_queries.mocks import mocked_relations
 
 from constants import users
-from metadata.models import kive_user, KiveUser
+from metadata.models import kive_user, KiveUser, AccessControl
 
 
 class DuckRequest:
@@ -42,11 +42,27 @@ class DuckContext(dict):
         self['request'] = DuckRequest(user=user)
 
 
+def mock_access_filter(test_case):
+    """ Filter permissions through relations, instead of subqueries.
+
+    Mocked querysets evaluate filters in Python, and can't run the EXISTS
+    subqueries from AccessControl.build_access_filter(). The real filter is
+    covered by the database tests, like the list tests in DatasetApiTests.
+    """
+    patcher = patch.object(
+        AccessControl,
+        'build_access_filter',
+        lambda user, model: KiveUser.kiveify(user).access_query())
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
 class ViewMockTestCase(TestCase, object):
     def create_client(self):
         patcher = mocked_relations(User, Session)
         patcher.start()
         self.addCleanup(patcher.stop)
+        mock_access_filter(self)
 
         user = User(pk=users.KIVE_USER_PK)
         User.objects.add(user)
@@ -100,6 +116,7 @@ class BaseTestCases:
             patcher = mocked_relations(model, User, KiveUser)
             patcher.start()
             self.addCleanup(patcher.stop)
+            mock_access_filter(self)
 
             user = User(pk=users.KIVE_USER_PK)
             User.objects.add(user)
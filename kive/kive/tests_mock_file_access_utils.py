@@ -0,0 +1,391 @@
+import errno
+import hashlib
+import os
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest.case import TestCase
+
+from django.core.files import File
+from django.test import RequestFactory, override_settings
+from mock import patch, call
+
+from file_access_utils import stage_file, link_tree, compute_md5, compute_md5s, \
+    BandwidthLimiter, build_download_response, ScanManifest, scan_media_folder
+
+
+class StageFileTest(TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.source_path = os.path.join(temp_dir.name, 'source.txt')
+        self.target_path = os.path.join(temp_dir.name, 'target.txt')
+        with open(self.source_path, 'wb') as f:
+            f.write(b'example contents\n')
+
+    def assert_staged(self):
+        with open(self.target_path, 'rb') as f:
+            self.assertEqual(b'example contents\n', f.read())
+
+    def test_hardlink(self):
+        strategy = stage_file(self.source_path, self.target_path)
+
+        self.assertEqual('hardlink', strategy)
+        self.assert_staged()
+        self.assertTrue(os.path.samefile(self.source_path, self.target_path))
+
+    def test_copy(self):
+        strategy = stage_file(self.source_path,
+                              self.target_path,
+                              strategies=['copy'])
+
+        self.assertEqual('copy', strategy)
+        self.assert_staged()
+        self.assertFalse(os.path.samefile(self.source_path, self.target_path))
+
+    def test_copy_range(self):
+        strategy = stage_file(self.source_path,
+                              self.target_path,
+                              strategies=['copy_range'])
+
+        self.assertEqual('copy_range', strategy)
+        self.assert_staged()
+
+    @patch('file_access_utils.os.link')
+    def test_fall_back(self, mock_link):
+        mock_link.side_effect = OSError(errno.EXDEV, 'Cross-device link')
+
+        strategy = stage_file(self.source_path,
+                              self.target_path,
+                              strategies=['hardlink', 'copy'])
+
+        self.assertEqual('copy', strategy)
+        self.assert_staged()
+
+    def test_missing_source(self):
+        os.remove(self.source_path)
+
+        with self.assertRaises(FileNotFoundError):
+            stage_file(self.source_path, self.target_path)
+        self.assertFalse(os.path.exists(self.target_path))
+
+
+class LinkTreeTest(TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.source_path = os.path.join(temp_dir.name, 'source')
+        self.target_path = os.path.join(temp_dir.name, 'target')
+        os.makedirs(os.path.join(self.source_path, 'sub'))
+        for file_name in ('a.txt', 'b.txt', os.path.join('sub', 'c.txt')):
+            with open(os.path.join(self.source_path, file_name), 'w') as f:
+                f.write(file_name)
+
+    def test_link_tree(self):
+        link_tree(self.source_path, self.target_path)
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.source_path, 'sub', 'c.txt'),
+            os.path.join(self.target_path, 'sub', 'c.txt')))
+
+    def test_ignore(self):
+        link_tree(self.source_path,
+                  self.target_path,
+                  ignore=lambda folder, entries: {'b.txt'})
+
+        self.assertEqual(['a.txt', 'sub'], sorted(os.listdir(self.target_path)))
+
+    @patch('file_access_utils.os.link')
+    def test_copy_fallback(self, mock_link):
+        mock_link.side_effect = OSError(errno.EXDEV, 'Cross-device link')
+
+        link_tree(self.source_path, self.target_path)
+
+        copied_path = os.path.join(self.target_path, 'a.txt')
+        self.assertFalse(os.path.samefile(
+            os.path.join(self.source_path, 'a.txt'),
+            copied_path))
+        with open(copied_path) as f:
+            self.assertEqual('a.txt', f.read())
+
+
+class ComputeMd5sTest(TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.file_paths = []
+        self.expected_md5s = {}
+        for i in range(10):
+            file_path = os.path.join(temp_dir.name, 'file{}.txt'.format(i))
+            contents = b'contents of file %d\n' % i * (i+1)
+            with open(file_path, 'wb') as f:
+                f.write(contents)
+            self.file_paths.append(file_path)
+            self.expected_md5s[file_path] = hashlib.md5(contents).hexdigest()
+
+    def test_chunks(self):
+        contents = b'x' * 100
+        expected_md5 = hashlib.md5(contents).hexdigest()
+
+        md5 = compute_md5(BytesIO(contents), chunk_size=7)
+
+        self.assertEqual(expected_md5, md5)
+
+    def test_paths(self):
+        md5s = dict(compute_md5s(self.file_paths,
+                                 thread_count=3,
+                                 chunk_size=16,
+                                 max_bandwidth=0))
+
+        self.assertEqual(self.expected_md5s, md5s)
+
+    def test_handles(self):
+        handles = [open(file_path, 'rb') for file_path in self.file_paths]
+        for f in handles:
+            self.addCleanup(f.close)
+        expected_md5s = {f: self.expected_md5s[f.name] for f in handles}
+
+        md5s = dict(compute_md5s(handles,
+                                 thread_count=2,
+                                 chunk_size=16,
+                                 max_bandwidth=0))
+
+        self.assertEqual(expected_md5s, md5s)
+
+    def test_missing_file(self):
+        missing_path = self.file_paths[0] + '.missing'
+
+        md5s = dict(compute_md5s([missing_path, self.file_paths[1]],
+                                 thread_count=2,
+                                 chunk_size=16,
+                                 max_bandwidth=0))
+
+        self.assertEqual({missing_path: None,
+                          self.file_paths[1]: self.expected_md5s[self.file_paths[1]]},
+                         md5s)
+
+    @patch('file_access_utils.sleep')
+    @patch('file_access_utils.perf_counter')
+    def test_bandwidth_limit(self, mock_perf_counter, mock_sleep):
+        mock_perf_counter.side_effect = [100.0, 100.5, 101.0]
+        limiter = BandwidthLimiter(bytes_per_second=1000)
+
+        limiter.consume(1000)  # Starts timing, and should take 1s.
+        limiter.consume(1000)  # 0.5s later, but should reach 2s.
+        limiter.consume(500)  # 1s later, but should reach 2.5s.
+
+        self.assertEqual([call(1.0), call(1.5), call(1.5)],
+                         mock_sleep.call_args_list)
+
+
+class BuildDownloadResponseTest(TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.media_root = temp_dir.name
+        self.file_path = os.path.join(temp_dir.name, 'Datasets', 'example.txt')
+        os.mkdir(os.path.dirname(self.file_path))
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456789')
+        self.factory = RequestFactory()
+
+    def download(self, **headers):
+        request = self.factory.get('/download', **headers)
+        download_file = File(open(self.file_path, 'rb'), name=self.file_path)
+        return build_download_response(download_file, request)
+
+    def test_full(self):
+        response = self.download()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+        self.assertEqual('10', response['Content-Length'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertEqual('attachment; filename="example.txt"',
+                         response['Content-Disposition'])
+
+    def test_range(self):
+        response = self.download(HTTP_RANGE='bytes=2-5')
+
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'2345', b''.join(response.streaming_content))
+        self.assertEqual('4', response['Content-Length'])
+        self.assertEqual('bytes 2-5/10', response['Content-Range'])
+
+    def test_open_range(self):
+        response = self.download(HTTP_RANGE='bytes=7-')
+
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'789', b''.join(response.streaming_content))
+        self.assertEqual('bytes 7-9/10', response['Content-Range'])
+
+    def test_suffix_range(self):
+        response = self.download(HTTP_RANGE='bytes=-3')
+
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'789', b''.join(response.streaming_content))
+
+    def test_unsatisfiable_range(self):
+        response = self.download(HTTP_RANGE='bytes=10-')
+
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */10', response['Content-Range'])
+
+    def test_multiple_ranges(self):
+        """ Multiple ranges aren't supported, so send the whole file. """
+        response = self.download(HTTP_RANGE='bytes=0-1,4-5')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+
+    def test_if_range_matches(self):
+        etag = self.download()['ETag']
+
+        response = self.download(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)
+
+        self.assertEqual(206, response.status_code)
+
+    def test_if_range_changed(self):
+        response = self.download(HTTP_RANGE='bytes=2-5',
+                                 HTTP_IF_RANGE='"old-etag"')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+
+    def test_x_sendfile(self):
+        with override_settings(DOWNLOAD_OFFLOAD='xsendfile'):
+            response = self.download()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.file_path, response['X-Sendfile'])
+        self.assertEqual(b'', response.content)
+        self.assertEqual('attachment; filename="example.txt"',
+                         response['Content-Disposition'])
+
+    def test_x_accel_redirect(self):
+        with override_settings(DOWNLOAD_OFFLOAD='xaccel',
+                               DOWNLOAD_ACCEL_PREFIX='/kive_media/',
+                               MEDIA_ROOT=self.media_root):
+            response = self.download()
+
+        self.assertEqual('/kive_media/Datasets/example.txt',
+                         response['X-Accel-Redirect'])
+        self.assertEqual(b'', response.content)
+
+    def test_x_accel_redirect_outside_media_root(self):
+        """ External files aren't visible to nginx, so stream them. """
+        with override_settings(DOWNLOAD_OFFLOAD='xaccel',
+                               MEDIA_ROOT=os.path.join(self.media_root, 'other')):
+            response = self.download()
+
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+
+
+class ScanMediaFolderTest(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.media_root = self.temp_dir.name
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.manifest_path = os.path.join(self.media_root,
+                                          'Manifests',
+                                          'manifest.json')
+        for folder in ('Datasets/2018_06', 'Datasets/2018_07/empty'):
+            os.makedirs(os.path.join(self.media_root, folder))
+        for file_name in ('Datasets/2018_06/a.txt', 'Datasets/2018_07/b.txt'):
+            with open(os.path.join(self.media_root, file_name), 'w') as f:
+                f.write('x')
+        self.set_old_times()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.temp_dir.cleanup()
+
+    def set_old_times(self):
+        """ Folders that changed in the last second always get rescanned. """
+        old_time = 1500000000
+        for folder, _, _ in os.walk(self.media_root):
+            os.utime(folder, (old_time, old_time))
+
+    def scan(self, manifest=None):
+        return sorted(scan_media_folder('Datasets',
+                                        recursive=True,
+                                        manifest=manifest))
+
+    def test_scan(self):
+        expected_names = ['Datasets/2018_06/a.txt',
+                          'Datasets/2018_07/b.txt',
+                          'Datasets/2018_07/empty']
+
+        self.assertEqual(expected_names, self.scan())
+
+    def test_not_recursive(self):
+        expected_names = ['Datasets/2018_06', 'Datasets/2018_07']
+
+        self.assertEqual(expected_names,
+                         sorted(scan_media_folder('Datasets')))
+
+    def test_missing_folder(self):
+        self.assertEqual([], list(scan_media_folder('Missing')))
+
+    def test_skip_unchanged(self):
+        manifest = ScanManifest(self.manifest_path)
+        self.scan(manifest)
+        manifest.save()
+        with open(os.path.join(self.media_root, 'Datasets/2018_06/a.txt'), 'w') as f:
+            f.write('changed contents')
+        with open(os.path.join(self.media_root, 'Datasets/2018_07/c.txt'), 'w') as f:
+            f.write('new file')
+        expected_names = ['Datasets/2018_07/b.txt', 'Datasets/2018_07/c.txt']
+
+        manifest = ScanManifest(self.manifest_path)
+        file_names = self.scan(manifest)
+
+        self.assertEqual(expected_names, file_names)
+        self.assertEqual(3, manifest.skipped_count)  # Datasets, 2018_06, and empty
+        self.assertEqual(1, manifest.scanned_count)  # 2018_07
+
+    def test_rescan_age(self):
+        manifest = ScanManifest(self.manifest_path)
+        self.scan(manifest)
+        manifest.save()
+
+        manifest = ScanManifest(self.manifest_path, rescan_age=0)
+        file_names = self.scan(manifest)
+
+        self.assertEqual(3, len(file_names))
+        self.assertEqual(0, manifest.skipped_count)
+
+    def test_mark_changed(self):
+        manifest = ScanManifest(self.manifest_path)
+        self.scan(manifest)
+        manifest.mark_changed('Datasets/2018_06')
+        manifest.save()
+
+        manifest = ScanManifest(self.manifest_path)
+        file_names = self.scan(manifest)
+
+        self.assertEqual(['Datasets/2018_06/a.txt'], file_names)
+
+    def test_recently_changed(self):
+        manifest = ScanManifest(self.manifest_path)
+        self.scan(manifest)
+        manifest.save()
+        os.utime(os.path.join(self.media_root, 'Datasets/2018_06'))
+
+        manifest = ScanManifest(self.manifest_path)
+        self.scan(manifest)
+        manifest.save()
+        manifest = ScanManifest(self.manifest_path)
+        file_names = self.scan(manifest)
+
+        self.assertEqual(['Datasets/2018_06/a.txt'], file_names)
+
+    def test_invalid_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path))
+        with open(self.manifest_path, 'w') as f:
+            f.write('garbage')
+
+        manifest = ScanManifest(self.manifest_path)
+
+        self.assertEqual(3, len(self.scan(manifest)))
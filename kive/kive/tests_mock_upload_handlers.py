@@ -0,0 +1,55 @@
+import hashlib
+from unittest.case import TestCase
+
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import override_settings
+
+from kive.upload_handlers import HashingMemoryFileUploadHandler, \
+    HashingTemporaryFileUploadHandler
+
+
+class HashingUploadHandlerTest(TestCase):
+    def receive_file(self, handler, chunks):
+        content_length = sum(len(chunk) for chunk in chunks)
+        handler.handle_raw_input(None, {}, content_length, 'boundary')
+        try:
+            handler.new_file('dataset_file', 'example.txt', 'text/plain', content_length)
+        except StopFutureHandlers:
+            pass
+        start = 0
+        for chunk in chunks:
+            handler.receive_data_chunk(chunk, start)
+            start += len(chunk)
+        return handler.file_complete(content_length)
+
+    def test_memory(self):
+        chunks = [b'first chunk\n', b'second chunk\n']
+        expected_md5 = hashlib.md5(b''.join(chunks)).hexdigest()
+
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1000):
+            uploaded_file = self.receive_file(HashingMemoryFileUploadHandler(),
+                                              chunks)
+
+        self.assertEqual(expected_md5, uploaded_file.md5)
+        self.assertEqual(b''.join(chunks), uploaded_file.read())
+
+    def test_memory_too_big(self):
+        chunks = [b'first chunk\n', b'second chunk\n']
+
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10):
+            uploaded_file = self.receive_file(HashingMemoryFileUploadHandler(),
+                                              chunks)
+
+        self.assertIsNone(uploaded_file)
+
+    def test_temporary(self):
+        chunks = [b'first chunk\n', b'second chunk\n']
+        expected_md5 = hashlib.md5(b''.join(chunks)).hexdigest()
+
+        uploaded_file = self.receive_file(HashingTemporaryFileUploadHandler(),
+                                          chunks)
+        self.addCleanup(uploaded_file.close)
+
+        self.assertEqual(expected_md5, uploaded_file.md5)
+        with open(uploaded_file.temporary_file_path(), 'rb') as f:
+            self.assertEqual(b''.join(chunks), f.read())
@@ -0,0 +1,48 @@
+""" Upload handlers that calculate each file's MD5 as it is received.
+
+The checksum is stored in the uploaded file's md5 attribute, so
+Dataset.create_dataset() doesn't have to read the file again.
+"""
+
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, \
+    TemporaryFileUploadHandler
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    """ Hashes small uploads that are kept in memory. """
+    def new_file(self, *args, **kwargs):
+        self.md5gen = hashlib.md5()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.md5gen.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.md5 = self.md5gen.hexdigest()
+        return uploaded_file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """ Hashes large uploads while they are written to a temporary file.
+
+    If FILE_UPLOAD_TEMP_DIR is on the same file system as MEDIA_ROOT, the
+    temporary file gets renamed into place instead of copied.
+    """
+    def new_file(self, *args, **kwargs):
+        self.md5gen = hashlib.md5()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.md5gen.update(raw_data)
+        super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.md5 = self.md5gen.hexdigest()
+        return uploaded_file
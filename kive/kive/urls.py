@@ -6,7 +6,7 @@ from container.ajax import ContainerFamilyViewSet, ContainerViewSet, ContainerAp
     ContainerRunViewSet, BatchViewSet, ContainerArgumentViewSet, ContainerLogViewSet
 from librarian.ajax import DatasetViewSet, ExternalFileDirectoryViewSet
 from kive.kive_router import KiveRouter
-from portal.ajax import UserViewSet
+from portal.ajax import UserViewSet, StorageLedgerViewSet, StorageSnapshotViewSet
 from portal.forms import LoginForm
 
 import portal.views
@@ -30,6 +30,8 @@ router.register(r'containerruns', ContainerRunViewSet)
 router.register(r'containerlogs', ContainerLogViewSet)
 router.register(r'datasets', DatasetViewSet)
 router.register(r'externalfiledirectories', ExternalFileDirectoryViewSet)
+router.register(r'storage', StorageLedgerViewSet)
+router.register(r'storagehistory', StorageSnapshotViewSet)
 router.register(r'users', UserViewSet)
 
 urlpatterns = [
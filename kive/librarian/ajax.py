@@ -1,4 +1,5 @@
 import logging
+import re
 from datetime import datetime
 
 from django.db import transaction
@@ -6,21 +7,22 @@ from django.db.models import Q
 from django.core.exceptions import ValidationError as DjangoValidationError
 from django.utils import timezone
 
-from rest_framework import permissions
+from rest_framework import permissions, status
 from rest_framework.decorators import action
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
 from file_access_utils import build_download_response
 from librarian.serializers import DatasetSerializer, ExternalFileDirectorySerializer,\
-    ExternalFileDirectoryListFilesSerializer
+    ExternalFileDirectoryListFilesSerializer, DatasetUploadSerializer, \
+    DatasetLookupSerializer
 
-from librarian.models import Dataset, ExternalFileDirectory
+from librarian.models import Dataset, ExternalFileDirectory, DatasetUpload
 
 from kive.ajax import RemovableModelViewSet, RedactModelMixin, IsGrantedReadCreate,\
     StandardPagination, CleanCreateModelMixin, SearchableModelMixin,\
-    convert_validation
+    convert_validation, FieldSelectionModelMixin
 
 JSON_CONTENT_TYPE = 'application/json'
 logger = logging.getLogger(__name__)
@@ -64,7 +66,8 @@ class ExternalFileDirectoryViewSet(ReadOnlyModelViewSet,
         return Response(list_files_serializer.data)
 
 
-class DatasetViewSet(RemovableModelViewSet,
+class DatasetViewSet(FieldSelectionModelMixin,
+                     RemovableModelViewSet,
                      CleanCreateModelMixin,
                      RedactModelMixin,
                      SearchableModelMixin):
@@ -79,6 +82,9 @@ class DatasetViewSet(RemovableModelViewSet,
     Query parameters for the list view:
 
     * page_size=n - limit the results and page through them
+    * cursor= - page through the list, newest first, by following the next
+        links, without counting the list. Add count=approximate for an
+        estimated count.
     * is_granted=true - For administrators, this limits the list to only include
         records that the user has been explicitly granted access to. For other
         users, this has no effect.
@@ -103,9 +109,39 @@ class DatasetViewSet(RemovableModelViewSet,
     * filters[n][key]=cdt&filters[n][val]=id - only include datasets with the
         compound datatype id, or raw type if id is missing.
     * filters[n][key]=md5&filters[n][val]=match - md5 checksum matches the value
+    * fields=a,b,c - only include the listed fields in each dataset, for
+        example fields=id,name,filesize
+    * omit=a,b,c - leave the listed fields out of each dataset
+    * verify=true - check the files for filesize and has_data, instead of
+        trusting the database
+
+    To check which files are already stored, POST a list of up to 10000
+    checksums like {"md5_checksums": ["d41d8cd98f00b204e9800998ecf8427e"]} to
+    /api/datasets/lookup/. The response maps each checksum to a list of
+    the accessible dataset ids with that checksum, newest first.
+
+    Large files can be uploaded in chunks that are retried or sent in parallel:
+
+    * POST file_name and size to /api/datasets/uploads/ to start an upload.
+    * PUT each chunk to the upload's url with a header like
+        "Content-Range: bytes 0-1048575/10000000".
+    * GET the upload's url to see the offset received without gaps, and the
+        received_ranges, so an interrupted upload can resume.
+    * POST the dataset fields, like name and users_allowed, to the upload's
+        finalize_url to create the dataset, or DELETE the upload's url to
+        abandon it.
     """
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
+    cursor_ordering = ('-date_created', '-id')
+    select_related_fields = dict(
+        externalfiledirectory=['externalfiledirectory'],
+        filesize=['externalfiledirectory'],
+        filesize_display=['externalfiledirectory'],
+        has_data=['externalfiledirectory'],
+        user=['user'])
+    prefetch_related_fields = dict(users_allowed=['users_allowed'],
+                                   groups_allowed=['groups_allowed'])
     permission_classes = (permissions.IsAuthenticated, IsGrantedReadCreate)
     pagination_class = StandardPagination
 
@@ -159,7 +195,7 @@ class DatasetViewSet(RemovableModelViewSet,
             is_purged = False
 
         if is_purged:
-            obj.dataset_file.delete(save=True)
+            obj.purge_file()
 
         return Response(DatasetSerializer(obj, context={'request': request}).data)
 
@@ -173,6 +209,106 @@ class DatasetViewSet(RemovableModelViewSet,
         dataset_handle = dataset.get_open_file_handle()
 
         if dataset_handle is not None:
-            return build_download_response(dataset_handle)
+            return build_download_response(dataset_handle,
+                                           request,
+                                           dataset.get_download_name())
         else:
             raise APIException(f"Couldn't find dataset file for {dataset.name}")
+
+    @action(detail=False, methods=['post'])
+    def lookup(self, request):
+        """ Find accessible datasets for a batch of MD5 checksums. """
+        serializer = DatasetLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        checksums = serializer.validated_data['md5_checksums']
+        matches = {md5: [] for md5 in checksums}
+        queryset = self.get_queryset().order_by('-date_created', '-id')
+        batch_size = 1000  # Stay below query parameter limits.
+        for start in range(0, len(checksums), batch_size):
+            batch = checksums[start:start + batch_size]
+            for md5, dataset_id in queryset.filter(
+                    MD5_checksum__in=batch).values_list('MD5_checksum', 'id'):
+                matches[md5].append(dataset_id)
+        return Response(dict(md5_checksums=matches))
+
+    @action(detail=False,
+            methods=['post'],
+            url_path='uploads',
+            url_name='uploads',
+            permission_classes=[permissions.IsAuthenticated])
+    def start_upload(self, request):
+        """ Start uploading a large file in chunks. """
+        serializer = DatasetUploadSerializer(data=request.data,
+                                             context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def get_upload(self, request, upload_id):
+        try:
+            return DatasetUpload.objects.get(pk=upload_id, user=request.user)
+        except DatasetUpload.DoesNotExist:
+            raise NotFound()
+
+    @action(detail=False,
+            methods=['get', 'put', 'delete'],
+            url_path=r'uploads/(?P<upload_id>[0-9]+)',
+            url_name='upload',
+            permission_classes=[permissions.IsAuthenticated])
+    def upload_chunk(self, request, upload_id=None):
+        """ Receive a chunk of an upload, or check its progress. """
+        upload = self.get_upload(request, upload_id)
+        if request.method == 'DELETE':
+            upload.delete_files()
+            upload.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        if request.method == 'PUT':
+            try:
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length <= 0:
+                raise ValidationError('A chunk needs a positive Content-Length.')
+            content_range = request.META.get('HTTP_CONTENT_RANGE')
+            if content_range is None:
+                raise ValidationError('A chunk needs a Content-Range.')
+            match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+            if match is None:
+                raise ValidationError(
+                    'Invalid Content-Range: {!r}.'.format(content_range))
+            start = int(match.group(1))
+            if int(match.group(2)) - start + 1 != length:
+                raise ValidationError(
+                    'Content-Range does not match Content-Length.')
+            total = match.group(3)
+            if total != '*' and upload.size != int(total):
+                raise ValidationError(
+                    'Content-Range total does not match upload size {}.'.format(
+                        upload.size))
+            try:
+                upload.write_chunk(start, request.stream, length)
+            except DjangoValidationError as ex:
+                raise convert_validation(ex)
+        return Response(DatasetUploadSerializer(upload,
+                                                context={'request': request}).data)
+
+    @action(detail=False,
+            methods=['post'],
+            url_path=r'uploads/(?P<upload_id>[0-9]+)/finalize',
+            url_name='upload-finalize',
+            permission_classes=[permissions.IsAuthenticated])
+    def finalize_upload(self, request, upload_id=None):
+        """ Create a dataset from a complete upload. """
+        upload = self.get_upload(request, upload_id)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            upload_file = upload.finish()
+            with upload_file, transaction.atomic():
+                dataset = serializer.save(dataset_file=upload_file, save_in_db=True)
+                dataset.clean()
+        except DjangoValidationError as ex:
+            raise convert_validation(ex)
+        upload.delete_files()
+        upload.delete()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,152 @@
+import random
+from datetime import timedelta
+from timeit import default_timer
+
+from django.contrib.auth.models import User, Group
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from constants import groups
+from librarian.models import Dataset
+from metadata.models import AccessControl
+
+
+class Command(BaseCommand):
+    help = ('Compare query plans and times for filtering datasets by user '
+            'permissions, on a large set of synthetic datasets. Everything '
+            'is rolled back at the end, unless --keep is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasets',
+                            type=int,
+                            default=2000000,
+                            help='Number of synthetic datasets to create')
+        parser.add_argument('--users',
+                            type=int,
+                            default=1000,
+                            help='Number of synthetic users to own them')
+        parser.add_argument('--groups',
+                            type=int,
+                            default=50,
+                            help='Number of synthetic groups')
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=10000,
+                            help='Number of datasets to insert at a time')
+        parser.add_argument('--repeat',
+                            type=int,
+                            default=5,
+                            help='Number of times to run each query')
+        parser.add_argument('--page_size',
+                            type=int,
+                            default=25,
+                            help='Number of datasets to fetch in a page')
+        parser.add_argument('--keep',
+                            action='store_true',
+                            help="Commit the synthetic records, so they can "
+                                 "be reused with --datasets 0")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['datasets']:
+                self.create_records(options['datasets'],
+                                    options['users'],
+                                    options['groups'],
+                                    options['batch_size'])
+            user = User.objects.filter(
+                username__startswith='access_bench_').order_by('id').first()
+            if user is None:
+                self.stderr.write('No synthetic users found.')
+                return
+            old_queryset = self.filter_with_joins(user)
+            new_queryset = AccessControl.filter_by_user(user,
+                                                        queryset=Dataset.objects.all())
+            for title, queryset in (('IN subquery with joins', old_queryset),
+                                    ('EXISTS subqueries', new_queryset)):
+                self.measure(title,
+                             queryset,
+                             options['repeat'],
+                             options['page_size'])
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    @staticmethod
+    def filter_with_joins(user):
+        """ The permission filter that build_access_filter() replaced. """
+        queryset = Dataset.objects.all()
+        allowed_items = queryset.filter(
+            Q(user=user) |
+            Q(users_allowed=user) |
+            Q(groups_allowed=groups.EVERYONE_PK) |
+            Q(groups_allowed__in=user.groups.all()))
+        return queryset.filter(pk__in=allowed_items)
+
+    def create_records(self, dataset_count, user_count, group_count, batch_size):
+        start = default_timer()
+        users = User.objects.bulk_create(
+            User(username='access_bench_{}'.format(i))
+            for i in range(user_count))
+        if users[0].pk is None:
+            users = list(User.objects.filter(username__startswith='access_bench_'))
+        bench_groups = Group.objects.bulk_create(
+            Group(name='access_bench_{}'.format(i))
+            for i in range(group_count))
+        if bench_groups[0].pk is None:
+            bench_groups = list(Group.objects.filter(
+                name__startswith='access_bench_'))
+        User.groups.through.objects.bulk_create(
+            User.groups.through(user_id=user.pk, group_id=group.pk)
+            for user in users
+            for group in random.sample(bench_groups, min(3, group_count)))
+        group_ids = [group.pk for group in bench_groups]
+        group_ids.append(groups.EVERYONE_PK)
+        user_link = Dataset.users_allowed.through
+        group_link = Dataset.groups_allowed.through
+        oldest = timezone.now() - timedelta(days=3650)
+        for batch_start in range(0, dataset_count, batch_size):
+            batch_end = min(batch_start + batch_size, dataset_count)
+            datasets = Dataset.objects.bulk_create(
+                Dataset(user=random.choice(users),
+                        name='access_bench_{}'.format(i),
+                        date_created=oldest + timedelta(minutes=i))
+                for i in range(batch_start, batch_end))
+            # Most datasets are private, some are shared with a user or a
+            # group, and a few with everyone.
+            user_link.objects.bulk_create(
+                user_link(dataset_id=dataset.pk,
+                          user_id=random.choice(users).pk)
+                for dataset in datasets
+                if random.random() < 0.2)
+            group_link.objects.bulk_create(
+                group_link(dataset_id=dataset.pk,
+                           group_id=random.choice(group_ids))
+                for dataset in datasets
+                if random.random() < 0.3)
+            self.stdout.write('Created {} datasets.'.format(batch_end))
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                for model in (Dataset, user_link, group_link):
+                    cursor.execute('ANALYZE ' + model._meta.db_table)
+        self.stdout.write('Created records in {:.1f}s.'.format(
+            default_timer() - start))
+
+    def measure(self, title, queryset, repeat, page_size):
+        page = queryset.order_by('-date_created', '-id')[:page_size]
+        self.stdout.write('')
+        self.stdout.write(title)
+        self.stdout.write('=' * len(title))
+        self.stdout.write(page.explain(
+            **(dict(analyze=True) if connection.vendor == 'postgresql' else {})))
+        for name, task in (('count', queryset.count),
+                           ('page', lambda: list(page.all()))):
+            times = []
+            for _ in range(repeat):
+                start = default_timer()
+                task()
+                times.append(default_timer() - start)
+            self.stdout.write('{}: best {:.3f}s, median {:.3f}s'.format(
+                name,
+                min(times),
+                sorted(times)[len(times) // 2]))
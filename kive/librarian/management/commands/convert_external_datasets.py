@@ -1,5 +1,6 @@
 import re
 from argparse import ArgumentDefaultsHelpFormatter
+from collections import defaultdict
 from glob import glob
 
 from django.core.management.base import BaseCommand
@@ -39,6 +40,7 @@ class Command(BaseCommand):
         external_directories = ExternalFileDirectory.objects.order_by('-path')
         missing_folders = set()
         changed_files = set()
+        found_files = defaultdict(list)  # {found_file: [(dataset, external_directory)]}
 
         datasets = Dataset.objects.filter(
             externalfiledirectory__isnull=True,  # not already external
@@ -66,26 +68,31 @@ class Command(BaseCommand):
             found_file, = files
             for external_directory in external_directories:
                 if found_file.startswith(external_directory.path):
-                    file_path = os.path.relpath(found_file,
-                                                external_directory.path)
-                    if not self.is_md5_changed(dataset,
-                                               found_file,
-                                               changed_files):
-                        if not options['dry_run']:
-                            dataset.externalfiledirectory = external_directory
-                            dataset.external_path = file_path
-                            dataset.dataset_file.delete(save=True)
-                        print('.', end='')
+                    found_files[found_file].append((dataset, external_directory))
                     break
             else:
                 print('Not under any external directory:', expected_path)
         for folder in sorted(missing_folders):
             print('Missing folder:', folder)
 
-    def is_md5_changed(self, dataset, found_file, changed_files):
+        # Hash all the found files in parallel, then convert the unchanged ones.
+        for found_file, new_md5 in file_access_utils.compute_md5s(found_files):
+            for dataset, external_directory in found_files[found_file]:
+                if self.is_md5_changed(dataset,
+                                       found_file,
+                                       new_md5,
+                                       changed_files):
+                    continue
+                if not options['dry_run']:
+                    dataset.externalfiledirectory = external_directory
+                    dataset.external_path = os.path.relpath(
+                        found_file,
+                        external_directory.path)
+                    dataset.release_file(save=True)
+                print('.', end='')
+
+    def is_md5_changed(self, dataset, found_file, new_md5, changed_files):
         old_md5 = dataset.MD5_checksum
-        with open(found_file, "rb") as f:
-            new_md5 = file_access_utils.compute_md5(f)
         is_changed = new_md5 != old_md5
         if is_changed:
             if found_file not in changed_files:
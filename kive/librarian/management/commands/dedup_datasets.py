@@ -0,0 +1,132 @@
+import logging
+import os
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+from django.template.defaultfilters import filesizeformat, pluralize
+
+from file_access_utils import compute_checksums
+from librarian.models import Dataset, DatasetContent
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Move duplicate dataset files into shared storage. The first copy '
+            'of each file is hard linked into place instead of copied, and '
+            'the other copies are deleted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=1000,
+                            help='Number of checksums to look up at a time')
+        parser.add_argument('--dry_run',
+                            action='store_true',
+                            help="Report what would be shared, without "
+                                 "changing anything")
+
+    def handle(self, batch_size=1000, dry_run=False, **kwargs):
+        self.shared_count = self.dataset_count = self.freed_size = 0
+        candidates = self.find_candidates()
+        shared_md5s = DatasetContent.objects.values('MD5_checksum')
+        duplicate_md5s = candidates.values('MD5_checksum').annotate(
+            dataset_count=Count('id')).filter(
+            dataset_count__gt=1).values('MD5_checksum')
+        md5s = candidates.filter(
+            Q(MD5_checksum__in=duplicate_md5s) |
+            Q(MD5_checksum__in=shared_md5s)).values_list(
+            'MD5_checksum',
+            flat=True).distinct().order_by('MD5_checksum')
+        last_md5 = ''
+        while True:
+            batch = list(md5s.filter(MD5_checksum__gt=last_md5)[:batch_size])
+            if not batch:
+                break
+            last_md5 = batch[-1]
+            for md5 in batch:
+                self.dedup_checksum(md5, dry_run)
+        self.stdout.write('{} {} file{} among {} dataset{}, freeing {}.'.format(
+            'Would share' if dry_run else 'Shared',
+            self.shared_count,
+            pluralize(self.shared_count),
+            self.dataset_count,
+            pluralize(self.dataset_count),
+            filesizeformat(self.freed_size)))
+
+    @staticmethod
+    def find_candidates():
+        """ Datasets with their own internal file. """
+        return Dataset.objects.filter(content=None).exclude(
+            dataset_file='').exclude(
+            dataset_file=None).exclude(
+            MD5_checksum='')
+
+    def dedup_checksum(self, md5, dry_run):
+        """ Share the files of all datasets with the same MD5. """
+        groups = defaultdict(list)  # {sha256: [dataset]}
+        for dataset in self.find_candidates().filter(
+                MD5_checksum=md5).order_by('id'):
+            try:
+                with open(dataset.dataset_file.path, 'rb') as f:
+                    file_md5, sha256 = compute_checksums(f)
+            except OSError as ex:
+                logger.warning('Cannot read dataset %d: %s', dataset.id, ex)
+                continue
+            if file_md5 != md5:
+                logger.warning('Dataset %d has changed, expected MD5 %s, not %s.',
+                               dataset.id,
+                               md5,
+                               file_md5)
+                continue
+            groups[sha256].append(dataset)
+        for sha256, datasets in groups.items():
+            content = DatasetContent.objects.filter(
+                MD5_checksum=md5,
+                sha256_checksum=sha256,
+                ref_count__gt=0).first()
+            if content is None and len(datasets) == 1:
+                continue  # Nothing to share with.
+            file_size = os.stat(datasets[0].dataset_file.path).st_size
+            self.shared_count += 1
+            self.dataset_count += len(datasets)
+            if dry_run:
+                linked_count = 1 if content is None else 0
+                self.freed_size += file_size * (len(datasets) - linked_count)
+                continue
+            self.share_files(md5, sha256, file_size, datasets)
+
+    def share_files(self, md5, sha256, file_size, datasets):
+        """ Point datasets at a shared file, then delete their own copies.
+
+        If the shared file doesn't exist yet, it's hard linked to the first
+        dataset's file.
+        """
+        old_paths = [dataset.dataset_file.path for dataset in datasets]
+        with transaction.atomic():
+            content, _ = DatasetContent.objects.get_or_create(
+                MD5_checksum=md5,
+                sha256_checksum=sha256,
+                defaults=dict(content_file=DatasetContent.build_name(md5, sha256),
+                              content_size=file_size))
+            content = DatasetContent.objects.select_for_update().get(pk=content.pk)
+            content_path = content.content_file.path
+            linked_count = 0
+            if content.ref_count == 0 or not os.path.exists(content_path):
+                os.makedirs(os.path.dirname(content_path), exist_ok=True)
+                if os.path.lexists(content_path):
+                    os.remove(content_path)  # Left over from a failed run.
+                os.link(old_paths[0], content_path)
+                linked_count = 1
+            for dataset in datasets:
+                dataset.attach_content(content)
+                dataset.save(update_fields=['content',
+                                            'dataset_file',
+                                            'dataset_size'])
+            content.ref_count += len(datasets)
+            content.save(update_fields=['ref_count'])
+        for old_path in old_paths:
+            os.remove(old_path)
+        self.freed_size += file_size * (len(datasets) - linked_count)
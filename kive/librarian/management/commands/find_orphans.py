@@ -61,7 +61,7 @@ class Command(BaseCommand):
                 if delete_all or delete_files:
                     try:
                         logger.info('Deleting file "{}"'.format(orphan.dataset_file.path))
-                        orphan.dataset_file.delete()
+                        orphan.release_file()
                     except ValueError:
                         logger.error('File has already been deleted')
                     logger.info('File deleted successfully')
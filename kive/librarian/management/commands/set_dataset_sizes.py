@@ -0,0 +1,47 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from librarian.models import Dataset
+from portal.models import StorageLedger
+
+
+class Command(BaseCommand):
+    help = "Record the file size on any datasets that don't have one yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=1000,
+                            help='Number of datasets to update at a time')
+
+    def handle(self, batch_size=1000, **kwargs):
+        set_count = missing_count = 0
+        last_id = 0
+        print('Starting.')
+        while True:
+            datasets = list(Dataset.objects.filter(
+                dataset_size=None,
+                id__gt=last_id).exclude(
+                Q(dataset_file='') & Q(external_path='')).select_related(
+                'externalfiledirectory').order_by('id')[:batch_size])
+            if not datasets:
+                break
+            last_id = datasets[-1].id
+            sized_datasets = []
+            for dataset in datasets:
+                try:
+                    dataset.dataset_size = os.stat(
+                        dataset.get_file_path()).st_size
+                except OSError as ex:
+                    print('Missing file for dataset {}: {}'.format(dataset.id,
+                                                                   ex))
+                    missing_count += 1
+                    continue
+                sized_datasets.append(dataset)
+            Dataset.objects.bulk_update(sized_datasets, ['dataset_size'])
+            StorageLedger.track_changes(sized_datasets)
+            set_count += len(sized_datasets)
+            print('Set size on {} datasets.'.format(set_count))
+        print('Done, with {} missing files.'.format(missing_count))
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.10 on 2026-10-17 06:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('librarian', '0201_squashed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=260)),
+                ('size', models.BigIntegerField(blank=True, help_text='Total size in bytes, if known when the upload started.', null=True)),
+                ('received_ranges', models.TextField(default='[]', help_text='JSON list of [start, end) byte ranges received so far.')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarian', '0202_datasetupload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dataset',
+            name='dataset_size',
+            field=models.BigIntegerField(blank=True, help_text='Size of the dataset file in bytes, recorded when it is created and kept after it is purged. Zero after redaction. If null, this has not been computed yet.', null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarian', '0203_dataset_size_help'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['date_created', 'id'], name='dataset_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarian', '0204_dataset_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['MD5_checksum', 'name'], name='dataset_md5_name_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('librarian', '0205_dataset_md5_name_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('MD5_checksum', models.CharField(max_length=32)),
+                ('sha256_checksum', models.CharField(help_text="Second checksum, so an MD5 collision can't share a file.", max_length=64)),
+                ('content_file', models.FileField(max_length=260, upload_to='')),
+                ('content_size', models.BigIntegerField(help_text='Size of the file in bytes.')),
+                ('ref_count', models.IntegerField(default=0, help_text='Number of datasets sharing the file, zero if it was deleted.')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='datasetcontent',
+            constraint=models.UniqueConstraint(fields=('MD5_checksum', 'sha256_checksum'), name='dataset_content_unique'),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='content',
+            field=models.ForeignKey(blank=True, help_text='Shared file that dataset_file points to, if any', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='datasets', to='librarian.datasetcontent'),
+        ),
+    ]
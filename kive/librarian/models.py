@@ -5,21 +5,29 @@ Shipyard data models pertaining to the lookup of the past: ExecRecord,
 Dataset, etc.
 """
 import csv
+import hashlib
+import json
 import logging
 import os
 import os.path
 import re
+import shutil
+import threading
 import time
 import io
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from django.contrib.humanize.templatetags.humanize import naturaltime
 from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.core.files import File
+from django.core.files.storage import default_storage
 from django.db.models.functions import Now
 from django.utils import timezone
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.template.defaultfilters import filesizeformat, pluralize
 from django.db.models.signals import post_delete
 from django.urls import reverse
@@ -28,7 +36,8 @@ import metadata.models
 import archive.models
 import librarian.signals
 from constants import maxlengths
-from container.models import ContainerDataset
+from container.models import ContainerDataset, ChecksumCache
+from portal.models import StorageLedger
 import six
 
 import file_access_utils
@@ -123,6 +132,14 @@ class Dataset(metadata.models.AccessControl):
                                     db_index=True,
                                     max_length=maxlengths.MAX_FILENAME_LENGTH)
 
+    content = models.ForeignKey(
+        'DatasetContent',
+        related_name='datasets',
+        help_text='Shared file that dataset_file points to, if any',
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT)
+
     externalfiledirectory = models.ForeignKey(
         ExternalFileDirectory,
         verbose_name="External file directory",
@@ -163,8 +180,8 @@ class Dataset(metadata.models.AccessControl):
     dataset_size = models.BigIntegerField(
         blank=True,
         null=True,
-        help_text="Size of the dataset file in bytes.  If null, this has not been computed yet or there is no "
-                  "internally stored file."
+        help_text="Size of the dataset file in bytes, recorded when it is created and kept after it is "
+                  "purged. Zero after redaction. If null, this has not been computed yet."
     )
     is_external_missing = models.BooleanField(
         default=False,
@@ -175,10 +192,16 @@ class Dataset(metadata.models.AccessControl):
 
     class Meta:
         ordering = ["-date_created", "name"]
+        indexes = [models.Index(fields=['date_created', 'id'],
+                                name='dataset_created_id_idx'),
+                   models.Index(fields=['MD5_checksum', 'name'],
+                                name='dataset_md5_name_idx')]
 
     def __init__(self, *args, **kwargs):
         super(Dataset, self).__init__(*args, **kwargs)
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Fingerprint of the file when its MD5 was calculated in this process.
+        self._trusted_md5 = None
 
     def __repr__(self):
         return 'Dataset(name={!r})'.format(self.name)
@@ -325,7 +348,7 @@ class Dataset(metadata.models.AccessControl):
                 }
             )
 
-        if self.has_data() and not self.check_md5():
+        if self.has_data() and not self.is_md5_trusted() and not self.check_md5():
             error_str = ('File integrity of "{}" lost. Current checksum "{}" does not equal expected checksum ' +
                          '"{}"').format(self, self.compute_md5(), self.MD5_checksum)
             raise ValidationError(
@@ -359,7 +382,9 @@ class Dataset(metadata.models.AccessControl):
             access_limits = []
 
         # Is this an output from a container run?
-        for container_dataset in self.containers.filter(argument__type='O'):
+        output_entries = self.containers.filter(argument__type='O',
+                                                run__reused_run=None)
+        for container_dataset in output_entries:
             access_limits.append(container_dataset.run)
 
         return access_limits
@@ -374,11 +399,15 @@ class Dataset(metadata.models.AccessControl):
     def get_view_url(self):
         return reverse('dataset_view', kwargs={"dataset_id": self.id})
 
-    def get_filesize(self):
+    def get_filesize(self, verify=False):
         """
+        :param bool verify: open the file to check its size, instead of using
+            the size recorded in the database
         :return int: size of dataset_file in bytes or None if the file handle
         cannot be accessed.
         """
+        if not verify and self.dataset_size is not None:
+            return None if self.is_recorded_missing() else self.dataset_size
         data_handle = None
         try:
             data_handle = self.get_open_file_handle("rb")
@@ -389,16 +418,42 @@ class Dataset(metadata.models.AccessControl):
             if data_handle is not None:
                 data_handle.close()
 
-    def get_formatted_filesize(self):
-        unformatted_size = self.get_filesize()
+    def get_formatted_filesize(self, verify=False):
+        unformatted_size = self.get_filesize(verify)
         if unformatted_size is None:
             return 'missing'
         return filesizeformat(unformatted_size)
 
-    def compute_md5(self):
+    def get_download_name(self):
+        """ Name to download the file as, or None to use the file's name.
+
+        Shared files are named after their checksums, so use the dataset name.
+        """
+        if self.content_id is not None:
+            return self.name
+        return None
+
+    def get_file_path(self):
+        """ Absolute path of the internal or external file, or None. """
+        if self.dataset_file:
+            return self.dataset_file.path
+        return self.external_absolute_path()
+
+    def compute_md5(self, use_cache=False):
         """Computes the MD5 checksum of the Dataset.
         Return None if the file could not be accessed.
+
+        :param bool use_cache: look up the checksum in the ChecksumCache, and
+            only hash the file if it has changed since it was cached.
         """
+        if use_cache:
+            file_path = self.get_file_path()
+            try:
+                if file_path is not None:
+                    return ChecksumCache.compute_md5(file_path)
+            except IOError as e:
+                self.logger.warning('error accessing dataset file: %s', e)
+                return None
         data_handle = self.get_open_file_handle("rb")
         if data_handle is None:
             self.logger.warning('cannot access file handle')
@@ -406,6 +461,31 @@ class Dataset(metadata.models.AccessControl):
         with data_handle:
             return file_access_utils.compute_md5(data_handle.file)
 
+    def get_md5_fingerprint(self):
+        file_path = self.get_file_path()
+        if file_path is None:
+            return None
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (file_path,
+                self.MD5_checksum,
+                file_stat.st_size,
+                file_stat.st_mtime_ns)
+
+    def trust_md5(self):
+        """ Skip checking the MD5 until the file changes.
+
+        Call this right after calculating the MD5 from the same bytes that are
+        in the file, so clean() doesn't have to read the file again.
+        """
+        self._trusted_md5 = self.get_md5_fingerprint()
+
+    def is_md5_trusted(self):
+        return (self._trusted_md5 is not None and
+                self._trusted_md5 == self.get_md5_fingerprint())
+
     def check_md5(self):
         """
         Checks the MD5 checksum of the Dataset against its stored value.
@@ -429,7 +509,19 @@ class Dataset(metadata.models.AccessControl):
             return False
         return True
 
-    def has_data(self, raise_errors=False):
+    def is_recorded_missing(self):
+        """ True if the database says the file is gone, without checking. """
+        return self.is_purged or bool(self.external_path and self.is_external_missing)
+
+    def has_data(self, raise_errors=False, verify=True):
+        """ Check that the file is there.
+
+        :param bool raise_errors: raise an IOError if the file can't be read
+        :param bool verify: open the file, instead of trusting the database
+            when it has recorded the file's size
+        """
+        if not verify and self.dataset_size is not None:
+            return not self.is_recorded_missing()
         try:
             data_handle = self.get_open_file_handle("rb", raise_errors=True)
             data_handle.close()
@@ -519,11 +611,32 @@ class Dataset(metadata.models.AccessControl):
                 type(file_handle.name)
             )
             fname = os.path.basename(full_name)
-            self.dataset_file.save(fname, File(file_handle))
+            if settings.DATASET_SHARED_STORAGE:
+                staged = DatasetContent.stage_file(file_handle, fname)
+                self.attach_content(DatasetContent.claim(staged))
+                copied_md5 = staged.md5
+            else:
+                if hasattr(file_handle, 'temporary_file_path'):
+                    # Storage moves spooled uploads, instead of copying them.
+                    content = file_handle
+                else:
+                    content = file_access_utils.HashingFile(file_handle)
+                self.dataset_file.save(fname, content)
+                self.dataset_size = self.dataset_file.size
+                copied_md5 = getattr(content, 'md5', None)
         finally:
             if opened_file_ourselves:
                 file_handle.close()
 
+        if not self.MD5_checksum:
+            if copied_md5 is None:
+                self.set_md5()
+            else:
+                self.MD5_checksum = copied_md5
+            self.trust_md5()
+        elif copied_md5 == self.MD5_checksum:
+            self.trust_md5()
+
         self.clean()
         self.save()
 
@@ -604,7 +717,9 @@ class Dataset(metadata.models.AccessControl):
         make_dataset=False). If check is True, do a ContentCheck on the
         file.  file_path is an absolute path; if externalfiledirectory
         is specified, file_path will be checked to ensure that it's
-        inside the specified directory.
+        inside the specified directory. If precomputed_md5 isn't given, it
+        comes from file_handle.md5 (set by the upload handlers), or it's
+        calculated while the file is copied, so the file only gets read once.
 
         Returns the Dataset created.
         """
@@ -653,20 +768,159 @@ class Dataset(metadata.models.AccessControl):
             new_dataset.last_time_checked = timezone.now()
             new_dataset.is_uploaded = is_uploaded
 
+            if precomputed_md5 is None and file_handle is not None:
+                # Set by the upload handlers while the file was received.
+                precomputed_md5 = getattr(file_handle, 'md5', None)
             if precomputed_md5 is not None:
                 new_dataset.MD5_checksum = precomputed_md5
-            else:
+            elif not keep_file:
                 new_dataset.set_md5(file_name, file_handle)
+                new_dataset.trust_md5()
+            # Otherwise, register_file() calculates it while copying.
             if file_handle is not None:
                 file_handle.seek(0)
 
             if keep_file:
                 new_dataset.register_file(file_path=file_name, file_handle=file_handle)
+            elif external_path:
+                new_dataset.dataset_size = os.stat(file_name).st_size
 
             new_dataset.clean()
             new_dataset.save()
         return new_dataset
 
+    @classmethod
+    def create_datasets(cls,
+                        file_names,
+                        user,
+                        permissions_source=None,
+                        thread_count=None,
+                        batch_size=None,
+                        on_batch=None):
+        """ Register many files as Datasets with a few bulk queries.
+
+        Each file is hashed and copied into the upload folder by a pool of
+        threads, then the Dataset rows and their permissions are inserted in
+        batches, one transaction per batch. Skips create_dataset()'s checks,
+        so only use it for files that Kive just wrote, like run outputs.
+
+        :param file_names: a sequence of (file_path, name) pairs
+        :param user: the owner of the new Datasets
+        :param permissions_source: an AccessControl object to copy
+            users_allowed and groups_allowed from
+        :param thread_count: number of files to hash and copy at once,
+            defaults to SAVE_OUTPUTS_THREADS
+        :param batch_size: rows to insert in each transaction, defaults to
+            SAVE_OUTPUTS_BATCH_SIZE
+        :param on_batch: a function to call with each batch of new Datasets,
+            inside the batch's transaction, so it can insert related rows
+        :return: a list of Datasets, in the same order as file_names
+        """
+        if thread_count is None:
+            thread_count = settings.SAVE_OUTPUTS_THREADS
+        if batch_size is None:
+            batch_size = settings.SAVE_OUTPUTS_BATCH_SIZE
+        if permissions_source is None:
+            user_ids = group_ids = []
+        else:
+            user_ids = list(permissions_source.users_allowed.values_list(
+                'pk',
+                flat=True))
+            group_ids = list(permissions_source.groups_allowed.values_list(
+                'pk',
+                flat=True))
+
+        def store_file(file_name):
+            file_path, name = file_name
+            dataset = cls(user=user,
+                          name=name,
+                          last_time_checked=timezone.now())
+            staged = None
+            with io.open(file_path, 'rb') as file_handle:
+                if settings.DATASET_SHARED_STORAGE:
+                    # Claimed below, in the same transaction as the dataset.
+                    staged = DatasetContent.stage_file(file_handle, file_path)
+                    dataset.MD5_checksum = staged.md5
+                else:
+                    # Hashes the file while copying it, in a single read.
+                    content = file_access_utils.HashingFile(file_handle)
+                    dataset.dataset_file.save(os.path.basename(file_path),
+                                              content,
+                                              save=False)
+                    dataset.MD5_checksum = content.md5
+                    dataset.dataset_size = dataset.dataset_file.size
+            return dataset, staged
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            stored_files = list(executor.map(store_file, file_names))
+        datasets = [dataset for dataset, _ in stored_files]
+
+        user_link = cls.users_allowed.through
+        group_link = cls.groups_allowed.through
+        for batch_start in range(0, len(datasets), batch_size):
+            batch = datasets[batch_start:batch_start+batch_size]
+            with transaction.atomic():
+                for dataset, staged in stored_files[batch_start:batch_start+batch_size]:
+                    if staged is not None:
+                        dataset.attach_content(DatasetContent.claim(staged))
+                cls.objects.bulk_create(batch)
+                StorageLedger.track_changes(batch, created=True)
+                user_link.objects.bulk_create(
+                    user_link(dataset_id=dataset.pk, user_id=user_id)
+                    for dataset in batch
+                    for user_id in user_ids)
+                group_link.objects.bulk_create(
+                    group_link(dataset_id=dataset.pk, group_id=group_id)
+                    for dataset in batch
+                    for group_id in group_ids)
+                if on_batch is not None:
+                    on_batch(batch)
+        return datasets
+
+    def purge_file(self, save=True):
+        """ Delete the internal file, but keep a record of its size.
+
+        :param bool save: False if the caller will save the record, like
+            with bulk_update()
+        :return: a shared file's id that the caller must release after saving,
+            if save is False, otherwise None
+        """
+        if self.dataset_size is None:
+            try:
+                self.dataset_size = self.dataset_file.size
+            except OSError:
+                pass
+        return self.release_file(save=save)
+
+    def attach_content(self, content):
+        """ Point this dataset at a shared file. """
+        self.content = content
+        self.dataset_file = content.content_file.name
+        self.dataset_size = content.content_size
+
+    def release_file(self, save=True):
+        """ Delete the internal file, or this dataset's share of it.
+
+        A shared file is only deleted when the last dataset releases it.
+        :param bool save: False if the caller will save the record, like
+            with bulk_update()
+        :return: a shared file's id that the caller must pass to
+            DatasetContent.release() in the same transaction that saves the
+            record, if save is False, otherwise None
+        """
+        if self.content_id is None:
+            self.dataset_file.delete(save=save)
+            return None
+        content_id = self.content_id
+        self.content = None
+        self.dataset_file = ''
+        if not save:
+            return content_id
+        with transaction.atomic():
+            self.save()
+            DatasetContent.release(content_id)
+        return None
+
     @transaction.atomic
     def build_redaction_plan(self, redaction_accumulator=None):
         """
@@ -694,13 +948,18 @@ class Dataset(metadata.models.AccessControl):
 
         self._redacted = True
         self.MD5_checksum = ""
+        self.dataset_size = 0
         self.externalfiledirectory = None
         if self.external_path:
             self.external_path = ""
-        self.save(update_fields=["_redacted", "MD5_checksum", "externalfiledirectory", "external_path"])
+        self.save(update_fields=["_redacted",
+                                 "MD5_checksum",
+                                 "dataset_size",
+                                 "externalfiledirectory",
+                                 "external_path"])
 
         if bool(self.dataset_file):
-            self.dataset_file.delete(save=True)
+            self.release_file(save=True)
         if self.has_structure():
             self.structure.delete()
 
@@ -728,7 +987,8 @@ class Dataset(metadata.models.AccessControl):
 
         for run_dataset in self.containers.all():
             run = run_dataset.run
-            if (run_dataset.argument.type == 'I' and
+            is_reused_output = run.reused_run_id is not None
+            if ((run_dataset.argument.type == 'I' or is_reused_output) and
                     run not in removal_plan['ContainerRuns']):
                 run.build_removal_plan(removal_plan)
 
@@ -763,16 +1023,15 @@ class Dataset(metadata.models.AccessControl):
         return unneeded
 
     @classmethod
-    def scan_file_names(cls):
-        """ Yield all file names, relative to MEDIA_ROOT. """
-        dataset_root = os.path.join(settings.MEDIA_ROOT, cls.UPLOAD_DIR)
-        for dirpath, dirnames, filenames in os.walk(dataset_root):
-            for filename in filenames:
-                file_path = os.path.join(dirpath, filename)
-                yield os.path.relpath(file_path, settings.MEDIA_ROOT)
-            if not (dirnames or filenames):
-                # Empty folder can be purged.
-                yield os.path.relpath(dirpath, settings.MEDIA_ROOT)
+    def scan_file_names(cls, manifest=None):
+        """ Yield all file names and empty folders, relative to MEDIA_ROOT.
+
+        :param ScanManifest manifest: skips folders that haven't changed
+            since the last scan
+        """
+        return file_access_utils.scan_media_folder(cls.UPLOAD_DIR,
+                                                   recursive=True,
+                                                   manifest=manifest)
 
     @classmethod
     def external_file_check(cls, batch_size=1000):
@@ -837,5 +1096,325 @@ class Dataset(metadata.models.AccessControl):
         return "{}_{}{}".format(name, unique_id, extension)
 
 
+StagedContent = namedtuple('StagedContent', 'name md5 sha256 size')
+
+
+class DatasetContent(models.Model):
+    """ A dataset file that is shared by all datasets with the same contents.
+
+    Only used when DATASET_SHARED_STORAGE is set. Each dataset that shares
+    the file points its dataset_file at content_file, and ref_count tracks
+    how many of them there are. The file is deleted when the last one is
+    purged, redacted, or removed, but the record is kept.
+    """
+    UPLOAD_DIR = os.path.join(Dataset.UPLOAD_DIR, 'Shared')
+    # Partly copied files, cleaned up by purge --synch if they're abandoned.
+    STAGING_DIR = os.path.join(UPLOAD_DIR, 'Staging')
+
+    MD5_checksum = models.CharField(max_length=32)
+    sha256_checksum = models.CharField(
+        max_length=64,
+        help_text='Second checksum, so an MD5 collision can\'t share a file.')
+    content_file = models.FileField(max_length=maxlengths.MAX_FILENAME_LENGTH)
+    content_size = models.BigIntegerField(help_text='Size of the file in bytes.')
+    ref_count = models.IntegerField(
+        default=0,
+        help_text='Number of datasets sharing the file, zero if it was deleted.')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['MD5_checksum', 'sha256_checksum'],
+                                    name='dataset_content_unique')]
+
+    def __str__(self):
+        return self.content_file.name
+
+    @classmethod
+    def build_name(cls, md5, sha256):
+        return os.path.join(cls.UPLOAD_DIR, md5[:2], md5 + '_' + sha256)
+
+    @classmethod
+    def stage_file(cls, file_handle, file_name):
+        """ Copy a file into the staging folder, and hash it on the way.
+
+        Spooled uploads are hashed, then moved instead of copied.
+        :param file_handle: an open, binary file at the start
+        :param str file_name: name to start the staged file's name with
+        :return StagedContent: the staged file's name and checksums
+        """
+        staged_name = os.path.join(cls.STAGING_DIR, os.path.basename(file_name))
+        if hasattr(file_handle, 'temporary_file_path'):
+            md5, sha256 = file_access_utils.compute_checksums(file_handle)
+            file_handle.seek(0)
+            staged_name = default_storage.save(staged_name, file_handle)
+        else:
+            content = file_access_utils.HashingFile(file_handle, sha256=True)
+            staged_name = default_storage.save(staged_name, content)
+            md5, sha256 = content.md5, content.sha256
+        return StagedContent(staged_name,
+                             md5,
+                             sha256,
+                             default_storage.size(staged_name))
+
+    @classmethod
+    def claim(cls, staged):
+        """ Add a reference to a shared file with the staged contents.
+
+        If no dataset holds the contents yet, the staged file moves into
+        place. Otherwise, it's deleted.
+        :param StagedContent staged: from stage_file()
+        :return DatasetContent: the shared file's record
+        """
+        with transaction.atomic():
+            content, _ = cls.objects.get_or_create(
+                MD5_checksum=staged.md5,
+                sha256_checksum=staged.sha256,
+                defaults=dict(content_file=cls.build_name(staged.md5,
+                                                          staged.sha256),
+                              content_size=staged.size))
+            content = cls.objects.select_for_update().get(pk=content.pk)
+            content_path = content.content_file.path
+            staged_path = default_storage.path(staged.name)
+            if content.ref_count == 0 or not os.path.exists(content_path):
+                os.makedirs(os.path.dirname(content_path), exist_ok=True)
+                os.replace(staged_path, content_path)
+            else:
+                os.remove(staged_path)
+            content.ref_count += 1
+            content.save(update_fields=['ref_count'])
+        return content
+
+    @classmethod
+    def recount(cls):
+        """ Rebuild ref_count from the datasets that point at each shared file.
+
+        Deletes any shared file that no datasets point at.
+        :return: the number of records that were corrected
+        """
+        suspects = cls.objects.annotate(
+            dataset_count=models.Count('datasets')).exclude(
+            ref_count=models.F('dataset_count')).values_list('pk', flat=True)
+        corrected_count = 0
+        for content_id in suspects:
+            with transaction.atomic():
+                content = cls.objects.select_for_update().get(pk=content_id)
+                dataset_count = content.datasets.count()
+                if dataset_count == content.ref_count:
+                    continue  # Changed since the first query.
+                LOGGER.warning('Corrected reference count for %s from %d to %d.',
+                               content,
+                               content.ref_count,
+                               dataset_count)
+                content.ref_count = dataset_count
+                content.save(update_fields=['ref_count'])
+                if dataset_count == 0:
+                    default_storage.delete(content.content_file.name)
+                corrected_count += 1
+        return corrected_count
+
+    @classmethod
+    def release(cls, content_id):
+        """ Remove a reference to a shared file, and delete it if it's the last.
+
+        :param content_id: the shared file's record id
+        """
+        with transaction.atomic():
+            content = cls.objects.select_for_update().get(pk=content_id)
+            content.ref_count = max(content.ref_count - 1, 0)
+            content.save(update_fields=['ref_count'])
+            if content.ref_count == 0:
+                default_storage.delete(content.content_file.name)
+
+
+class PartialUploadFile(File):
+    """ A finished chunked upload that storage can move instead of copying. """
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class DatasetUpload(models.Model):
+    """ A large file that is uploaded in chunks before it becomes a Dataset.
+
+    Chunks can arrive in any order, or in parallel, and each one is written
+    at its own offset in a partial file. The partial file is moved into place
+    when the upload is finished.
+
+    Hashing while chunks arrive is only best-effort. Each process keeps its
+    own running MD5, because hashlib's state can't be shared, and only
+    hashes the bytes it has seen arrive in order. Whichever process finishes
+    the upload hashes the rest, or the whole file if it has no running MD5
+    for it. Running MD5s that haven't been used for HASHER_MAX_AGE seconds
+    are dropped, in case their uploads were finished or abandoned elsewhere.
+    """
+    UPLOAD_DIR = "DatasetUploads"  # This is relative to kive.settings.MEDIA_ROOT
+    HASHER_MAX_AGE = 60 * 60
+
+    # {upload_id: (hashed_offset, md5gen, used_time)} for uploads hashed in
+    # this process
+    hashers = {}
+    hashers_lock = threading.Lock()
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=maxlengths.MAX_FILENAME_LENGTH)
+    size = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Total size in bytes, if known when the upload started.")
+    received_ranges = models.TextField(
+        default='[]',
+        help_text="JSON list of [start, end) byte ranges received so far.")
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = None  # Filled in later by Django.
+
+    def __str__(self):
+        return '{} ({}/{})'.format(self.file_name, self.offset, self.size)
+
+    @property
+    def file_path(self):
+        return os.path.join(settings.MEDIA_ROOT,
+                            self.UPLOAD_DIR,
+                            str(self.pk),
+                            os.path.basename(self.file_name))
+
+    def get_ranges(self):
+        return json.loads(self.received_ranges)
+
+    @property
+    def offset(self):
+        """ Number of bytes received without any gaps from the start. """
+        ranges = self.get_ranges()
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    @property
+    def is_complete(self):
+        return self.size is not None and self.offset == self.size
+
+    def write_chunk(self, start, stream, length, chunk_size=1024*1024):
+        """ Write bytes from a stream at an offset in the partial file.
+
+        :param int start: the offset to write at
+        :param stream: a readable file object with at least length bytes
+        :param int length: the number of bytes to write
+        """
+        end = start + length
+        if start < 0 or (self.size is not None and end > self.size):
+            raise ValidationError('Chunk {}-{} is outside the file size {}.'.format(
+                start,
+                end,
+                self.size))
+        file_path = self.file_path
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        position = start
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            while position < end:
+                data = stream.read(min(chunk_size, end - position))
+                if not data:
+                    raise ValidationError('Chunk ended after {} of {} bytes.'.format(
+                        position - start,
+                        length))
+                os.pwrite(fd, data, position)
+                position += len(data)
+        finally:
+            os.close(fd)
+        with transaction.atomic():
+            upload = DatasetUpload.objects.select_for_update().get(pk=self.pk)
+            upload.add_range(start, end)
+            upload.save(update_fields=['received_ranges'])
+        self.received_ranges = upload.received_ranges
+        self.hash_received()
+
+    def add_range(self, start, end):
+        merged = []
+        for old_start, old_end in sorted(self.get_ranges() + [[start, end]]):
+            if merged and old_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], old_end)
+            else:
+                merged.append([old_start, old_end])
+        self.received_ranges = json.dumps(merged)
+
+    def pop_hasher(self):
+        """ Take this upload's running MD5 from this process's cache.
+
+        :return: (hashed_offset, md5gen), where md5gen is None if this
+            process doesn't have one
+        """
+        with self.hashers_lock:
+            hashed_offset, md5gen, _ = self.hashers.pop(self.pk, (0, None, None))
+        return hashed_offset, md5gen
+
+    def store_hasher(self, hashed_offset, md5gen):
+        """ Put this upload's running MD5 back, and drop any unused ones. """
+        now = time.monotonic()
+        with self.hashers_lock:
+            stale_ids = [upload_id
+                         for upload_id, (_, _, used_time) in self.hashers.items()
+                         if now - used_time > self.HASHER_MAX_AGE]
+            for upload_id in stale_ids:
+                del self.hashers[upload_id]
+            self.hashers[self.pk] = (hashed_offset, md5gen, now)
+
+    def hash_received(self):
+        """ Add any bytes received in order to this process's MD5. """
+        hashed_offset, md5gen = self.pop_hasher()
+        if md5gen is None:
+            md5gen = hashlib.md5()
+        offset = self.offset
+        if offset > hashed_offset:
+            with open(self.file_path, 'rb') as f:
+                f.seek(hashed_offset)
+                while hashed_offset < offset:
+                    data = f.read(min(1024*1024, offset - hashed_offset))
+                    if not data:
+                        break
+                    md5gen.update(data)
+                    hashed_offset += len(data)
+        self.store_hasher(hashed_offset, md5gen)
+
+    def finish(self):
+        """ Check that the upload is complete, and open the partial file.
+
+        :return: a PartialUploadFile with its md5 attribute set
+        """
+        ranges = self.get_ranges()
+        if self.size is None:
+            if len(ranges) > 1 or (ranges and ranges[0][0] != 0):
+                raise ValidationError('Upload has gaps: {}.'.format(ranges))
+            self.size = self.offset
+        if not self.is_complete:
+            raise ValidationError('Upload only has {} of {} bytes.'.format(
+                self.offset,
+                self.size))
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        open(self.file_path, 'ab').close()  # In case it's empty.
+        hashed_offset, md5gen = self.pop_hasher()
+        if md5gen is None:
+            # Chunks were hashed by another process, so start again.
+            hashed_offset, md5gen = 0, hashlib.md5()
+        with open(self.file_path, 'rb') as f:
+            f.seek(hashed_offset)
+            for data in iter(lambda: f.read(1024*1024), b''):
+                md5gen.update(data)
+        upload_file = PartialUploadFile(open(self.file_path, 'rb'))
+        upload_file.md5 = md5gen.hexdigest()
+        return upload_file
+
+    def delete_files(self):
+        shutil.rmtree(os.path.dirname(self.file_path), ignore_errors=True)
+        self.pop_hasher()
+
+    @classmethod
+    def remove_stale(cls, max_age):
+        """ Remove uploads that were started more than max_age ago. """
+        stale_uploads = cls.objects.filter(
+            date_created__lt=timezone.now() - max_age)
+        for upload in stale_uploads:
+            upload.delete_files()
+            upload.delete()
+
+
 # Register signals.
 post_delete.connect(librarian.signals.dataset_post_delete, sender=Dataset)
@@ -2,13 +2,14 @@ import os
 
 from django.template.defaultfilters import filesizeformat
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
-from librarian.models import Dataset, ExternalFileDirectory
+from librarian.models import Dataset, ExternalFileDirectory, DatasetUpload
 
-from kive.serializers import AccessControlSerializer
+from kive.serializers import AccessControlSerializer, FieldSelectionMixin
 
 
-class ExternalFileDirectorySerializer(serializers.ModelSerializer):
+class ExternalFileDirectorySerializer(FieldSelectionMixin, serializers.ModelSerializer):
     class Meta:
         model = ExternalFileDirectory
         fields = (
@@ -38,11 +39,18 @@ class ExternalFileDirectoryListFilesSerializer(ExternalFileDirectorySerializer):
         )
 
 
-class DatasetSerializer(AccessControlSerializer, serializers.ModelSerializer):
+class DatasetSerializer(FieldSelectionMixin,
+                        AccessControlSerializer,
+                        serializers.ModelSerializer):
+    """ Serializes datasets, with sizes from the database.
+
+    Add verify=true to the query string to check the files themselves.
+    """
 
     filename = serializers.SerializerMethodField()
-    filesize = serializers.IntegerField(source='get_filesize', read_only=True)
+    filesize = serializers.SerializerMethodField()
     filesize_display = serializers.SerializerMethodField()
+    has_data = serializers.SerializerMethodField()
 
     download_url = serializers.HyperlinkedIdentityField(view_name='dataset-download')
     removal_plan = serializers.HyperlinkedIdentityField(view_name='dataset-removal-plan')
@@ -92,14 +100,30 @@ class DatasetSerializer(AccessControlSerializer, serializers.ModelSerializer):
         if not obj:
             return
 
+        download_name = obj.get_download_name()
+        if download_name is not None:
+            return download_name
         if obj.dataset_file:
             return os.path.basename(obj.dataset_file.name)
         elif obj.external_path:
             return os.path.basename(obj.external_path)
 
+    def is_verified(self):
+        request = self.context.get('request')
+        return (request is not None and
+                request.GET.get('verify', '').lower() == 'true')
+
+    def get_filesize(self, obj):
+        if obj:
+            return obj.get_filesize(verify=self.is_verified())
+
     def get_filesize_display(self, obj):
         if obj:
-            return filesizeformat(obj.get_filesize())
+            return filesizeformat(self.get_filesize(obj))
+
+    def get_has_data(self, obj):
+        if obj:
+            return obj.has_data(verify=self.is_verified())
 
     def validate(self, data):
         df_exists = bool(data.get("dataset_file"))
@@ -155,3 +179,44 @@ class DatasetSerializer(AccessControlSerializer, serializers.ModelSerializer):
             externalfiledirectory=efd
         )
         return dataset
+
+
+class DatasetUploadSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+    finalize_url = serializers.SerializerMethodField()
+    offset = serializers.IntegerField(read_only=True)
+    received_ranges = serializers.JSONField(source='get_ranges', read_only=True)
+
+    class Meta:
+        model = DatasetUpload
+        fields = ('id',
+                  'url',
+                  'finalize_url',
+                  'file_name',
+                  'size',
+                  'offset',
+                  'received_ranges',
+                  'date_created')
+
+    def get_url(self, obj):
+        return reverse('dataset-upload',
+                       kwargs=dict(upload_id=obj.pk),
+                       request=self.context.get('request'))
+
+    def get_finalize_url(self, obj):
+        return reverse('dataset-upload-finalize',
+                       kwargs=dict(upload_id=obj.pk),
+                       request=self.context.get('request'))
+
+
+class DatasetLookupSerializer(serializers.Serializer):
+    """ A batch of checksums to look up in the accessible datasets. """
+    MAX_CHECKSUMS = 10000
+
+    md5_checksums = serializers.ListField(
+        child=serializers.RegexField(r'^[0-9A-Fa-f]{32}$'),
+        allow_empty=False,
+        max_length=MAX_CHECKSUMS)
+
+    def validate_md5_checksums(self, value):
+        return [md5.lower() for md5 in value]
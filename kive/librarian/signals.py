@@ -1,4 +1,11 @@
 def dataset_post_delete(instance, **kwargs):
-    """Remove a Dataset from the file system after it is deleted."""
+    """Remove a Dataset from the file system after it is deleted.
+
+    If other datasets share the file, just release this one's share.
+    """
     if instance.dataset_file:
-        instance.dataset_file.delete(save=False)
+        content_id = instance.release_file(save=False)
+        if content_id is not None:
+            # The record is already gone, so release its share right away.
+            from librarian.models import DatasetContent
+            DatasetContent.release(content_id)
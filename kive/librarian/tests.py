@@ -3,6 +3,7 @@ Shipyard models pertaining to the librarian app.
 """
 
 from datetime import datetime, timedelta
+import hashlib
 import os
 import random
 import re
@@ -11,13 +12,16 @@ import logging
 import json
 import shutil
 import stat
-from io import BytesIO
+from base64 import urlsafe_b64encode
+from io import BytesIO, StringIO
 from zipfile import ZipFile
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.contrib.auth.models import User, Group
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, skipIfDBFeature, Client
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import TestCase, skipIfDBFeature, Client, override_settings
 from django.urls import reverse, resolve
 from django.core.files import File
 from django.core.files.base import ContentFile
@@ -31,7 +35,8 @@ from rest_framework import status
 from constants import groups
 from container.models import ContainerFamily, ContainerArgument, Container
 from librarian.ajax import ExternalFileDirectoryViewSet, DatasetViewSet
-from librarian.models import Dataset, ExternalFileDirectory
+from librarian.models import Dataset, ExternalFileDirectory, DatasetContent, \
+    DatasetUpload
 from librarian.serializers import DatasetSerializer
 from metadata.models import kive_user, everyone_group
 
@@ -153,6 +158,40 @@ class DatasetTests(LibrarianTestCase):
                              expected_md5
                          ))
 
+    @patch('file_access_utils.compute_md5')
+    def test_hashed_upload(self, mock_compute_md5):
+        """ Uploads hashed by the upload handlers are moved, not reread. """
+        uploaded_file = TemporaryUploadedFile('upload.txt', 'text/plain', 0, None)
+        uploaded_file.write(b'Uploaded contents.')
+        uploaded_file.seek(0)
+        uploaded_file.md5 = hashlib.md5(b'Uploaded contents.').hexdigest()
+        temp_path = uploaded_file.temporary_file_path()
+
+        dataset = Dataset.create_dataset(file_path=None,
+                                         user=self.myUser,
+                                         name='upload',
+                                         file_handle=uploaded_file)
+        uploaded_file.close()
+
+        mock_compute_md5.assert_not_called()
+        self.assertEqual(uploaded_file.md5, dataset.MD5_checksum)
+        self.assertFalse(os.path.exists(temp_path))
+        with dataset.get_open_file_handle('rb') as f:
+            self.assertEqual(b'Uploaded contents.', f.read())
+
+    def test_hash_while_copying(self):
+        expected_md5 = file_access_utils.compute_md5(BytesIO(b'Copied contents.'))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'Copied contents.')
+            f.flush()
+            with patch('file_access_utils.compute_md5') as mock_compute_md5:
+                dataset = Dataset.create_dataset(file_path=f.name,
+                                                 user=self.myUser,
+                                                 name='copied')
+
+        mock_compute_md5.assert_not_called()
+        self.assertEqual(expected_md5, dataset.MD5_checksum)
+
     def test_dataset_creation(self):
         """
         Test coherence of a freshly created Dataset.
@@ -332,6 +371,62 @@ class DatasetTests(LibrarianTestCase):
         self.assertRegex(dataset2.name, r'bar\.txt.*')
         self.assertTrue(dataset1.is_uploaded)
 
+    def test_create_datasets(self):
+        source = self.singlet_dataset
+        source.users_allowed.add(self.ringoUser)
+        file_names = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(5):
+                file_path = os.path.join(temp_dir, 'bulk{}.txt'.format(i))
+                with open(file_path, 'w') as f:
+                    f.write('Content of file {}.'.format(i))
+                file_names.append((file_path, 'bulk{}'.format(i)))
+
+            datasets = Dataset.create_datasets(file_names,
+                                               user=self.myUser,
+                                               permissions_source=source,
+                                               thread_count=2,
+                                               batch_size=2)
+
+        self.assertEqual(['bulk0', 'bulk1', 'bulk2', 'bulk3', 'bulk4'],
+                         [dataset.name for dataset in datasets])
+        dataset = Dataset.objects.get(pk=datasets[3].pk)
+        self.assertEqual(self.myUser, dataset.user)
+        self.assertEqual(len('Content of file 3.'), dataset.dataset_size)
+        self.assertTrue(dataset.check_md5())
+        with dataset.get_open_file_handle('r') as f:
+            self.assertEqual('Content of file 3.', f.read())
+        self.assertEqual([self.ringoUser], list(dataset.users_allowed.all()))
+        self.assertEqual([everyone_group()], list(dataset.groups_allowed.all()))
+
+    def test_create_datasets_batch_callback(self):
+        """ A failure in the callback rolls back that batch's datasets. """
+        batch_sizes = []
+
+        def on_batch(batch):
+            batch_sizes.append(len(batch))
+            if len(batch_sizes) == 2:
+                raise RuntimeError('Linking failed.')
+
+        file_names = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(3):
+                file_path = os.path.join(temp_dir, 'bulk{}.txt'.format(i))
+                with open(file_path, 'w') as f:
+                    f.write('Content of file {}.'.format(i))
+                file_names.append((file_path, 'bulk{}'.format(i)))
+            dataset_count = Dataset.objects.count()
+
+            with self.assertRaisesRegex(RuntimeError, 'Linking failed'):
+                Dataset.create_datasets(file_names,
+                                        user=self.myUser,
+                                        batch_size=2,
+                                        on_batch=on_batch)
+
+        self.assertEqual([2, 1], batch_sizes)
+        self.assertEqual(dataset_count + 2, Dataset.objects.count())
+        self.assertFalse(Dataset.objects.filter(name='bulk2').exists())
+
     def test_unique_filename(self):
         example_dataset = Dataset(name="asdf_jkl.example.txt", id=987654321)
         unique_name = example_dataset.unique_filename()
@@ -448,6 +543,59 @@ class DatasetApiMockTests(BaseTestCases.ApiTestCase):
         self.assertEqual(len(response.data), 3)
         self.assertEqual(response.data[2]['name'], 'bananas')
 
+    @patch('librarian.models.Dataset.has_data')
+    def test_list_fields(self, mock_has_data):
+        request = self.factory.get(self.list_path + '?fields=id,name')
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertEqual(3, len(response.data))
+        self.assertEqual(['id', 'name'], list(response.data[2]))
+        mock_has_data.assert_not_called()
+
+    def test_list_cursor(self):
+        request = self.factory.get(self.list_path + '?cursor=&page_size=2')
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertEqual(['bananas', 'cherries'],
+                         [dataset['name'] for dataset in response.data['results']])
+        self.assertNotIn('count', response.data)
+        next_url = response.data['next']
+
+        request = self.factory.get(next_url)
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertEqual(['apples'],
+                         [dataset['name'] for dataset in response.data['results']])
+        self.assertIsNone(response.data['next'])
+
+    def test_list_invalid_cursor(self):
+        request = self.factory.get(self.list_path + '?cursor=garbage')
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertEqual(400, response.status_code)
+
+    def test_list_cursor_wrong_values(self):
+        cursor = urlsafe_b64encode(json.dumps(['not a date']).encode()).decode()
+        request = self.factory.get(self.list_path + '?cursor=' + cursor)
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertEqual(400, response.status_code)
+
+    def test_list_omit(self):
+        request = self.factory.get(
+            self.list_path + '?omit=removal_plan,redaction_plan')
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        self.assertIn('name', response.data[2])
+        self.assertNotIn('removal_plan', response.data[2])
+        self.assertNotIn('redaction_plan', response.data[2])
+
     def test_filter_smart(self):
         """
         Test the API list view.
@@ -737,6 +885,88 @@ class DatasetApiTests(BaseTestCases.ApiTestCase):
         for d in Dataset.objects.all():
             d.dataset_file.delete()
 
+    def test_chunked_upload(self):
+        client = Client()
+        client.force_login(self.kive_user)
+        contents = b'0123456789'
+
+        response = client.post(reverse('dataset-uploads'),
+                               dict(file_name='chunked.txt', size=len(contents)))
+        self.assertEqual(201, response.status_code, response.content)
+        upload_url = response.json()['url']
+        finalize_url = response.json()['finalize_url']
+
+        # Chunks can arrive out of order.
+        response = client.put(upload_url,
+                              contents[6:],
+                              content_type='application/octet-stream',
+                              HTTP_CONTENT_RANGE='bytes 6-9/10')
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(0, response.json()['offset'])
+        self.assertEqual([[6, 10]], response.json()['received_ranges'])
+
+        response = client.post(finalize_url, dict(name='early'))
+        self.assertEqual(400, response.status_code)
+
+        client.put(upload_url,
+                   contents[:6],
+                   content_type='application/octet-stream',
+                   HTTP_CONTENT_RANGE='bytes 0-5/10')
+        response = client.get(upload_url)
+        self.assertEqual(10, response.json()['offset'])
+
+        response = client.post(finalize_url,
+                               dict(name='chunked',
+                                    description='uploaded in chunks'))
+        self.assertEqual(201, response.status_code, response.content)
+
+        dataset = Dataset.objects.get(id=response.json()['id'])
+        self.assertEqual(hashlib.md5(contents).hexdigest(), dataset.MD5_checksum)
+        self.assertEqual('chunked.txt', os.path.basename(dataset.dataset_file.name))
+        self.assertTrue(dataset.is_uploaded)
+        with dataset.get_open_file_handle('rb') as f:
+            self.assertEqual(contents, f.read())
+        self.assertEqual(404, client.get(upload_url).status_code)
+
+    def test_chunked_upload_bad_headers(self):
+        client = Client()
+        client.force_login(self.kive_user)
+        response = client.post(reverse('dataset-uploads'),
+                               dict(file_name='chunked.txt', size=10))
+        upload_url = response.json()['url']
+
+        no_range_response = client.put(upload_url,
+                                       b'0123456789',
+                                       content_type='application/octet-stream')
+        empty_response = client.put(upload_url,
+                                    b'',
+                                    content_type='application/octet-stream',
+                                    HTTP_CONTENT_RANGE='bytes 0-0/10')
+
+        self.assertEqual(400, no_range_response.status_code)
+        self.assertEqual(400, empty_response.status_code)
+        self.assertEqual([], client.get(upload_url).json()['received_ranges'])
+
+    def test_upload_hashers_expire(self):
+        """ Running MD5s for uploads finished elsewhere don't pile up. """
+        old_upload = DatasetUpload.objects.create(user=self.kive_user,
+                                                  file_name='old.txt')
+        new_upload = DatasetUpload.objects.create(user=self.kive_user,
+                                                  file_name='new.txt')
+        self.addCleanup(old_upload.delete_files)
+        self.addCleanup(new_upload.delete_files)
+        old_upload.store_hasher(5, hashlib.md5(b'01234'))
+        hashed_offset, md5gen, used_time = DatasetUpload.hashers[old_upload.pk]
+        DatasetUpload.hashers[old_upload.pk] = (
+            hashed_offset,
+            md5gen,
+            used_time - DatasetUpload.HASHER_MAX_AGE - 1)
+
+        new_upload.store_hasher(0, hashlib.md5())
+
+        self.assertNotIn(old_upload.pk, DatasetUpload.hashers)
+        self.assertIn(new_upload.pk, DatasetUpload.hashers)
+
     def test_dataset_add(self):
         num_cols = 12
         num_files = 2
@@ -829,6 +1059,7 @@ class DatasetApiTests(BaseTestCases.ApiTestCase):
 
         dataset = Dataset.objects.get(pk=self.detail_pk)
         self.assertTrue(dataset.is_redacted())
+        self.assertEqual(0, dataset.dataset_size)
 
     def test_dataset_purge(self):
         request = self.factory.patch(self.detail_path,
@@ -840,6 +1071,9 @@ class DatasetApiTests(BaseTestCases.ApiTestCase):
 
         dataset = Dataset.objects.get(pk=self.detail_pk)
         self.assertFalse(dataset.has_data())
+        self.assertFalse(dataset.has_data(verify=False))
+        self.assertEqual(self.test_dataset.dataset_size, dataset.dataset_size)
+        self.assertIsNone(dataset.get_filesize())
 
     def test_dataset_purge_again(self):
         # Purge the dataset file.
@@ -869,6 +1103,135 @@ class DatasetApiTests(BaseTestCases.ApiTestCase):
         self.assertFalse(response.data['has_data'])
         self.assertFalse(response.data['is_redacted'])
 
+    def test_list_cursor_count(self):
+        request = self.factory.get(
+            self.list_path + '?cursor=&page_size=2&count=approximate')
+        force_authenticate(request, user=self.kive_user)
+        response = self.list_view(request, pk=None)
+
+        # PostgreSQL's estimate depends on when the table was last analyzed.
+        count = response.data['count']
+        self.assertIsInstance(count, int)
+        self.assertGreaterEqual(count, 0)
+        self.assertEqual(1, len(response.data['results']))
+        self.assertIsNone(response.data['next'])
+
+    def list_visible_names(self, dataset_permissions):
+        """ Create a dataset for each set of permissions, and list them.
+
+        The list goes through the full request, so it uses the real access
+        filter and the middleware that caches the viewer's groups.
+        :param dataset_permissions: {name: (users_allowed, groups_allowed)}
+        :return: the names of the datasets that a new viewer can see, sorted
+        """
+        owner = User.objects.create_user('list_owner')
+        viewer = User.objects.create_user('list_viewer')
+        viewer.groups.add(Group.objects.get(pk=groups.DEVELOPERS_PK))
+        for name, (users_allowed, groups_allowed) in dataset_permissions.items():
+            dataset = Dataset.objects.create(user=owner, name=name)
+            dataset.users_allowed.add(*users_allowed)
+            dataset.groups_allowed.add(*groups_allowed)
+        client = Client()
+        client.force_login(viewer)
+
+        response = client.get(self.list_path)
+
+        self.assertEqual(200, response.status_code, response.content)
+        return sorted(entry['name'] for entry in response.json())
+
+    def test_list_shared_with_group(self):
+        developers = Group.objects.get(pk=groups.DEVELOPERS_PK)
+        admins = Group.objects.get(pk=groups.ADMIN_PK)
+
+        names = self.list_visible_names(dict(developers=([], [developers]),
+                                             admins=([], [admins]),
+                                             private=([], [])))
+
+        self.assertEqual(['developers'], names)
+
+    def test_list_shared_with_everyone(self):
+        names = self.list_visible_names(dict(everyone=([], [everyone_group()]),
+                                             private=([], [])))
+
+        self.assertEqual(['everyone'], names)
+
+    def test_list_shared_with_user(self):
+        other_user = User.objects.create_user('list_other')
+        viewer_names = self.list_visible_names(dict(other=([other_user], []),
+                                                    private=([], [])))
+        viewer = User.objects.get(username='list_viewer')
+        Dataset.objects.get(name='other').users_allowed.add(viewer)
+        client = Client()
+        client.force_login(viewer)
+
+        response = client.get(self.list_path)
+
+        self.assertEqual([], viewer_names)
+        self.assertEqual(['other'],
+                         [entry['name'] for entry in response.json()])
+
+    def test_lookup(self):
+        md5 = self.test_dataset.MD5_checksum
+        missing_md5 = 'f' * 32
+        owner = User.objects.create_user('lookup_owner')
+        other_user = User.objects.create_user('lookup_other')
+        owned_dataset = Dataset.objects.create(user=owner,
+                                               name='owned.csv',
+                                               MD5_checksum=md5)
+        Dataset.objects.create(user=other_user,
+                               name='private.csv',
+                               MD5_checksum=md5)
+        client = Client()
+        client.force_login(owner)
+
+        response = client.post(reverse('dataset-lookup'),
+                               dict(md5_checksums=[md5.upper(), missing_md5]),
+                               content_type='application/json')
+
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual({md5: [owned_dataset.pk], missing_md5: []},
+                         response.json()['md5_checksums'])
+
+    def test_lookup_invalid(self):
+        client = Client()
+        client.force_login(self.kive_user)
+
+        response = client.post(reverse('dataset-lookup'),
+                               dict(md5_checksums=['not an md5']),
+                               content_type='application/json')
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('md5_checksums', response.json())
+
+    def test_dataset_size_recorded(self):
+        self.assertEqual(len('0,1,2,3,4,5,6,7,8,9,10,11'),
+                         self.test_dataset.dataset_size)
+
+    def test_dataset_view_missing_file(self):
+        """ Sizes come from the database, unless verify is requested. """
+        os.remove(self.test_dataset.dataset_file.path)
+
+        request = self.factory.get(self.detail_path)
+        force_authenticate(request, user=self.kive_user)
+        response = self.detail_view(request, pk=self.detail_pk)
+        self.assertEqual(self.test_dataset.dataset_size,
+                         response.data['filesize'])
+        self.assertTrue(response.data['has_data'])
+
+        request = self.factory.get(self.detail_path + '?verify=true')
+        force_authenticate(request, user=self.kive_user)
+        response = self.detail_view(request, pk=self.detail_pk)
+        self.assertIsNone(response.data['filesize'])
+        self.assertFalse(response.data['has_data'])
+
+    def test_set_dataset_sizes(self):
+        Dataset.objects.update(dataset_size=None)
+
+        call_command('set_dataset_sizes', stdout=StringIO())
+
+        dataset = Dataset.objects.get(pk=self.detail_pk)
+        self.assertEqual(self.test_dataset.dataset_size, dataset.dataset_size)
+
 
 # noinspection DuplicatedCode
 @skipIfDBFeature('is_mocked')
@@ -1697,3 +2060,190 @@ Missing 1 external dataset. Most recent from {}, last checked 4 minutes ago.
         self.assertLess(external_file_ds.last_time_checked, start_time)
         self.assertTrue(external_file_ds.is_external_missing)
         self.assertMultiLineEqual(expected_log_messages, log_messages)
+
+
+@override_settings(DATASET_SHARED_STORAGE=True)
+class SharedStorageTests(TestCase):
+    def setUp(self):
+        self.user = kive_user()
+
+    def tearDown(self):
+        tools.clean_up_all_files()
+
+    def create_dataset(self, text='I am a file!', name='example.txt'):
+        with tempfile.TemporaryFile() as f:
+            f.write(text.encode())
+            f.seek(0)
+            return Dataset.create_dataset(file_path=None,
+                                          user=self.user,
+                                          name=name,
+                                          file_handle=f)
+
+    @staticmethod
+    def read_file(dataset):
+        with open(dataset.dataset_file.path, 'rb') as f:
+            return f.read()
+
+    def test_share(self):
+        dataset1 = self.create_dataset()
+        dataset2 = self.create_dataset()
+        dataset3 = self.create_dataset('I am different.')
+
+        content = dataset1.content
+        content.refresh_from_db()
+        self.assertEqual(content, dataset2.content)
+        self.assertNotEqual(content, dataset3.content)
+        self.assertEqual(2, content.ref_count)
+        self.assertEqual(dataset1.dataset_file.name, dataset2.dataset_file.name)
+        self.assertEqual(
+            os.path.join('Datasets', 'Shared', content.MD5_checksum[:2],
+                         content.MD5_checksum + '_' + content.sha256_checksum),
+            content.content_file.name)
+        self.assertEqual(hashlib.md5(b'I am a file!').hexdigest(),
+                         dataset2.MD5_checksum)
+        self.assertEqual(hashlib.sha256(b'I am a file!').hexdigest(),
+                         content.sha256_checksum)
+        self.assertEqual(12, dataset2.dataset_size)
+        self.assertEqual(b'I am a file!', self.read_file(dataset2))
+        staging_path = os.path.join(settings.MEDIA_ROOT, DatasetContent.STAGING_DIR)
+        self.assertEqual([], os.listdir(staging_path))
+
+    def test_share_outputs(self):
+        source_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_folder)
+        file_names = []
+        for name in ('a.txt', 'b.txt'):
+            file_path = os.path.join(source_folder, name)
+            with open(file_path, 'w') as f:
+                f.write('I am a file!')
+            file_names.append((file_path, name))
+
+        dataset1, dataset2 = Dataset.create_datasets(file_names, self.user)
+
+        dataset1.refresh_from_db()
+        dataset2.refresh_from_db()
+        self.assertEqual(dataset1.content_id, dataset2.content_id)
+        self.assertEqual(2, dataset1.content.ref_count)
+        self.assertEqual(12, dataset1.dataset_size)
+
+    def test_purge(self):
+        """ The shared file is only deleted when the last dataset is purged. """
+        dataset1 = self.create_dataset()
+        dataset2 = self.create_dataset()
+        content_path = dataset1.content.content_file.path
+
+        dataset1.purge_file()
+
+        self.assertFalse(dataset1.dataset_file)
+        self.assertIsNone(dataset1.content)
+        self.assertEqual(12, dataset1.dataset_size)
+        self.assertTrue(os.path.exists(content_path))
+        dataset2.content.refresh_from_db()
+        self.assertEqual(1, dataset2.content.ref_count)
+
+        dataset2.purge_file()
+
+        self.assertFalse(os.path.exists(content_path))
+        self.assertEqual(0, DatasetContent.objects.get().ref_count)
+
+    def test_recount(self):
+        dataset1 = self.create_dataset()
+        self.create_dataset()
+        dataset3 = self.create_dataset('I am different.')
+        DatasetContent.objects.filter(pk=dataset1.content_id).update(ref_count=3)
+        Dataset.objects.filter(pk=dataset3.pk).update(content=None,
+                                                      dataset_file='')
+
+        with self.assertLogs('librarian.models', logging.WARNING):
+            corrected_count = DatasetContent.recount()
+
+        self.assertEqual(2, corrected_count)
+        dataset1.content.refresh_from_db()
+        dataset3.content.refresh_from_db()
+        self.assertEqual(2, dataset1.content.ref_count)
+        self.assertEqual(0, dataset3.content.ref_count)
+        self.assertFalse(os.path.exists(dataset3.content.content_file.path))
+
+    def test_store_after_purge(self):
+        dataset1 = self.create_dataset()
+        dataset1.purge_file()
+
+        dataset2 = self.create_dataset()
+
+        self.assertEqual(1, dataset2.content.ref_count)
+        self.assertEqual(b'I am a file!', self.read_file(dataset2))
+
+    def test_redact(self):
+        dataset1 = self.create_dataset()
+        dataset2 = self.create_dataset()
+
+        dataset1.redact()
+
+        dataset1.refresh_from_db()
+        self.assertTrue(dataset1.is_redacted())
+        self.assertFalse(dataset1.dataset_file)
+        self.assertTrue(os.path.exists(dataset2.dataset_file.path))
+        self.assertEqual(1, DatasetContent.objects.get().ref_count)
+
+    def test_remove(self):
+        dataset1 = self.create_dataset()
+        dataset2 = self.create_dataset()
+
+        dataset1.remove()
+
+        self.assertTrue(os.path.exists(dataset2.dataset_file.path))
+        self.assertEqual(1, DatasetContent.objects.get().ref_count)
+
+    def test_filename(self):
+        dataset = self.create_dataset(name='example.csv')
+
+        filename = DatasetSerializer().get_filename(dataset)
+
+        self.assertEqual('example.csv', filename)
+
+    @override_settings(DATASET_SHARED_STORAGE=False)
+    def test_dedup_command(self):
+        dataset1 = self.create_dataset()
+        dataset2 = self.create_dataset()
+        dataset3 = self.create_dataset('I am different.')
+        old_path1 = dataset1.dataset_file.path
+        old_path2 = dataset2.dataset_file.path
+        expected_message = 'Shared 1 file among 2 datasets, freeing 12\xa0bytes.\n'
+        stdout = StringIO()
+
+        call_command('dedup_datasets', stdout=stdout)
+
+        self.assertEqual(expected_message, stdout.getvalue())
+        dataset1.refresh_from_db()
+        dataset2.refresh_from_db()
+        dataset3.refresh_from_db()
+        content = DatasetContent.objects.get()
+        self.assertEqual(content, dataset1.content)
+        self.assertEqual(content, dataset2.content)
+        self.assertIsNone(dataset3.content)
+        self.assertEqual(2, content.ref_count)
+        self.assertEqual(content.content_file.name, dataset2.dataset_file.name)
+        self.assertEqual(b'I am a file!', self.read_file(dataset2))
+        self.assertFalse(os.path.exists(old_path1))
+        self.assertFalse(os.path.exists(old_path2))
+
+        # Later copies join the shared file.
+        dataset4 = self.create_dataset()
+        call_command('dedup_datasets', stdout=StringIO())
+        dataset4.refresh_from_db()
+        self.assertEqual(content, dataset4.content)
+        content.refresh_from_db()
+        self.assertEqual(3, content.ref_count)
+
+    @override_settings(DATASET_SHARED_STORAGE=False)
+    def test_dedup_dry_run(self):
+        dataset1 = self.create_dataset()
+        self.create_dataset()
+        expected_message = 'Would share 1 file among 2 datasets, freeing 12\xa0bytes.\n'
+        stdout = StringIO()
+
+        call_command('dedup_datasets', dry_run=True, stdout=stdout)
+
+        self.assertEqual(expected_message, stdout.getvalue())
+        self.assertFalse(DatasetContent.objects.exists())
+        self.assertTrue(os.path.exists(dataset1.dataset_file.path))
@@ -46,7 +46,9 @@ def dataset_download(request, dataset_id):
     except ObjectDoesNotExist:
         raise Http404("ID {} cannot be accessed".format(dataset_id))
 
-    return build_download_response(dataset.dataset_file)
+    return build_download_response(dataset.dataset_file,
+                                   request,
+                                   dataset.get_download_name())
 
 
 @login_required
@@ -72,7 +74,9 @@ def dataset_view(request, dataset_id):
     addable_users, addable_groups = dataset.other_users_groups()
 
     generating_run = None
-    container_dataset = dataset.containers.filter(argument__type='O').first()  # Output from which runs?
+    container_dataset = dataset.containers.filter(
+        argument__type='O',
+        run__reused_run=None).first()  # Output from which run?
     if container_dataset is None:
         container_run = None
     else:
@@ -0,0 +1,14 @@
+from metadata.models import request_group_ids
+
+
+class AccessGroupCacheMiddleware:
+    """ Cache each user's group ids until the end of the request. """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request_group_ids.set({})
+        try:
+            return self.get_response(request)
+        finally:
+            request_group_ids.reset(token)
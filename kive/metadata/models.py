@@ -8,10 +8,11 @@ from django.db import models, transaction
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.http import Http404
 from django.contrib.auth.models import User, Group
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef
 
 import json
 import itertools
+from contextvars import ContextVar
 
 from constants import groups, users
 
@@ -106,6 +107,29 @@ class KiveUser(User):
         return query_object
 
 
+# {user_id: [group_id]} for the current request, or None outside of requests.
+request_group_ids = ContextVar('request_group_ids', default=None)
+
+
+def get_group_ids(user):
+    """ Find the ids of the user's groups, including Everyone.
+
+    During a web request, AccessGroupCacheMiddleware keeps the list until the
+    request ends, so the groups are only queried once per request. Outside of
+    requests, they're queried every time, so long-running processes see
+    changes.
+    """
+    cache = request_group_ids.get()
+    group_ids = None if cache is None else cache.get(user.pk)
+    if group_ids is None:
+        group_ids = list(user.groups.values_list('pk', flat=True))
+        if groups.EVERYONE_PK not in group_ids:
+            group_ids.append(groups.EVERYONE_PK)
+        if cache is not None:
+            cache[user.pk] = group_ids
+    return group_ids
+
+
 class AccessControl(models.Model):
     """
     Represents anything that belongs to a certain user.
@@ -269,11 +293,35 @@ class AccessControl(models.Model):
             if not admin_check(user):
                 raise Exception('User is not an administrator.')
         else:
-            user_plus = KiveUser.kiveify(user)
-            allowed_items = queryset.filter(user_plus.access_query())
-            queryset = queryset.filter(pk__in=allowed_items)
+            queryset = queryset.filter(
+                AccessControl.build_access_filter(user, queryset.model))
         return queryset
 
+    @staticmethod
+    def build_access_filter(user, model):
+        """ Build a filter for records of model that the user can see.
+
+        Each way of granting access is a separate condition: owning the record,
+        or a correlated EXISTS on the users_allowed or groups_allowed through
+        table. That lets the database probe the through tables' indexes for
+        each row, instead of joining both many-to-many tables and removing
+        duplicates.
+        @param user: user that must be able to see the records
+        @param model: a model that derives from AccessControl
+        """
+        conditions = [Q(user_id=user.pk)]
+        for field_name, target_ids in (('users_allowed', [user.pk]),
+                                       ('groups_allowed', get_group_ids(user))):
+            field = model._meta.get_field(field_name)
+            links = field.remote_field.through.objects.filter(**{
+                field.m2m_field_name(): OuterRef('pk'),
+                field.m2m_reverse_field_name() + '_id__in': target_ids})
+            conditions.append(Q(Exists(links)))
+        access_filter = Q()
+        for condition in conditions:
+            access_filter |= condition
+        return access_filter
+
     def grant_everyone_access(self):
         self.groups_allowed.add(Group.objects.get(pk=groups.EVERYONE_PK))
 
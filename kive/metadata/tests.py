@@ -5,7 +5,7 @@ from django.test import TestCase, skipIfDBFeature
 from django.contrib.auth.models import User, Group
 
 from librarian.models import Dataset
-from metadata.models import everyone_group
+from metadata.models import everyone_group, request_group_ids
 from constants import groups
 
 
@@ -106,3 +106,58 @@ class AccessControlTests(TestCase):
                                                                  groups_qs=self.groups_to_intersect)
         self.assertSetEqual(set(self.users_to_intersect), set(users_qs))
         self.assertSetEqual(set(self.groups_to_intersect), set(groups_qs))
+
+    def test_filter_by_user_owner(self):
+        visible = Dataset.filter_by_user(self.ds_owner)
+
+        self.assertEqual([self.dataset], list(visible))
+
+    def test_filter_by_user_no_access(self):
+        visible = Dataset.filter_by_user(self.lore)
+
+        self.assertEqual([], list(visible))
+
+    def test_filter_by_user_allowed(self):
+        self.dataset.users_allowed.add(self.lore)
+
+        visible = Dataset.filter_by_user(self.lore)
+
+        self.assertEqual([self.dataset], list(visible))
+
+    def test_filter_by_user_group(self):
+        self.lore.groups.add(self.developers_group)
+        self.dataset.groups_allowed.add(self.developers_group)
+        self.dataset.users_allowed.add(self.lore)  # No duplicates.
+
+        visible = Dataset.filter_by_user(self.lore)
+
+        self.assertEqual([self.dataset], list(visible))
+
+    def test_filter_by_user_everyone(self):
+        """ Everyone group counts, even for users who aren't in it. """
+        self.lore.groups.clear()
+        self.dataset.groups_allowed.add(everyone_group())
+
+        visible = Dataset.filter_by_user(self.lore)
+
+        self.assertEqual([self.dataset], list(visible))
+
+    def test_filter_by_user_caches_groups(self):
+        """ Only look up the user's groups once per request. """
+        token = request_group_ids.set({})
+        self.addCleanup(request_group_ids.reset, token)
+        Dataset.filter_by_user(self.lore)
+
+        with self.assertNumQueries(1):
+            list(Dataset.filter_by_user(self.lore))
+
+    def test_filter_by_user_group_changes(self):
+        """ Outside of requests, the same user object sees group changes. """
+        self.dataset.groups_allowed.add(self.developers_group)
+        visible_before = list(Dataset.filter_by_user(self.lore))
+
+        self.lore.groups.add(self.developers_group)
+        visible_after = list(Dataset.filter_by_user(self.lore))
+
+        self.assertEqual([], visible_before)
+        self.assertEqual([self.dataset], visible_after)
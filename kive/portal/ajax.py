@@ -1,10 +1,72 @@
+from rest_framework import permissions
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
 from django.contrib.auth.models import User
 
+from kive.ajax import FieldSelectionModelMixin, StandardPagination
 from kive.serializers import UserSerializer
+from portal.models import StorageLedger, StorageSnapshot
+from portal.serializers import StorageLedgerSerializer, StorageSnapshotSerializer
 
 
-class UserViewSet(ReadOnlyModelViewSet):
+class UserViewSet(FieldSelectionModelMixin, ReadOnlyModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    prefetch_related_fields = dict(groups=['groups'])
+
+
+class StorageLedgerViewSet(ReadOnlyModelViewSet):
+    """ Storage used in each category, for each user and in total.
+
+    Entries without a user are the totals for all users. Only administrators
+    can see them.
+
+    Query parameters for the list view:
+
+    * category=datasets - only list one category
+    * totals - only list the totals for all users
+
+    # Actions
+
+    * totals/ - {category: {file_count, total_size}}, read straight from the
+        ledger without scanning any files or records
+    """
+    queryset = StorageLedger.objects.select_related('user')
+    serializer_class = StorageLedgerSerializer
+    permission_classes = (permissions.IsAdminUser,)
+    pagination_class = StandardPagination
+
+    def get_queryset(self):
+        StorageLedger.fold_changes()
+        queryset = super(StorageLedgerViewSet, self).get_queryset()
+        category = self.request.GET.get('category')
+        if category is not None:
+            queryset = queryset.filter(category=category)
+        if 'totals' in self.request.GET:
+            queryset = queryset.filter(user=None)
+        return queryset
+
+    @action(detail=False)
+    def totals(self, request):
+        totals = {category: dict(file_count=0, total_size=0)
+                  for category, _ in StorageLedger.CATEGORIES}
+        StorageLedger.fold_changes()
+        for category, file_count, total_size in StorageLedger.objects.filter(
+                user=None).values_list('category', 'file_count', 'total_size'):
+            totals[category] = dict(file_count=file_count, total_size=total_size)
+        return Response(totals)
+
+
+class StorageSnapshotViewSet(ReadOnlyModelViewSet):
+    """ History of the storage totals, recorded each time purge runs.
+
+    Only administrators can see them. The list is newest first, and accepts
+    the cursor query parameter to page through a long history.
+    """
+    queryset = StorageSnapshot.objects.order_by('-snapshot_time', '-id')
+    serializer_class = StorageSnapshotSerializer
+    permission_classes = (permissions.IsAdminUser,)
+    pagination_class = StandardPagination
+    cursor_ordering = ('-snapshot_time', '-id')
@@ -11,6 +11,7 @@ class PortalConfig(AppConfig):
     name = 'portal'
 
     def ready(self):
+        self.connect_storage_signals()
         is_manage_py = sys.argv and sys.argv[0].endswith('manage.py')
         if is_manage_py and len(sys.argv) > 1 and sys.argv[1] != 'runserver':
             # Running some other management command, don't check secret key.
@@ -19,3 +20,15 @@ class PortalConfig(AppConfig):
             logger.warning(
                 'KIVE_SECRET_KEY environment variable was not set. Sessions '
                 'will expire when the server shuts down.')
+
+    @staticmethod
+    def connect_storage_signals():
+        from django.db.models.signals import post_init, post_save, post_delete
+        from portal.models import StorageLedger
+        from portal import signals
+
+        for source in StorageLedger.SOURCES:
+            model = source.model
+            post_init.connect(signals.remember_storage, sender=model)
+            post_save.connect(signals.track_storage, sender=model)
+            post_delete.connect(signals.track_storage_deletion, sender=model)
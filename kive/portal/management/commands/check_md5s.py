@@ -3,6 +3,7 @@ from threading import Thread, Event
 import errno
 from django.core.management.base import BaseCommand
 
+from file_access_utils import compute_md5s
 from librarian.models import Dataset
 
 
@@ -24,6 +25,11 @@ class Command(BaseCommand):
                             type=int,
                             default=10,
                             help='Interval between status reports (seconds)')
+        parser.add_argument('--threads',
+                            '-t',
+                            type=int,
+                            help='Number of files to hash at once '
+                                 '(default MD5_THREADS setting)')
 
     def handle(self, *args, **options):
         max_size = options['max_size']
@@ -32,6 +38,29 @@ class Command(BaseCommand):
                                args=(options['report_interval'], finish_event))
         report_thread.daemon = True
         report_thread.start()
+        datasets = {}  # {file_path: [dataset]}
+        file_paths = self.find_files(max_size, datasets)
+        for file_path, new_md5 in compute_md5s(file_paths,
+                                               thread_count=options['threads']):
+            ds = datasets[file_path].pop()
+            if new_md5 == ds.MD5_checksum:
+                self.dataset_passed += 1
+            else:
+                ds.logger.warning('MD5 mismatch for %s: expected %s, but was %s.',
+                                  file_path,
+                                  ds.MD5_checksum,
+                                  new_md5)
+                self.dataset_failures += 1
+        finish_event.set()
+        report_thread.join()
+
+    def find_files(self, max_size, datasets):
+        """ Yield the file paths to hash, and count the ones to skip.
+
+        :param max_size: skip files larger than this, unless None
+        :param dict datasets: filled in with {file_path: [dataset]} for each
+            file that gets yielded
+        """
         for ds in Dataset.objects.iterator():
             self.dataset_count += 1
             try:
@@ -45,12 +74,10 @@ class Command(BaseCommand):
                 self.dataset_purged += 1
             elif max_size is not None and ds.get_filesize() > max_size:
                 self.dataset_skips += 1
-            elif not ds.check_md5():
-                self.dataset_failures += 1
             else:
-                self.dataset_passed += 1
-        finish_event.set()
-        report_thread.join()
+                file_path = ds.get_file_path()
+                datasets.setdefault(file_path, []).append(ds)
+                yield file_path
 
     def report(self, interval, finish_event):
         """ Loop until finish_event is set, reporting every few seconds.
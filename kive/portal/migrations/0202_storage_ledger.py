@@ -0,0 +1,60 @@
+# Generated by Django 4.0.10 on 2026-10-17 07:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('portal', '0201_squashed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('containers', 'containers'), ('sandboxes', 'container runs'), ('logs', 'container logs'), ('datasets', 'datasets')], max_length=20)),
+                ('file_count', models.BigIntegerField(default=0)),
+                ('total_size', models.BigIntegerField(default=0, help_text='Size of all the files in bytes.')),
+                ('reconcile_time', models.DateTimeField(blank=True, help_text='When the totals were last checked against the files.', null=True)),
+            ],
+            options={
+                'ordering': ['category', 'user_id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='StorageSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('containers', 'containers'), ('sandboxes', 'container runs'), ('logs', 'container logs'), ('datasets', 'datasets')], max_length=20)),
+                ('snapshot_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('file_count', models.BigIntegerField(default=0)),
+                ('total_size', models.BigIntegerField(default=0, help_text='Size of all the files in bytes.')),
+            ],
+            options={
+                'ordering': ['snapshot_time', 'category'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='storagesnapshot',
+            index=models.Index(fields=['snapshot_time'], name='storage_snapshot_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='storageledger',
+            name='user',
+            field=models.ForeignKey(blank=True, help_text='Owner of the files, or blank for the total of all users.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='storage_ledgers', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='storageledger',
+            constraint=models.UniqueConstraint(fields=('category', 'user'), name='storage_ledger_user_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='storageledger',
+            constraint=models.UniqueConstraint(condition=models.Q(('user', None)), fields=('category',), name='storage_ledger_total_unique'),
+        ),
+    ]
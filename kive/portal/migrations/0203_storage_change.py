@@ -0,0 +1,28 @@
+# Generated by Django 4.0.10 on 2026-10-17 08:28
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0202_storage_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('containers', 'containers'), ('sandboxes', 'container runs'), ('logs', 'container logs'), ('datasets', 'datasets')], max_length=20)),
+                ('user_id', models.IntegerField(blank=True, help_text="Owner of the files. Not a foreign key, because deleting a user records changes for the user's files.", null=True)),
+                ('file_count', models.BigIntegerField(default=0)),
+                ('total_size', models.BigIntegerField(default=0, help_text='Change in size of the files in bytes.')),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='storageledger',
+            options={'ordering': ['category', django.db.models.expressions.OrderBy(django.db.models.expressions.F('user_id'), nulls_first=True)]},
+        ),
+    ]
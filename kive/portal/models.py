@@ -3,6 +3,17 @@ portal.models
 
 Kive data models relating to general front-end functionality.
 """
+import logging
+from collections import Counter, namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
 
 FILE_SIZE_MULTIPLIERS = dict(k=1 << 10,
                              m=1 << 20,
@@ -27,3 +38,355 @@ def parse_file_size(text):
     except ValueError:
         raise ValueError('Invalid file size: {!r}'.format(text))
     return int(raw_value * multiplier + 0.5)
+
+
+class StorageSource(namedtuple('StorageSource',
+                               'category model_label file_field size_field user_field')):
+    """ A model that stores files in MEDIA_ROOT.
+
+    A record uses storage if its file field is set and its size is known.
+    user_field is the owner's id, and can follow one foreign key, like
+    run__user_id.
+    """
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def measure(self, instance):
+        """ Find the (size, file_count) that a record uses.
+
+        :return: the usage, or None if the fields weren't loaded
+        """
+        try:
+            file_value = instance.__dict__[self.file_field]
+            file_size = instance.__dict__[self.size_field]
+        except KeyError:
+            return None  # Deferred field
+        if not file_value or file_size is None:
+            return 0, 0
+        return file_size, 1
+
+    def find_user_ids(self, instances):
+        """ Find the owner id for each record. """
+        if '__' not in self.user_field:
+            return [getattr(instance, self.user_field) for instance in instances]
+        relation_name, user_field = self.user_field.split('__')
+        # noinspection PyProtectedMember
+        relation = self.model._meta.get_field(relation_name)
+        related_ids = [getattr(instance, relation.attname) for instance in instances]
+        owners = dict(relation.related_model.objects.filter(
+            pk__in=set(related_ids)).values_list('pk', user_field))
+        return [owners.get(related_id) for related_id in related_ids]
+
+
+class StorageLedger(models.Model):
+    """ Running totals of storage used in MEDIA_ROOT.
+
+    Signals record a StorageChange when records are saved or deleted, and
+    fold_changes() adds them to the totals before they're read. Bulk changes
+    have to call track_changes() themselves. Purge synchronization calls
+    reconcile() to correct any drift.
+    """
+    CONTAINERS = 'containers'
+    SANDBOXES = 'sandboxes'
+    LOGS = 'logs'
+    DATASETS = 'datasets'
+    CATEGORIES = ((CONTAINERS, 'containers'),
+                  (SANDBOXES, 'container runs'),
+                  (LOGS, 'container logs'),
+                  (DATASETS, 'datasets'))
+    SOURCES = (StorageSource(CONTAINERS,
+                             'container.Container',
+                             'file',
+                             'file_size',
+                             'user_id'),
+               StorageSource(SANDBOXES,
+                             'container.ContainerRun',
+                             'sandbox_path',
+                             'sandbox_size',
+                             'user_id'),
+               StorageSource(LOGS,
+                             'container.ContainerLog',
+                             'long_text',
+                             'log_size',
+                             'run__user_id'),
+               StorageSource(DATASETS,
+                             'librarian.Dataset',
+                             'dataset_file',
+                             'dataset_size',
+                             'user_id'))
+
+    category = models.CharField(max_length=20, choices=CATEGORIES)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             null=True,
+                             blank=True,
+                             related_name='storage_ledgers',
+                             on_delete=models.CASCADE,
+                             help_text='Owner of the files, or blank for the '
+                                       'total of all users.')
+    file_count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0,
+                                        help_text='Size of all the files in bytes.')
+    reconcile_time = models.DateTimeField(null=True,
+                                          blank=True,
+                                          help_text='When the totals were last '
+                                                    'checked against the files.')
+
+    class Meta:
+        ordering = ['category', F('user_id').asc(nulls_first=True)]
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'user'],
+                                    name='storage_ledger_user_unique'),
+            models.UniqueConstraint(fields=['category'],
+                                    condition=Q(user=None),
+                                    name='storage_ledger_total_unique')]
+
+    def __str__(self):
+        return '{} for {}'.format(self.get_category_display(),
+                                  self.user or 'all users')
+
+    @classmethod
+    def find_source(cls, model):
+        # noinspection PyProtectedMember
+        label = model._meta.label
+        for source in cls.SOURCES:
+            if source.model_label == label:
+                return source
+        return None
+
+    @classmethod
+    def get_totals(cls):
+        """ Read the total size of each category.
+
+        :return: {category: total_size}, with zero for any missing category
+        """
+        cls.fold_changes()
+        totals = {category: 0 for category, _ in cls.CATEGORIES}
+        totals.update(cls.objects.filter(user=None).values_list('category',
+                                                                'total_size'))
+        return totals
+
+    @classmethod
+    def track_changes(cls, instances, created=False):
+        """ Record changes to records that were just saved.
+
+        Signals call this for each save, and bulk_create() or bulk_update()
+        callers should call it with all the records they saved.
+        :param instances: a list of records from the same model
+        :param bool created: True if the records are new
+        """
+        if not instances:
+            return
+        source = cls.find_source(type(instances[0]))
+        changes = []
+        for instance in instances:
+            old_usage = (0, 0) if created else getattr(instance, '_storage_usage', None)
+            new_usage = source.measure(instance)
+            instance._storage_usage = new_usage
+            if old_usage is None or new_usage is None:
+                continue  # Unknown until the next reconcile.
+            changes.append((instance,
+                            new_usage[0] - old_usage[0],
+                            new_usage[1] - old_usage[1]))
+        cls.record_changes(source, changes)
+
+    @classmethod
+    def track_deletions(cls, instances):
+        """ Record records that were just deleted. """
+        if not instances:
+            return
+        source = cls.find_source(type(instances[0]))
+        changes = []
+        for instance in instances:
+            old_usage = getattr(instance, '_storage_usage', None)
+            if old_usage is not None:
+                changes.append((instance, -old_usage[0], -old_usage[1]))
+            instance._storage_usage = (0, 0)
+        cls.record_changes(source, changes)
+
+    @classmethod
+    def record_changes(cls, source, changes):
+        """ Record changes to be added to the running totals.
+
+        Only inserts rows, so saves in different transactions don't wait for
+        each other to update the same ledger rows.
+        :param StorageSource source: where the changes happened
+        :param changes: [(instance, size_change, count_change)]
+        """
+        changes = [change for change in changes if change[1] or change[2]]
+        if not changes:
+            return
+        user_ids = source.find_user_ids([instance for instance, _, _ in changes])
+        size_changes = Counter()
+        count_changes = Counter()
+        for user_id, (_, size_change, count_change) in zip(user_ids, changes):
+            size_changes[user_id] += size_change
+            count_changes[user_id] += count_change
+        StorageChange.objects.bulk_create(
+            StorageChange(category=source.category,
+                          user_id=user_id,
+                          total_size=size_change,
+                          file_count=count_changes[user_id])
+            for user_id, size_change in size_changes.items())
+
+    @classmethod
+    def fold_changes(cls, category=None, batch_size=1000):
+        """ Add recorded changes to the running totals, and delete them.
+
+        Each batch is its own short transaction.
+        :param category: only fold changes for one category, or None for all
+        :param batch_size: number of changes to fold in each transaction
+        """
+        while True:
+            with transaction.atomic():
+                changes = StorageChange.objects.select_for_update().order_by('id')
+                if category is not None:
+                    changes = changes.filter(category=category)
+                batch = list(changes.values_list('id',
+                                                 'category',
+                                                 'user_id',
+                                                 'total_size',
+                                                 'file_count')[:batch_size])
+                if not batch:
+                    return
+                size_changes = Counter()
+                count_changes = Counter()
+                for _, change_category, user_id, size_change, count_change in batch:
+                    for ledger_user_id in {user_id, None}:
+                        key = (change_category, ledger_user_id)
+                        size_changes[key] += size_change
+                        count_changes[key] += count_change
+                user_ids = {user_id for _, user_id in size_changes}
+                existing_user_ids = set(User.objects.filter(
+                    pk__in=user_ids).values_list('pk', flat=True))
+                existing_user_ids.add(None)
+                for (change_category, user_id), size_change in size_changes.items():
+                    if user_id not in existing_user_ids:
+                        continue  # Deleted along with the user's ledger.
+                    cls.add_change(change_category,
+                                   user_id,
+                                   size_change,
+                                   count_changes[(change_category, user_id)])
+                StorageChange.objects.filter(
+                    id__in=[change_id for change_id, *_ in batch]).delete()
+
+    @classmethod
+    def add_change(cls, category, user_id, size_change, count_change):
+        ledgers = cls.objects.filter(category=category, user_id=user_id)
+        updates = dict(total_size=F('total_size') + size_change,
+                       file_count=F('file_count') + count_change)
+        if ledgers.update(**updates):
+            return
+        if user_id is not None and (size_change < 0 or count_change < 0):
+            # The user is probably being deleted, along with their ledger.
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(category=category,
+                                   user_id=user_id,
+                                   total_size=size_change,
+                                   file_count=count_change)
+        except IntegrityError:
+            # Someone else created it first.
+            ledgers.update(**updates)
+
+    @classmethod
+    def reconcile(cls):
+        """ Recalculate the totals from the records, and correct any drift.
+
+        :return: {category: size_drift}, where size_drift is how many bytes
+            the ledger was over the records' total
+        """
+        now = timezone.now()
+        drifts = {}
+        for source in cls.SOURCES:
+            cls.fold_changes(source.category)
+            with transaction.atomic():
+                # Lock the ledger, so other changes wait until this finishes.
+                old_ledgers = {ledger.user_id: ledger
+                               for ledger in cls.objects.select_for_update().filter(
+                                   category=source.category)}
+                # Changes that are already committed are counted in the
+                # records, so they're replaced by the new totals. One that
+                # commits before the records are summed is counted twice
+                # until the next reconcile.
+                counted_change_ids = list(
+                    StorageChange.objects.select_for_update().filter(
+                        category=source.category).values_list('id', flat=True))
+                usage = source.model.objects.exclude(
+                    **{source.file_field: ''}).exclude(
+                    **{source.file_field: None}).exclude(
+                    **{source.size_field: None}).values(
+                    source.user_field).annotate(
+                    total_size=Sum(source.size_field),
+                    file_count=Count('pk')).order_by()
+                new_totals = {row[source.user_field]: (row['total_size'],
+                                                       row['file_count'])
+                              for row in usage}
+                new_totals[None] = (sum(total for total, _ in new_totals.values()),
+                                    sum(count for _, count in new_totals.values()))
+                old_total = old_ledgers.get(None)
+                drifts[source.category] = (
+                    (old_total.total_size if old_total else 0) - new_totals[None][0])
+                if drifts[source.category]:
+                    logger.warning('Corrected %s storage ledger by %d bytes.',
+                                   source.category,
+                                   -drifts[source.category])
+                for user_id, ledger in old_ledgers.items():
+                    if user_id not in new_totals:
+                        ledger.delete()
+                for user_id, (total_size, file_count) in new_totals.items():
+                    ledger = old_ledgers.get(user_id)
+                    if ledger is None:
+                        ledger = cls(category=source.category, user_id=user_id)
+                    ledger.total_size = total_size
+                    ledger.file_count = file_count
+                    ledger.reconcile_time = now
+                    ledger.save()
+                StorageChange.objects.filter(id__in=counted_change_ids).delete()
+        return drifts
+
+
+class StorageChange(models.Model):
+    """ A change to the storage totals that hasn't been added to the ledger. """
+    category = models.CharField(max_length=20,
+                                choices=StorageLedger.CATEGORIES)
+    user_id = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="Owner of the files. Not a foreign key, because deleting a "
+                  "user records changes for the user's files.")
+    file_count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0,
+                                        help_text='Change in size of the files in bytes.')
+
+
+class StorageSnapshot(models.Model):
+    """ Total storage for a category at one time, for capacity planning. """
+    category = models.CharField(max_length=20,
+                                choices=StorageLedger.CATEGORIES)
+    snapshot_time = models.DateTimeField(default=timezone.now)
+    file_count = models.BigIntegerField(default=0)
+    total_size = models.BigIntegerField(default=0,
+                                        help_text='Size of all the files in bytes.')
+
+    class Meta:
+        ordering = ['snapshot_time', 'category']
+        indexes = [models.Index(fields=['snapshot_time'],
+                                name='storage_snapshot_time_idx')]
+
+    @classmethod
+    def record(cls):
+        """ Copy the current totals from the ledger. """
+        StorageLedger.fold_changes()
+        now = timezone.now()
+        ledgers = {ledger.category: ledger
+                   for ledger in StorageLedger.objects.filter(user=None)}
+        snapshots = []
+        for category, _ in StorageLedger.CATEGORIES:
+            ledger = ledgers.get(category)
+            snapshots.append(cls(category=category,
+                                 snapshot_time=now,
+                                 file_count=ledger.file_count if ledger else 0,
+                                 total_size=ledger.total_size if ledger else 0))
+        return cls.objects.bulk_create(snapshots)
@@ -0,0 +1,26 @@
+from rest_framework import serializers
+
+from portal.models import StorageLedger, StorageSnapshot
+
+
+class StorageLedgerSerializer(serializers.ModelSerializer):
+    user = serializers.SlugRelatedField(slug_field='username', read_only=True)
+
+    class Meta:
+        model = StorageLedger
+        fields = ('id',
+                  'category',
+                  'user',
+                  'file_count',
+                  'total_size',
+                  'reconcile_time')
+
+
+class StorageSnapshotSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StorageSnapshot
+        fields = ('id',
+                  'category',
+                  'snapshot_time',
+                  'file_count',
+                  'total_size')
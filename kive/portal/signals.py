@@ -0,0 +1,18 @@
+from portal.models import StorageLedger
+
+
+def remember_storage(sender, instance, **kwargs):
+    """ Record the storage a record uses when it's loaded. """
+    source = StorageLedger.find_source(sender)
+    if source is not None:
+        instance._storage_usage = source.measure(instance)
+
+
+def track_storage(sender, instance, created, **kwargs):
+    if StorageLedger.find_source(sender) is not None:
+        StorageLedger.track_changes([instance], created=created)
+
+
+def track_storage_deletion(sender, instance, **kwargs):
+    if StorageLedger.find_source(sender) is not None:
+        StorageLedger.track_deletions([instance])
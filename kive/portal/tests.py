@@ -0,0 +1,214 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse, resolve
+from rest_framework import status
+from rest_framework.test import force_authenticate, APIRequestFactory
+
+from librarian.models import Dataset
+from portal.models import StorageLedger, StorageSnapshot, StorageChange
+
+
+class StorageLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('ledger_user')
+
+    def create_dataset(self, name='example', size=100):
+        return Dataset.objects.create(user=self.user,
+                                      name=name,
+                                      dataset_file='Datasets/{}.txt'.format(name),
+                                      dataset_size=size)
+
+    def assertLedger(self, expected_count, expected_size, user=None):
+        StorageLedger.fold_changes()
+        ledger = StorageLedger.objects.get(category=StorageLedger.DATASETS,
+                                           user=user)
+        self.assertEqual((expected_count, expected_size),
+                         (ledger.file_count, ledger.total_size))
+
+    def test_create(self):
+        self.create_dataset('a', 100)
+        self.create_dataset('b', 20)
+
+        self.assertLedger(2, 120)
+        self.assertLedger(2, 120, self.user)
+        self.assertEqual(120, StorageLedger.get_totals()[StorageLedger.DATASETS])
+
+    def test_changes_recorded_separately(self):
+        """ Saves only insert changes, they don't lock the ledger rows. """
+        self.create_dataset('a', 100)
+        self.create_dataset('b', 20)
+
+        self.assertFalse(StorageLedger.objects.exists())
+        self.assertEqual([100, 20],
+                         list(StorageChange.objects.order_by('id').values_list(
+                             'total_size',
+                             flat=True)))
+
+        StorageLedger.fold_changes(batch_size=1)
+
+        self.assertLedger(2, 120)
+        self.assertLedger(2, 120, self.user)
+        self.assertFalse(StorageChange.objects.exists())
+
+    def test_size_unknown(self):
+        """ Files don't count until their size is recorded. """
+        dataset = self.create_dataset('a', size=None)
+        self.assertEqual(0, StorageLedger.get_totals()[StorageLedger.DATASETS])
+
+        dataset = Dataset.objects.get(id=dataset.id)
+        dataset.dataset_size = 100
+        dataset.save()
+
+        self.assertLedger(1, 100)
+
+    def test_purge(self):
+        self.create_dataset('a', 100)
+        dataset = self.create_dataset('b', 20)
+
+        dataset.purge_file()
+
+        self.assertLedger(1, 100)
+        self.assertLedger(1, 100, self.user)
+
+    def test_delete(self):
+        self.create_dataset('a', 100)
+        dataset = self.create_dataset('b', 20)
+
+        Dataset.objects.get(id=dataset.id).delete()
+
+        self.assertLedger(1, 100)
+
+    def test_delete_user(self):
+        self.create_dataset('a', 100)
+        other_user = User.objects.create_user('other_user')
+        Dataset.objects.create(user=other_user,
+                               name='other',
+                               dataset_file='Datasets/other.txt',
+                               dataset_size=20)
+
+        user_id = self.user.id
+
+        self.user.delete()
+
+        self.assertLedger(1, 20)
+        self.assertFalse(StorageLedger.objects.filter(user_id=user_id).exists())
+
+    def test_deferred_fields(self):
+        """ Saving a partly loaded record is ignored until the reconcile. """
+        dataset = self.create_dataset('a', 100)
+        dataset = Dataset.objects.only('id', 'user_id', 'name').get(id=dataset.id)
+
+        dataset.name = 'renamed'
+        dataset.save()
+
+        self.assertLedger(1, 100)
+
+    def test_bulk_update(self):
+        self.create_dataset('a', 100)
+        datasets = list(Dataset.objects.filter(user=self.user))
+        for dataset in datasets:
+            dataset.dataset_size = 150
+
+        Dataset.objects.bulk_update(datasets, ['dataset_size'])
+        StorageLedger.track_changes(datasets)
+
+        self.assertLedger(1, 150)
+
+    def test_reconcile(self):
+        self.create_dataset('a', 100)
+        self.create_dataset('b', 20)
+        Dataset.objects.filter(name='b').update(dataset_size=30)
+
+        with self.assertLogs('portal.models') as logs:
+            drifts = StorageLedger.reconcile()
+
+        self.assertEqual(-10, drifts[StorageLedger.DATASETS])
+        self.assertEqual(0, drifts[StorageLedger.LOGS])
+        self.assertEqual(['WARNING:portal.models:Corrected datasets storage '
+                          'ledger by 10 bytes.'],
+                         logs.output)
+        self.assertLedger(2, 130)
+        self.assertLedger(2, 130, self.user)
+        ledger = StorageLedger.objects.get(category=StorageLedger.DATASETS,
+                                           user=None)
+        self.assertIsNotNone(ledger.reconcile_time)
+
+    def test_reconcile_removes_empty_users(self):
+        dataset = self.create_dataset('a', 100)
+        Dataset.objects.filter(id=dataset.id).update(dataset_file='')
+
+        StorageLedger.reconcile()
+
+        self.assertLedger(0, 0)
+        self.assertFalse(StorageLedger.objects.filter(user=self.user).exists())
+
+    def test_snapshot(self):
+        self.create_dataset('a', 100)
+
+        StorageSnapshot.record()
+        self.create_dataset('b', 20)
+        StorageSnapshot.record()
+
+        snapshots = StorageSnapshot.objects.filter(
+            category=StorageLedger.DATASETS)
+        self.assertEqual([100, 120], [snapshot.total_size for snapshot in snapshots])
+        self.assertEqual(2 * len(StorageLedger.CATEGORIES),
+                         StorageSnapshot.objects.count())
+
+
+class StorageApiTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.admin = User.objects.create_user('ledger_admin', is_staff=True)
+        self.user = User.objects.create_user('ledger_user')
+        Dataset.objects.create(user=self.user,
+                               name='example',
+                               dataset_file='Datasets/example.txt',
+                               dataset_size=100)
+        self.list_path = reverse('storageledger-list')
+        self.list_view, _, _ = resolve(self.list_path)
+        self.totals_path = reverse('storageledger-totals')
+        self.totals_view, _, _ = resolve(self.totals_path)
+
+    def test_list(self):
+        request = self.factory.get(self.list_path, dict(category='datasets'))
+        force_authenticate(request, user=self.admin)
+        response = self.list_view(request)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([(None, 100), ('ledger_user', 100)],
+                         [(row['user'], row['total_size']) for row in response.data])
+
+    def test_list_totals(self):
+        request = self.factory.get(self.list_path, dict(totals=''))
+        force_authenticate(request, user=self.admin)
+        response = self.list_view(request)
+
+        self.assertEqual([None], [row['user'] for row in response.data])
+
+    def test_totals(self):
+        request = self.factory.get(self.totals_path)
+        force_authenticate(request, user=self.admin)
+        response = self.totals_view(request)
+
+        self.assertEqual(dict(file_count=1, total_size=100),
+                         response.data['datasets'])
+        self.assertEqual(dict(file_count=0, total_size=0),
+                         response.data['logs'])
+
+    def test_not_admin(self):
+        request = self.factory.get(self.totals_path)
+        force_authenticate(request, user=self.user)
+        response = self.totals_view(request)
+
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+    def test_history(self):
+        StorageSnapshot.record()
+        path = reverse('storagesnapshot-list')
+        view, _, _ = resolve(path)
+        request = self.factory.get(path)
+        force_authenticate(request, user=self.admin)
+        response = view(request)
+
+        self.assertEqual(len(StorageLedger.CATEGORIES), len(response.data))
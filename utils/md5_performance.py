@@ -0,0 +1,131 @@
+""" Test MD5 hashing speed with different chunk sizes and thread counts.
+
+Run it once on local storage and once on network storage, appending to the
+same times file, then plot the results together. For example:
+
+    python md5_performance.py /tmp/samples --times md5_times.csv
+    python md5_performance.py /mnt/shared/samples --times md5_times.csv
+    python md5_performance.py --plot md5_times.csv
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
+from csv import DictWriter
+from datetime import datetime
+import os
+from socket import gethostname
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir,
+                             'kive'))
+from file_access_utils import compute_md5s  # noqa
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Test MD5 speed with different chunk sizes and threads',
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('data',
+                        nargs='?',
+                        help='data folder with files to hash')
+    parser.add_argument('--times',
+                        type=FileType('a'),
+                        help='CSV file to append hash times to')
+    parser.add_argument('--chunks',
+                        type=int,
+                        nargs='+',
+                        default=[64*1024, 256*1024, 1024*1024, 4*1024*1024],
+                        help='chunk sizes to test (bytes)')
+    parser.add_argument('--threads',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8, 16],
+                        help='thread counts to test')
+    parser.add_argument('--max_bandwidth',
+                        type=float,
+                        default=0,
+                        help='bandwidth limit (MB/s), or 0 for no limit')
+    parser.add_argument('--plot',
+                        nargs='*',
+                        help='CSV files to plot times from')
+    args = parser.parse_args()
+    if args.times is None:
+        args.times = sys.stdout
+    if not args.plot and args.data is None:
+        parser.error('the data folder is required, unless plotting')
+    return args
+
+
+def plot_results(args):
+    from matplotlib import pyplot as plt
+    import pandas as pd
+
+    df = pd.concat(pd.read_csv(data_file) for data_file in args.plot)
+    storage_groups = df.groupby(['host', 'data'])
+    # noinspection PyTypeChecker
+    f, axes_list = plt.subplots(len(storage_groups),
+                                1,
+                                sharex=True,
+                                sharey=True,
+                                squeeze=False)
+    for ax, ((host, data), storage_df) in zip(axes_list[:, 0], storage_groups):
+        for chunk, chunk_df in storage_df.groupby('chunk'):
+            chunk_df.plot(x='threads',
+                          y='rate',
+                          label='{} KB'.format(chunk // 1024),
+                          logx=True,
+                          title='{}:{}'.format(host, data),
+                          ax=ax)
+        ax.set_ylabel('Hash rate (MB/s)')
+    plt.tight_layout()
+    plt.show()
+
+
+def find_files(data_folder):
+    file_paths = []
+    for dir_path, _, file_names in os.walk(data_folder):
+        for file_name in file_names:
+            file_paths.append(os.path.join(dir_path, file_name))
+    return file_paths
+
+
+def main():
+    args = parse_args()
+    if args.plot:
+        plot_results(args)
+        return
+    has_header = args.times is not sys.stdout and args.times.tell() != 0
+    file_paths = find_files(args.data)
+    data_size = sum(os.lstat(file_path).st_size for file_path in file_paths)
+    host_name = gethostname()
+    writer = DictWriter(args.times,
+                        ['host', 'data', 'files', 'chunk', 'threads', 'time', 'rate'],
+                        lineterminator=os.linesep)
+    if not has_header:
+        writer.writeheader()
+
+    # Hash everything once to avoid cache effects on the first combination.
+    # Files bigger than the page cache will still be read from storage.
+    for _ in compute_md5s(file_paths, thread_count=4, chunk_size=1024*1024,
+                          max_bandwidth=args.max_bandwidth):
+        pass
+    for chunk_size in args.chunks:
+        for thread_count in args.threads:
+            start_time = datetime.now()
+            for _ in compute_md5s(file_paths,
+                                  thread_count=thread_count,
+                                  chunk_size=chunk_size,
+                                  max_bandwidth=args.max_bandwidth):
+                pass
+            duration = (datetime.now() - start_time).total_seconds()
+            writer.writerow(dict(host=host_name,
+                                 data=os.path.abspath(args.data),
+                                 files=len(file_paths),
+                                 chunk=chunk_size,
+                                 threads=thread_count,
+                                 time=duration,
+                                 rate=data_size / 1024 / 1024 / duration))
+            args.times.flush()
+
+
+if __name__ == '__main__':
+    main()